@@ -19,6 +19,8 @@ use POSIX;
 use Classifier;
 use Time::HiRes   qw(usleep nanosleep);
 use Digest::SHA1  qw(sha1_hex);
+use IO::Socket::UNIX;
+use Socket        qw(SOCK_STREAM);
 
 use threads;
 use threads::shared;
@@ -54,6 +56,79 @@ sub run_qx_ordered {
     return $output;
 }
 
+# Sends one batch to the prediction server and reads its rows up to the blank
+# line that ends the batch. Returns the rows, or undef and the reason when the
+# server cannot be reached or closes the connection before the end of the batch.
+
+sub request_socket_predictions {
+    my $fn_socket = shift;
+    my @to_process = @_;
+    my $sock = IO::Socket::UNIX->new( Type => SOCK_STREAM, Peer => $fn_socket ) 
+		or return (undef, "Unable to connect to prediction server $fn_socket: $!");
+    print $sock map { "$_\n" } @to_process;
+    print $sock "\n";
+    $sock->flush;
+    my @output;
+    my $complete = 0;
+    while ( my $line = <$sock> ) {
+		if ( $line eq "\n" ) { $complete = 1; last; }
+		push @output, $line;
+    }
+    close $sock;
+    return (undef, "Prediction server $fn_socket closed the connection after ".scalar(@output)." of ".scalar(@to_process)." rows") if ! $complete;
+    return (\@output, undef);
+}
+
+sub run_socket_ordered {
+    my $order = shift;
+    my $fn_socket = shift;
+    my @to_process = @_;
+    # A worker that dies mid-batch must not take the whole run down
+    $SIG{PIPE} = 'IGNORE';
+    my ($output, $error) = request_socket_predictions($fn_socket, @to_process);
+    if ( defined $error ) {
+		warn "$0: $error, retrying the batch\n";
+		($output, $error) = request_socket_predictions($fn_socket, @to_process);
+		die "$0: $error\n" if defined $error;
+    }
+    die "$0: Prediction server returned ".scalar(@$output)." rows for ".scalar(@to_process)." images\n" if scalar(@$output) != scalar(@to_process);
+    return join("\n", "$order", join('', @$output) );
+}
+
+#########################################################################################
+# Starts MobileNetV2.py serve on a Unix socket so that the model is loaded once 
+# for the whole run instead of once per batch. Returns the server pid and socket.
+
+sub start_prediction_server {
+    my $fn_model = shift;
+    my $n_workers = shift;
+    my $predict_args = shift // '';
+    my $fn_socket = mlev_tmpfile("predict.sock");
+    
+    my $cmd = join("; ", 
+		mlev_config('CL-TFImage.tf_gpu.activate'),
+		"export TF_CPP_MIN_LOG_LEVEL=2; exec python3 $mlev_dir/tf/MobileNetV2.py$predict_args -w $n_workers -S \"$fn_socket\" serve \"$fn_model\""
+	);
+	printf STDERR "\e[1;37m> $cmd\e[0m\n";
+	
+    my $pid = fork();
+    die "$0: Unable to fork prediction server: $!" if ! defined $pid;
+    if ( $pid == 0 ) {
+		exec("bash", "-c", $cmd) or POSIX::_exit(1);
+    }
+    
+    usleep(100000) while ( ! -S $fn_socket and waitpid($pid, WNOHANG) == 0 );
+    die "$0: Prediction server exited before listening on $fn_socket" if ! -S $fn_socket;
+    
+    return ($pid, $fn_socket);
+}
+
+sub stop_prediction_server {
+    my $pid = shift;
+    kill 'TERM', $pid;
+    waitpid($pid, 0);
+}
+
 #########################################################################################
 
 sub train {
@@ -83,8 +158,14 @@ sub train {
 		/hidden-layers=(.+)/ and do { $cmd_args .= " -l $1"; next; } ;
 		/arch=(.+)/ and do { $cmd_args .= " -a $1"; next; } ;
 		/trainable/ and do { $cmd_args .= " -t"; next; } ;
+		/augmented-views=(\d+)/ and do { $cmd_args .= " -K $1"; next; } ;
     }
     
+    my $embedding_cache = mlev_config('CL-TFImage.embedding_cache') // '';
+    $cmd_args .= " -E \"$embedding_cache\"" if $embedding_cache ne '';
+    my $hub_dir = mlev_config('CL-TFImage.hub_dir') // '';
+    $cmd_args .= " -H \"$hub_dir\"" if $hub_dir ne '';
+    
     my $graph_file = mlev_tmpfile('graph');
     my $label_file = mlev_tmpfile('label');
     
@@ -128,7 +209,23 @@ sub predict {
     
     my $tmpfn_imagelist = mlev_tmpfile("imagelist");
  
-	my $max_threads = max( ceil($nproc * 2 / 3), 1);
+	# Thread budget per prediction process, as measured by MobileNetV2.py tune
+	my $n_predict_workers = mlev_config('CL-TFImage.predict.workers') // 0;
+	my $n_predict_threads = mlev_config('CL-TFImage.predict.threads') // 0;
+	my $predict_batch_size = mlev_config('CL-TFImage.predict.batch_size') // 0;
+	my $predict_args = '';
+	$predict_args .= " -i $n_predict_threads -j 1" if $n_predict_threads > 0;
+	$predict_args .= " -b $predict_batch_size" if $predict_batch_size > 0;
+	my $hub_dir = mlev_config('CL-TFImage.hub_dir') // '';
+	$predict_args .= " -H \"$hub_dir\"" if $hub_dir ne '';
+	my $prediction_cache = mlev_config('CL-TFImage.prediction_cache') // '';
+	$predict_args .= " -P \"$prediction_cache\"" if $prediction_cache ne '';
+ 
+	my $n_serve_workers = mlev_config('CL-TFImage.serve.workers') // 0;
+	my ($server_pid, $fn_socket);
+	($server_pid, $fn_socket) = start_prediction_server($fn_model, $n_serve_workers, $predict_args) if $n_serve_workers > 0;
+	
+	my $max_threads = $n_serve_workers > 0 ? $n_serve_workers : $n_predict_workers > 0 ? $n_predict_workers : max( ceil($nproc * 2 / 3), 1);
 	our $total = scalar(@image_list) ;
 	our $n_processed = 0;
  	our $batch_size = ( ($total / $max_threads) < ($nproc * 6) ) ?  int( ($total + 1) / ( ( $max_threads - 1 ) || 1)  ) : ($nproc * 4)  ;
@@ -170,41 +267,54 @@ sub predict {
 
 	}
 	
+	# A batch whose rows are missing would shift every later row of the
+	# output, so a failed batch stops the run.
+	my $join_ordered = sub {
+		my $thr = shift;
+		my $retval = $thr -> join();
+		if ( my $error = $thr -> error() ) {
+			stop_prediction_server($server_pid) if defined $server_pid;
+			die $error;
+		}
+		my ($thr_order, $rows) = split /\n/, $retval, 2;
+		$output_array[$thr_order] = $rows;
+		report_progress( $thr_order, $rows );
+	};
+	
     while ( scalar(@image_list) ) {
 		my @to_process = splice @image_list, 0, $batch_size;
 		push @to_process, (splice @image_list, 0) if scalar(@image_list) < scalar(@to_process) / 4 ;
-			
-		my $tmpfn_imagelist1 = $tmpfn_imagelist.$order;
-		open TMPFN, ">$tmpfn_imagelist1";
-		print TMPFN map { "$_\n" } @to_process;
-		close TMPFN;
 		
-		my $cmd = join("; ", 
-			mlev_config('CL-TFImage.tf_gpu.activate'),
-			"export TF_CPP_MIN_LOG_LEVEL=2; python3 $mlev_dir/tf/MobileNetV2.py predict \"$fn_model\" index:$tmpfn_imagelist1; rm  $tmpfn_imagelist1",
-			mlev_config('CL-TFImage.tf_gpu.deactivate')
-		); 
-
 		$n_active_threads ++;
-		my $thr = threads->create( \&run_qx_ordered, $order, $cmd ) ;
+		if ( defined $fn_socket ) {
+			my $thr = threads->create( \&run_socket_ordered, $order, $fn_socket, @to_process ) ;
+		} else {
+			my $tmpfn_imagelist1 = $tmpfn_imagelist.$order;
+			open TMPFN, ">$tmpfn_imagelist1";
+			print TMPFN map { "$_\n" } @to_process;
+			close TMPFN;
+			
+			my $cmd = join("; ", 
+				mlev_config('CL-TFImage.tf_gpu.activate'),
+				"export TF_CPP_MIN_LOG_LEVEL=2; python3 $mlev_dir/tf/MobileNetV2.py$predict_args predict \"$fn_model\" index:$tmpfn_imagelist1; rm  $tmpfn_imagelist1",
+				mlev_config('CL-TFImage.tf_gpu.deactivate')
+			); 
+			my $thr = threads->create( \&run_qx_ordered, $order, $cmd ) ;
+		}
 		while ( $n_active_threads >=  $max_threads ) {
 			for my $thr ( threads->list() ) {
 				next if ! $thr -> is_joinable();
-				my ($thr_order, $retval) = split /\n/, ( $thr -> join() ), 2;
-				$output_array[$thr_order] = $retval;
+				$join_ordered->( $thr );
 				-- $n_active_threads;
-				report_progress( $thr_order, $retval );
 			}
 			usleep(100);
 		}
 		++$order;
 	}
 
-	for my $thr ( threads->list() ) {
-		my ($thr_order, $retval) = split /\n/, ( $thr -> join() ), 2;
-		$output_array[$thr_order] = $retval;
-		report_progress( $thr_order, $retval );
-	}
+	$join_ordered->( $_ ) for threads->list();
+	
+	stop_prediction_server($server_pid) if defined $server_pid;
 
     push @output_all, join("\t", @labels);
 
@@ -110,7 +110,7 @@ sub retrain {
 	my ($pipeline) = $trained_model->get_attr('pipeline');
 	my $pipeline_o = $pipeline;
 	for my $arg ( keys %{ $params } ) {
-		next if $arg !~ /^(?:arch|epochs?|split-tiles|patience|trainable|arch|hidden-layers|batch-size)$/;
+		next if $arg !~ /^(?:arch|epochs?|split-tiles|patience|trainable|arch|hidden-layers|batch-size|augmented-views)$/;
 		$pipeline =~ s/\b$arg=\S+//g;  
 		$pipeline .= " $arg=$params->{$arg}";
 		$pipeline =~ s/  +/ /g;
@@ -134,6 +134,10 @@ sub mlev_config {
 	my $item = shift;
 	if ( (! exists $MLEV_config{'processed'}) and (-f $mlev_dir.'/mlev_config')  ) {
 		%MLEV_config = map { my @p = split /=/, $_, 2; s/^\s*|\s*$//g for @p; @p } grep { /=/ } map { chomp; s/\s*#.*//r} file($mlev_dir.'/mlev_config') ;
+		# Host-specific settings, e.g. written by MobileNetV2.py tune, override mlev_config
+		if ( -f $mlev_dir.'/mlev_config.local' ) {
+			%MLEV_config = ( %MLEV_config, map { my @p = split /=/, $_, 2; s/^\s*|\s*$//g for @p; @p } grep { /=/ } map { chomp; s/\s*#.*//r} file($mlev_dir.'/mlev_config.local') );
+		}
 	}
 	$MLEV_config{'processed'} = 1;
 	return 
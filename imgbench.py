@@ -0,0 +1,467 @@
+#!/usr/bin/python3
+from __future__ import print_function
+
+# Benchmarks the Python imaging tools on deterministic synthetic slides.
+# Every slide is rendered band by band from a few low-resolution random
+# fields (tissue, and one annotation per rater), so the same seed gives the
+# same pixels at any size, up to gigapixel slides that do not fit in memory.
+# Each tool runs as a child process; its wall time, peak RSS, tiles/sec and
+# input MB/s are saved as JSON and compared against a baseline run.
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import platform
+import subprocess
+
+import cv2
+import numpy as np
+
+from imgtiles import parse_tile_dim, tile_grid, ImageBands
+
+try:
+	import pyvips
+except ImportError:
+	pyvips = None
+
+FIELD_SCALE = 32
+
+BAND_ROWS = 256
+
+N_RATERS = 3
+
+TISSUE_LEVEL = 128
+
+ANNOTATION_LEVEL = 200
+
+PREDICTION_LEVEL = 184
+
+BACKGROUND_BGR = ( 235, 235, 235 )
+
+TISSUE_BGR = ( 180, 110, 200 )
+
+ANNOTATION_BGR = ( 40, 200, 40 )
+
+TOOLS = [ 'imgsplit', 'imgsplitbymask', 'imgextrmask', 'imgconcord', 'imgconcord-bbox', 'imgkappa', 'predict' ]
+
+tool_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+#####################################################################################################
+# Synthetic slides
+
+# Random field of the given shape, smoothed into blobs and rank-normalised to
+# 0..255, so that the area above a level does not depend on the seed.
+
+def random_field(shape, seed, base=None):
+	rng = np.random.default_rng(seed)
+	field = rng.random(shape, dtype=np.float32)
+	sigma = max( 2.0, min(shape) / 20 )
+	field = cv2.GaussianBlur(field, (0, 0), sigma)
+	if base is not None:
+		field = 0.8 * base + 0.2 * field * 255
+	ranks = np.empty(field.size, dtype=np.float32)
+	ranks[ np.argsort(field, axis=None, kind='stable') ] = np.arange(field.size, dtype=np.float32)
+	return ( ranks * ( 255.0 / max(field.size - 1, 1) ) ).reshape(shape)
+
+
+# Low-resolution fields of a slide of rows x cols pixels: tissue first, then
+# one annotation field per rater. The raters share most of their field, so
+# that they mostly agree.
+
+def slide_fields(rows, cols, seed):
+	shape = ( rows // FIELD_SCALE + 2, cols // FIELD_SCALE + 2 )
+	tissue = random_field(shape, [ seed, 0 ])
+	first = random_field(shape, [ seed, 1 ])
+	return [ tissue, first ] + [ random_field(shape, [ seed, 1 + r ], base=first) for r in range(1, N_RATERS) ]
+
+
+# Bilinear upscaling of rows r0..r1 of a field to the full resolution.
+
+def upscale_rows(field, r0, r1, cols):
+	def axis(n0, n1, size):
+		f = ( np.arange(n0, n1, dtype=np.float32) + 0.5 ) / FIELD_SCALE - 0.5
+		i0 = np.clip( np.floor(f).astype(np.intp), 0, size - 1 )
+		i1 = np.clip( i0 + 1, 0, size - 1 )
+		w = np.clip( f - np.floor(f), 0, 1 ).astype(np.float32)
+		return i0, i1, w
+	ri0, ri1, rw = axis(r0, r1, field.shape[0])
+	ci0, ci1, cw = axis(0, cols, field.shape[1])
+	band = field[ri0] * (1 - rw[:, None]) + field[ri1] * rw[:, None]
+	return band[:, ci0] * (1 - cw) + band[:, ci1] * cw
+
+
+def texture_tile(seed):
+	rng = np.random.default_rng([ seed, 99 ])
+	return rng.normal(0, 12, (256, 256, 3)).astype(np.int16)
+
+
+# Rows r0..r1 of the source slide (rater None) or of the copy annotated by
+# rater r, as BGR uint8.
+
+def render_rows(fields, texture, r0, r1, cols, rater=None):
+	tissue = upscale_rows(fields[0], r0, r1, cols) >= TISSUE_LEVEL
+	rows_idx = np.arange(r0, r1) % texture.shape[0]
+	cols_idx = np.arange(cols) % texture.shape[1]
+	noise = texture[rows_idx][:, cols_idx]
+	band = np.where( tissue[:, :, None], np.int16(TISSUE_BGR), np.int16(BACKGROUND_BGR) ) + np.where( tissue[:, :, None], noise, noise // 4 )
+	band = np.clip(band, 0, 255).astype(np.uint8)
+	if rater is not None:
+		annotated = upscale_rows(fields[1 + rater], r0, r1, cols) >= ANNOTATION_LEVEL
+		band[annotated] = ANNOTATION_BGR
+	return band
+
+
+def render_mask_rows(fields, r0, r1, cols):
+	return np.where( upscale_rows(fields[1], r0, r1, cols) >= PREDICTION_LEVEL, np.uint8(255), np.uint8(0) )
+
+
+# Renders rows x cols pixels band by band into a raw file on disk, then saves
+# it as fn. With pyvips the raw file is streamed into a tiled TIFF, so slides
+# larger than memory can be written; otherwise OpenCV writes it from a memory
+# map.
+
+def write_rendered(fn, rows, cols, bands, render):
+	fn_raw = fn + ".raw"
+	shape = (rows, cols, bands) if bands > 1 else (rows, cols)
+	raw = np.lib.format.open_memmap(fn_raw, mode='w+', dtype=np.uint8, shape=shape)
+	for r0 in range(0, rows, BAND_ROWS):
+		r1 = min(r0 + BAND_ROWS, rows)
+		raw[r0:r1] = render(r0, r1)
+	raw.flush()
+	offset = raw.offset
+	del raw
+	try:
+		if pyvips is not None:
+			img = pyvips.Image.rawload(fn_raw, cols, rows, bands, offset=offset)
+			if bands == 3:
+				img = img[2].bandjoin( [ img[1], img[0] ] ).copy(interpretation='srgb')
+			if fn.endswith('.tif'):
+				img.tiffsave(fn, tile=True, tile_width=512, tile_height=512, compression='jpeg', Q=90, bigtiff=True)
+			else:
+				img.write_to_file(fn)
+		else:
+			cv2.imwrite( fn, np.load(fn_raw, mmap_mode='r') )
+	finally:
+		os.remove(fn_raw)
+
+
+# Source slide, one annotated copy per rater, a predicted mask and the tile
+# boxes of the slide, written to dir_data once per size and seed.
+
+def make_slide(dir_data, rows, cols, seed):
+	name = "slide-{}x{}-s{}".format(cols, rows, seed)
+	data = {
+		'src': os.path.join(dir_data, name + ".tif"),
+		'gndt': [ os.path.join(dir_data, name + "-gt{}.tif".format(r)) for r in range(N_RATERS) ],
+		'pred': os.path.join(dir_data, name + "-pred.png"),
+		'boxes': os.path.join(dir_data, name + "-boxes.txt"),
+		}
+	if all( os.path.isfile(fn) for fn in [ data['src'], data['pred'], data['boxes'] ] + data['gndt'] ):
+		return data
+
+	eprint("Generating " + name)
+	os.makedirs(dir_data, exist_ok=True)
+	fields = slide_fields(rows, cols, seed)
+	texture = texture_tile(seed)
+	write_rendered( data['src'], rows, cols, 3, lambda r0, r1: render_rows(fields, texture, r0, r1, cols) )
+	for r, fn in enumerate(data['gndt']):
+		write_rendered( fn, rows, cols, 3, lambda r0, r1: render_rows(fields, texture, r0, r1, cols, rater=r) )
+	write_rendered( data['pred'], rows, cols, 1, lambda r0, r1: render_mask_rows(fields, r0, r1, cols) )
+	with open(data['boxes'], 'w') as f:
+		for y, x in tile_grid(cols, rows, 224, 224):
+			f.write( "{} {} {} {}\n".format(y, x, y + 223, x + 223) )
+	return data
+
+
+# The first n_tiles 224x224 tiles of the slide, as JPEG files listed in an
+# index file for MobileNetV2.py predict.
+
+def make_predict_tiles(data, dir_data, n_tiles):
+	dir_tiles = os.path.splitext(data['src'])[0] + "-tiles{}".format(n_tiles)
+	fn_index = dir_tiles + ".txt"
+	if os.path.isfile(fn_index):
+		return fn_index
+	os.makedirs(dir_tiles, exist_ok=True)
+	bands = ImageBands(data['src'])
+	names = []
+	for y, x in tile_grid(bands.width, bands.height, 224, 224):
+		if len(names) >= n_tiles:
+			break
+		tile = bands.read_rows(y, y + 224)[:, x:x + 224]
+		if tile.shape[0] < 224 or tile.shape[1] < 224:
+			continue
+		names.append( os.path.join(dir_tiles, "tile-{:05d}-{:05d}.jpg".format(y, x)) )
+		cv2.imwrite(names[-1], tile)
+	with open(fn_index, 'w') as f:
+		f.write( "".join( fn + "\n" for fn in names ) )
+	return fn_index
+
+
+# A tiny randomly initialised classifier saved as a SavedModel, so that the
+# predict benchmark needs neither the network nor a trained model. Returns
+# None when TensorFlow is not installed.
+
+def make_tiny_model(dir_data, seed):
+	fn_model = os.path.join(dir_data, "tiny-s{}.model".format(seed))
+	if os.path.isdir(fn_model):
+		return fn_model
+	try:
+		import tensorflow as tf
+	except ImportError:
+		return None
+	tf.random.set_seed(seed)
+	model = tf.keras.Sequential( [
+		tf.keras.layers.InputLayer( input_shape=(224, 224, 3) ),
+		tf.keras.layers.Conv2D(8, 3, strides=4, activation="relu"),
+		tf.keras.layers.GlobalAveragePooling2D(),
+		tf.keras.layers.Dense(2, activation="softmax", name="output"),
+		] )
+	model.save(fn_model, save_format="tf")
+	with open(fn_model + ".labels", 'w') as f:
+		f.write( "N\nY" )
+	return fn_model
+
+
+#####################################################################################################
+# Runs
+
+def count_files(path):
+	n = 0
+	for root, dirs, files in os.walk(path):
+		n += len( [ fn for fn in files if fn.endswith('.jpg') ] )
+	return n
+
+
+def count_lines(fn):
+	with open(fn) as f:
+		return sum( 1 for line in f if len(line.strip()) > 0 )
+
+
+# Command, input files and tile counter of each tool on one slide.
+
+def tool_run(tool, data, dir_out, fn_model, fn_tiles):
+	def script(name):
+		return [ sys.executable, os.path.join(tool_dir, name) ]
+	if tool == 'imgsplit':
+		return script('imgsplit.py') + [ data['src'], dir_out ], [ data['src'] ], lambda: count_files(dir_out)
+	if tool == 'imgsplitbymask':
+		return script('imgsplitbymask.py') + [ data['src'], data['gndt'][0], dir_out ], [ data['src'], data['gndt'][0] ], lambda: count_files(dir_out)
+	if tool == 'imgextrmask':
+		return script('imgextrmask.py') + [ data['src'], data['gndt'][0], os.path.join(dir_out, "mask.png") ], [ data['src'], data['gndt'][0] ], None
+	if tool == 'imgconcord':
+		return script('imgconcord.py') + [ data['src'], data['gndt'][0], data['pred'] ], [ data['src'], data['gndt'][0], data['pred'] ], None
+	if tool == 'imgconcord-bbox':
+		return script('imgconcord.py') + [ data['src'], data['gndt'][0], data['pred'], data['boxes'] ], [ data['src'], data['gndt'][0], data['pred'] ], lambda: count_lines(data['boxes'])
+	if tool == 'imgkappa':
+		return script('imgkappa.py') + [ data['src'] ] + data['gndt'], [ data['src'] ] + data['gndt'], None
+	if tool == 'predict':
+		return script('tf/MobileNetV2.py') + [ 'predict', fn_model, 'index:' + fn_tiles ], [], lambda: count_lines(fn_tiles)
+	raise ValueError("unknown tool " + tool)
+
+
+# Runs a command and writes its wall time and the peak RSS of its process,
+# in KB, to the file given first. Linux carries the peak RSS of a process over fork and exec, so
+# a tool started straight from the benchmark would report the peak of the
+# benchmark itself (e.g. after rendering a slide); the wrapper is small when
+# it forks the tool.
+
+RSS_WRAPPER = """
+import sys, time, resource, subprocess
+t0 = time.time()
+code = subprocess.call(sys.argv[2:])
+wall = time.time() - t0
+with open(sys.argv[1], 'w') as f:
+	f.write( "{} {}".format( wall, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss ) )
+sys.exit( code if code >= 0 else 128 - code )
+"""
+
+
+# Runs cmd once and returns its wall time, peak RSS in MB and exit code. The
+# ground truth mask cache is emptied before every run, so the runs are cold.
+
+def run_once(cmd, dir_out, fn_log):
+	if os.path.isdir(dir_out):
+		shutil.rmtree(dir_out)
+	os.makedirs(dir_out)
+	env = dict( os.environ, IMGMASK_CACHE=os.path.join(dir_out, "imgmask-cache"), TF_CPP_MIN_LOG_LEVEL='2' )
+	fn_rss = fn_log + ".rss"
+	with open(fn_log, 'w') as log:
+		code = subprocess.call( [ sys.executable, '-c', RSS_WRAPPER, fn_rss ] + cmd, stdout=subprocess.DEVNULL, stderr=log, env=env, cwd=dir_out )
+	with open(fn_rss) as f:
+		wall, rss = f.read().split()
+	os.remove(fn_rss)
+	return float(wall), int(rss) / 1024, code
+
+
+def run_benchmark(tool, size, data, dir_work, fn_model, fn_tiles, repeat):
+	result = { 'tool': tool, 'size': size }
+	if tool == 'predict' and fn_model is None:
+		result['status'] = "skipped: tensorflow is not installed"
+		return result
+	dir_out = os.path.join(dir_work, "out")
+	fn_log = os.path.join(dir_work, "{}-{}.log".format(tool, size))
+	cmd, inputs, count_tiles = tool_run(tool, data, dir_out, fn_model, fn_tiles)
+	if tool == 'predict':
+		inputs = [ l.strip() for l in open(fn_tiles) if len(l.strip()) > 0 ]
+
+	walls = []
+	peak_rss = 0.0
+	for i in range(repeat):
+		wall, rss, code = run_once(cmd, dir_out, fn_log)
+		if code != 0:
+			result['status'] = "failed with exit code {}, see {}".format(code, fn_log)
+			return result
+		walls.append(wall)
+		peak_rss = max(peak_rss, rss)
+	tiles = count_tiles() if count_tiles is not None else None
+	shutil.rmtree(dir_out)
+
+	wall = float( np.median(walls) )
+	n_bytes = sum( os.path.getsize(fn) for fn in inputs )
+	result.update( {
+		'status': "ok",
+		'wall_s': wall,
+		'wall_s_runs': walls,
+		'tiles': tiles,
+		'tiles_per_s': tiles / wall if tiles is not None else None,
+		'input_mb': n_bytes / 1e6,
+		'mb_per_s': n_bytes / 1e6 / wall,
+		'peak_rss_mb': peak_rss,
+		} )
+	return result
+
+
+# Adds the relative change of wall time and peak RSS against the baseline run
+# of the same tool and size; a change above threshold is a regression.
+
+def compare_baseline(results, baseline, threshold):
+	base = { ( r['tool'], r['size'] ): r for r in baseline['results'] if r['status'] == "ok" }
+	n_regressions = 0
+	for r in results:
+		b = base.get( ( r['tool'], r['size'] ) )
+		if r['status'] != "ok" or b is None:
+			continue
+		r['baseline_wall_s'] = b['wall_s']
+		r['wall_change'] = r['wall_s'] / b['wall_s'] - 1
+		r['rss_change'] = r['peak_rss_mb'] / b['peak_rss_mb'] - 1
+		r['regression'] = r['wall_change'] > threshold or r['rss_change'] > threshold
+		n_regressions += r['regression']
+	return n_regressions
+
+
+def format_value(value, fmt="{:.3f}"):
+	return fmt.format(value) if value is not None else "NA"
+
+
+def print_results(results):
+	print( "\t".join( [ "tool", "size", "wall_s", "tiles_per_s", "mb_per_s", "peak_rss_mb", "wall_change", "rss_change", "status" ] ) )
+	for r in results:
+		status = r['status']
+		if r.get('regression'):
+			status = "REGRESSION"
+		print( "\t".join( [ r['tool'], r['size'], format_value(r.get('wall_s')), format_value(r.get('tiles_per_s'), "{:.1f}"), format_value(r.get('mb_per_s'), "{:.1f}"),
+			format_value(r.get('peak_rss_mb'), "{:.0f}"), format_value(r.get('wall_change'), "{:+.1%}"), format_value(r.get('rss_change'), "{:+.1%}"), status ] ) )
+
+
+#####################################################################################################
+
+sizes = "2048,8192"
+dir_work = "/tmp/imgbench"
+fn_output = None
+fn_baseline = None
+threshold = 0.10
+repeat = 3
+n_predict_tiles = 256
+tools = TOOLS
+seed = 0
+
+argv = [ sys.argv[0] ]
+i = 1
+while i < len(sys.argv):
+	if sys.argv[i] in ( '-s', '--sizes' ) and i + 1 < len(sys.argv):
+		sizes = sys.argv[i + 1]
+		i += 1
+	elif sys.argv[i] in ( '-d', '--workdir' ) and i + 1 < len(sys.argv):
+		dir_work = sys.argv[i + 1]
+		i += 1
+	elif sys.argv[i] in ( '-o', '--output' ) and i + 1 < len(sys.argv):
+		fn_output = sys.argv[i + 1]
+		i += 1
+	elif sys.argv[i] in ( '-b', '--baseline' ) and i + 1 < len(sys.argv):
+		fn_baseline = sys.argv[i + 1]
+		i += 1
+	elif sys.argv[i] in ( '-t', '--threshold' ) and i + 1 < len(sys.argv):
+		threshold = float(sys.argv[i + 1])
+		i += 1
+	elif sys.argv[i] in ( '-r', '--repeat' ) and i + 1 < len(sys.argv):
+		repeat = int(sys.argv[i + 1])
+		i += 1
+	elif sys.argv[i] in ( '-n', '--predict-tiles' ) and i + 1 < len(sys.argv):
+		n_predict_tiles = int(sys.argv[i + 1])
+		i += 1
+	elif sys.argv[i] in ( '-T', '--tools' ) and i + 1 < len(sys.argv):
+		tools = [ t for t in sys.argv[i + 1].split(',') if len(t) > 0 ]
+		i += 1
+	elif sys.argv[i] == '--seed' and i + 1 < len(sys.argv):
+		seed = int(sys.argv[i + 1])
+		i += 1
+	else:
+		argv.append(sys.argv[i])
+	i += 1
+
+if len(argv) > 1 or any( t not in TOOLS for t in tools ):
+    sys.stderr.write("FATAL: Invalid arguments\n\n")
+    sys.stderr.write("Usage: imgbench.py [-s WxH,WxH,...] [-d WorkDir] [-o Results.json] [-b Baseline.json] [-t Threshold|0.10] [-r Repeat|3] [-n PredictTiles|256] [-T Tool,Tool,...] [--seed N]\n")
+    sys.stderr.write("Tools: " + ",".join(TOOLS) + "\n\n")
+    sys.exit(1)
+
+dir_work = os.path.abspath(dir_work)
+dir_data = os.path.join(dir_work, "data")
+fn_model = make_tiny_model(dir_data, seed) if 'predict' in tools else None
+
+results = []
+for size in [ s for s in sizes.split(',') if len(s) > 0 ]:
+	cols, rows = parse_tile_dim(size)
+	size = "{}x{}".format(cols, rows)
+	data = make_slide(dir_data, rows, cols, seed)
+	fn_tiles = make_predict_tiles(data, dir_data, n_predict_tiles) if 'predict' in tools else None
+	for tool in tools:
+		eprint("Running {} on {}".format(tool, size))
+		results.append( run_benchmark(tool, size, data, dir_work, fn_model, fn_tiles, repeat) )
+
+n_regressions = 0
+baseline = None
+if fn_baseline is not None:
+	with open(fn_baseline) as f:
+		baseline = json.load(f)
+	n_regressions = compare_baseline(results, baseline, threshold)
+
+print_results(results)
+
+if fn_output is not None:
+	with open(fn_output, 'w') as f:
+		json.dump( {
+			'host': socket.gethostname(),
+			'platform': platform.platform(),
+			'python': platform.python_version(),
+			'cpus': os.cpu_count(),
+			'pyvips': pyvips is not None,
+			'date': time.strftime("%Y-%m-%dT%H:%M:%S"),
+			'seed': seed,
+			'repeat': repeat,
+			'threshold': threshold,
+			'baseline': fn_baseline,
+			'results': results,
+			}, f, indent=1 )
+
+if n_regressions > 0:
+	eprint("{} regression(s) of more than {:.0%} against {}".format(n_regressions, threshold, fn_baseline))
+	sys.exit(2)
@@ -1,56 +1,27 @@
 #!/usr/bin/python3
 from __future__ import print_function
 
+import os
 import time
 import sys
+import multiprocessing as mp
 import cv2
+import numpy as np
+
+import imgtrace
+from imgmask import get_ground_truth_mask, integral_mask, count_nonzero_boxes
+from imgraster import load_tile_scores, tile_arrays, TileRaster
+from imgstats import confusion_counts
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
-def get_ground_truth_mask(fn_src1, fn_src2):
-    src1 = cv2.imread(fn_src1, -1) 
-    src2 = cv2.imread(fn_src2, -1)
-    diff = cv2.subtract(src1, src2)
+def format_stat(value):
+    return str('%.5g' % value) if ( str(value) != 'NA') else 'NA'
 
-    (B1, G1, R1) = cv2.split(src1)
-    (B2, G2, R2) = cv2.split(src2)
 
-    diffB1 = cv2.subtract(B1, B2)
-    diffG1 = cv2.subtract(G1, G2)
-    diffR1 = cv2.subtract(R1, R2)
-    diffB2 = cv2.subtract(B2, B1)
-    diffG2 = cv2.subtract(G2, G1)
-    diffR2 = cv2.subtract(R2, R1)
-    
-    ret, diffB1 = cv2.threshold(diffB1, 64, 255, cv2.THRESH_BINARY)  
-    ret, diffG1 = cv2.threshold(diffG1, 64, 255, cv2.THRESH_BINARY)  
-    ret, diffR1 = cv2.threshold(diffR1, 64, 255, cv2.THRESH_BINARY)  
-    ret, diffB2 = cv2.threshold(diffB2, 64, 255, cv2.THRESH_BINARY)  
-    ret, diffG2 = cv2.threshold(diffG2, 64, 255, cv2.THRESH_BINARY)  
-    ret, diffR2 = cv2.threshold(diffR2, 64, 255, cv2.THRESH_BINARY)  
-    
-    diff2 = diffB1
-    diff2 = cv2.bitwise_or(diff2, diffG1)
-    diff2 = cv2.bitwise_or(diff2, diffR1)
-    diff2 = cv2.bitwise_or(diff2, diffB2)
-    diff2 = cv2.bitwise_or(diff2, diffG2)
-    diff2 = cv2.bitwise_or(diff2, diffR2)
-    
-    ret, diff = cv2.threshold(diff2, 64, 255, cv2.THRESH_BINARY)  
-    return diff
-
-
-def calculate_two_class_stats(arg_mask_gndt, arg_mask_pred):
-    dimensions = mask_gndt.shape
-    dimensions_pred = mask_pred.shape
-    
-    n_tp = cv2.countNonZero( cv2.bitwise_and(arg_mask_gndt, arg_mask_pred) )
-    n_fn = cv2.countNonZero( cv2.subtract(arg_mask_gndt, arg_mask_pred) )
-    n_fp = cv2.countNonZero( cv2.subtract(arg_mask_pred, arg_mask_gndt) )
-    n_tn = cv2.countNonZero( cv2.bitwise_not( cv2.bitwise_or(arg_mask_gndt, arg_mask_pred)) )
-    
+def two_class_stats(n_tp, n_fn, n_fp, n_tn):
     pixels = (n_tp + n_tn + n_fp + n_fn)
     sens = n_tp / (n_tp + n_fn) if  (n_tp + n_fn) > 0  else 'NA' 
     spec = n_tn / (n_tn + n_fp) if  (n_tn + n_fp) > 0  else 'NA' 
@@ -62,63 +33,272 @@ def calculate_two_class_stats(arg_mask_gndt, arg_mask_pred):
 
     acc  = (n_tp + n_tn) / pixels
     
+    return [ 
+        ( "pixels",  str(pixels) ),
+        ( "tp",      str(n_tp) ),
+        ( "fn",      str(n_fn) ),
+        ( "fp",      str(n_fp) ),
+        ( "tn",      str(n_tn) ),
+        ( "sens",    format_stat(sens) ),
+        ( "spec",    format_stat(spec) ),
+        ( "ppv",     format_stat(ppv) ),
+        ( "npv",     format_stat(npv) ),
+        ( "f1",      format_stat(f1) ),
+        ( "jaccard", format_stat(jaccard) ),
+        ( "acc",     format_stat(acc) ),
+        ]
+
+
+# Pixels above 127 are positive in both masks, as after cv2.threshold.
+
+def calculate_two_class_stats(arg_mask_gndt, arg_mask_pred):
+    dimensions = arg_mask_gndt.shape
+    
+    n_tp, n_fn, n_fp, n_tn = confusion_counts(arg_mask_gndt, arg_mask_pred, thres=127)
+    
     print( "\t".join( [ "width",   str(dimensions[0]) ] ) )
     print( "\t".join( [ "height",  str(dimensions[1]) ] ) )
-    print( "\t".join( [ "pixels",  str(pixels) ] ) )
-    print( "\t".join( [ "tp",      str(n_tp) ] ) )
-    print( "\t".join( [ "fn",      str(n_fn) ] ) )
-    print( "\t".join( [ "fp",      str(n_fp) ] ) )
-    print( "\t".join( [ "tn",      str(n_tn) ] ) )
-    print( "\t".join( [ "sens",    str('%.5g' % sens)    if ( str(sens) != 'NA') else 'NA'] ) )
-    print( "\t".join( [ "spec",    str('%.5g' % spec)    if ( str(spec) != 'NA') else 'NA'] ) )
-    print( "\t".join( [ "ppv",     str('%.5g' % ppv)     if ( str(ppv) != 'NA') else 'NA' ] ) )
-    print( "\t".join( [ "npv",     str('%.5g' % npv)     if ( str(npv) != 'NA') else 'NA' ] ) )
-    print( "\t".join( [ "f1",      str('%.5g' % f1)      if ( str(f1)  != 'NA') else 'NA' ] ) )
-    print( "\t".join( [ "jaccard", str('%.5g' % jaccard) if ( str(jaccard) != 'NA') else 'NA' ] ) )
-    print( "\t".join( [ "acc",     str('%.5g' % acc)     if ( str(acc) != 'NA') else 'NA'] ) )
+    for name, value in two_class_stats(n_tp, n_fn, n_fp, n_tn):
+        print( "\t".join( [ name, value ] ) )
+
+
+# Marks every box whose ground truth occupancy reaches crit as fully positive.
+# The occupancy of all boxes is looked up at once in the summed-area table.
+
+def expand_mask_by_boxes(arg_mask_gndt, boxes, crit):
+    mask_gndt2 = arg_mask_gndt.copy()
+    if len(boxes) == 0:
+        return mask_gndt2
+    y0, x0, y1, x1 = np.array(boxes, dtype=np.int64).T
+    nz = count_nonzero_boxes( integral_mask(arg_mask_gndt), y0, x0, y1, x1 )
+    size = (x1-x0) * (y1-y0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pnz = nz / size
+    for i in np.flatnonzero( pnz >= crit ):
+        mask_gndt2[ max(y0[i], 0):y1[i]+1, max(x0[i], 0):x1[i]+1 ] = 255
+    return mask_gndt2
+
+
+#####################################################################################################
+# Threshold sweep. Reproduces imgtistats.pl, which for each quantile of the
+# tile scores drew a predicted mask with imgprob.pl and ran this script on it,
+# but rasterises the tile scores and decodes the images only once.
+
+def perl_str(value):
+    return '%.15g' % value
+
+
+def perl_quantile(q, values):
+    a = sorted(values)
+    n = len(a)
+    if n <= 0:
+        return None
+    k2 = int( (q * n * 2) + 0.5 )
+    k = int( k2 / 2 )
+    a += [ a[-1], a[-1] ]
+    return a[k] if (k2 % 2) else (a[k] + a[k+1]) / 2
+
+
+def calc_auc(curve):
+    auc = 0.0
+    for i in range(2, len(curve) - 1, 2):
+        auc += ( curve[i+1] + curve[i-1] ) * ( curve[i] - curve[i-2] ) / 2.00
+    return auc
+
+
+def sweep_thresholds(fn_image_src, fn_image_gndt, fn_score, crit, ndiv):
+    imgtrace.set_context(slide=fn_image_src)
+    with imgtrace.stage('scores') as rec:
+        tile_probs, scores = load_tile_scores(fn_score, fn_image_src)
+        rec['count'] = len(tile_probs)
+    if len(tile_probs) == 0:
+        eprint("imgconcord.py: no tiles of " + fn_image_src + " in " + fn_score)
+        sys.exit(1)
 
+    quantiles = list( range(ndiv - 1, 0, -1) )
+    thresholds = [ perl_quantile(t / ndiv, scores) for t in quantiles ]
 
+    mask_gndt = get_ground_truth_mask(fn_image_src, fn_image_gndt)
+    with imgtrace.stage('mask', kind='bbox', count=len(tile_probs)):
+        mask_gndt2 = expand_mask_by_boxes(mask_gndt, sorted(tile_probs), crit)
+    dimensions = mask_gndt2.shape
+
+    fields = [ "q", "thres", "crit", "width", "height", "pixels", "tp", "fn", "fp", "tn", "sens", "spec", "ppv", "npv", "f1", "jaccard", "acc", "eauc" ]
+    print( "\t".join(fields) )
+
+    roc_curve = [0, 0]
+    prc_curve = [0, 1]
+    npos = None
+    ntot = None
+    # The highest tile probability covering a pixel decides it, as in the
+    # overlays of imgprob.pl.
+    with imgtrace.stage('stats', count=len(thresholds)):
+        boxes, probs = tile_arrays(tile_probs)
+        raster = TileRaster(boxes, probs, mask_gndt2.shape, 'max')
+        sweep = raster.confusion_counts(integral_mask(mask_gndt2), thresholds)
+
+    for quantile, thres, count in zip( quantiles, thresholds, sweep ):
+        row = dict( two_class_stats(*count) )
+        row.update( { "q": str(quantile), "thres": perl_str(thres), "crit": str(crit), "width": str(dimensions[0]), "height": str(dimensions[1]) } )
+        n_tp, n_fn, n_fp, n_tn = count
+        if npos is None:
+            npos = n_tp + n_fn
+            ntot = n_tp + n_fp + n_fn + n_tn
+        if row["sens"] == 'NA' or row["spec"] == 'NA':
+            row["eauc"] = 'NA'
+        else:
+            row["eauc"] = perl_str( ( float(row["sens"]) + float(row["spec"]) ) / 2 )
+            roc_curve += [ 1 - float(row["spec"]), float(row["sens"]) ]
+        if row["ppv"] != 'NA' and row["sens"] != 'NA':
+            prc_curve += [ float(row["sens"]), float(row["ppv"]) ]
+        print( "\t".join( [ row[f] for f in fields ] ) )
+
+    roc_curve += [1, 1]
+    prc_curve += [1, 0]
+    prc_curve.reverse()
+
+    auprc = calc_auc(prc_curve)
+    print( "\t".join( [ "AUROC", perl_str( calc_auc(roc_curve) ) ] ) )
+    print( "\t".join( [ "AUPRC", perl_str( auprc ) ] ) )
+    print( "\t".join( [ "nAUPRC", perl_str( auprc / ( npos / (ntot + npos) ) ) if npos > 0 else 'NA' ] ) )
+
+
+#####################################################################################################
+# Cohort mode: one manifest row per slide (source image, labelled ground truth,
+# predicted mask and optionally a bounding box list, tab-separated). Slides
+# are processed in a pool of worker processes that only send back the four
+# counts of each slide. The totals are micro-averaged (the statistics of the
+# summed counts, i.e. pooling all pixels) and macro-averaged (the mean of the
+# statistics of the slides, skipping NA).
+
+BATCH_STATS = [ "sens", "spec", "ppv", "npv", "f1", "jaccard", "acc" ]
+
+
+def read_manifest(fn_manifest):
+    rows = []
+    with open(fn_manifest) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if len(line.strip()) == 0 or line.startswith('#'):
+                continue
+            rows.append( [ v for v in line.split("\t") if len(v) > 0 ] )
+    return rows
+
+
+def read_boxes(fn_bbox):
+    with open(fn_bbox) as f:
+        return [ [ int(i) for i in line.split(maxsplit=4) ] for line in f.readlines() ]
+
+
+def process_slide(args):
+    row, crit = args
+    fn_source = row[0]
+    imgtrace.set_context(slide=fn_source)
+    try:
+        mask_gndt = get_ground_truth_mask(fn_source, row[1])
+        with imgtrace.stage('decode'):
+            mask_pred = cv2.imread(row[2], -1)
+        if mask_pred is None:
+            raise IOError("cannot read image " + row[2])
+        if len(row) >= 4:
+            boxes = read_boxes(row[3])
+            with imgtrace.stage('mask', kind='bbox', count=len(boxes)):
+                mask_gndt = expand_mask_by_boxes(mask_gndt, boxes, crit)
+        else:
+            crit = 1
+        with imgtrace.stage('stats'):
+            return fn_source, crit, mask_gndt.shape, confusion_counts(mask_gndt, mask_pred, thres=127)
+    except Exception as e:
+        eprint("imgconcord.py: " + fn_source + ": " + str(e))
+        return fn_source, crit, None, None
+
+
+def macro_average(rows):
+    means = []
+    for name in BATCH_STATS:
+        values = [ float(row[name]) for row in rows if row[name] != 'NA' ]
+        means.append( format_stat( sum(values) / len(values) ) if len(values) > 0 else 'NA' )
+    return means
+
+
+def run_manifest(fn_manifest, n_workers, crit):
+    rows = [ row for row in read_manifest(fn_manifest) if len(row) >= 3 ]
+    fields = [ "pixels", "tp", "fn", "fp", "tn" ] + BATCH_STATS
+    print( "Srcfile", "crit", "width", "height", *fields, sep="\t" )
+
+    totals = [ 0, 0, 0, 0 ]
+    slide_stats = []
+    with mp.get_context('fork').Pool(n_workers, initializer=cv2.setNumThreads, initargs=(1,)) as pool:
+        for fn_source, slide_crit, dimensions, counts in pool.imap(process_slide, [ (row, crit) for row in rows ]):
+            if counts is None:
+                print( fn_source, slide_crit, *( [ 'NA' ] * ( len(fields) + 2 ) ), sep="\t" )
+                continue
+            row = dict( two_class_stats(*counts) )
+            print( fn_source, slide_crit, dimensions[0], dimensions[1], *[ row[f] for f in fields ], sep="\t" )
+            sys.stdout.flush()
+            totals = [ t + n for t, n in zip(totals, counts) ]
+            slide_stats.append(row)
+
+    if len(slide_stats) == 0:
+        eprint("imgconcord.py: no slide of " + fn_manifest + " could be evaluated")
+        sys.exit(1)
+    row = dict( two_class_stats(*totals) )
+    print( "MICRO", crit, 'NA', 'NA', *[ row[f] for f in fields ], sep="\t" )
+    print( "MACRO", crit, 'NA', 'NA', *( [ 'NA' ] * 5 ), *macro_average(slide_stats), sep="\t" )
+    eprint( "imgconcord.py: {} of {} slides evaluated".format( len(slide_stats), len(rows) ) )
+
+
+sys.argv = imgtrace.parse_argv(sys.argv)
+
+if len(sys.argv)>=5 and sys.argv[1] == '--sweep':
+    crit = float(sys.argv[5]) if len(sys.argv)>=6 else 0.8
+    ndiv = int(sys.argv[6]) if len(sys.argv)>=7 else 10
+    sweep_thresholds(sys.argv[2], sys.argv[3], sys.argv[4], crit, ndiv)
+    sys.exit(0)
+
+if len(sys.argv)>=3 and sys.argv[1] == '--manifest':
+    n_workers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+    crit = float(sys.argv[4]) if len(sys.argv) > 4 else 0.95
+    run_manifest(sys.argv[2], n_workers, crit)
+    sys.exit(0)
 
 if len(sys.argv)<3:
     sys.stderr.write("FATAL: Insufficient arguments\n\n")
-    sys.stderr.write("Usage: imgconcord.py SourceImage SourceImageLabelledGroundTruth PredictedMask [BoundingBoxList] [Crit|0.95]\n\n")
+    sys.stderr.write("Usage: imgconcord.py [--trace File] SourceImage SourceImageLabelledGroundTruth PredictedMask [BoundingBoxList] [Crit|0.95]\n")
+    sys.stderr.write("       imgconcord.py --sweep SourceImage SourceImageLabelledGroundTruth ScoreFile [Crit|0.8] [NDiv|10]\n")
+    sys.stderr.write("       imgconcord.py [--trace File] --manifest Manifest.tsv [NWorkers] [Crit|0.95]\n\n")
     sys.exit(1)
 
 
 fn_image_src  = sys.argv[1]
 fn_image_gndt = sys.argv[2]
 
-mask_gndt_int = get_ground_truth_mask(fn_image_src, fn_image_gndt)
-ret, mask_gndt = cv2.threshold(mask_gndt_int, 127, 255, cv2.THRESH_BINARY)
+imgtrace.set_context(slide=fn_image_src)
+
+mask_gndt = get_ground_truth_mask(fn_image_src, fn_image_gndt)
 
-mask_pred = cv2.imread(sys.argv[3], -1)
-ret, mask_pred = cv2.threshold(mask_pred, 127, 255, cv2.THRESH_BINARY)
+with imgtrace.stage('decode'):
+    mask_pred = cv2.imread(sys.argv[3], -1)
 
 
 crit = 0.95
 
-if len(sys.argv)>=5:
+if len(sys.argv)>=6:
     crit=float(sys.argv[5])
 
 if len(sys.argv)<=4:
     print( "\t".join( [ "crit", str(1) ] ) )
-    calculate_two_class_stats(mask_gndt, mask_pred)
+    with imgtrace.stage('stats'):
+        calculate_two_class_stats(mask_gndt, mask_pred)
     sys.exit(0)
 
-mask_gndt2 = mask_gndt_int.copy()
+boxes = read_boxes(sys.argv[4])
 
-with open(sys.argv[4]) as f:
-    lines = f.readlines()
-    for line in lines:
-        y0,x0,y1,x1 = [ int(i) for i in line.split(maxsplit=4) ]
-        cropped_image = mask_gndt[ y0:y1, x0:x1 ]
-        nz = cv2.countNonZero(cropped_image);
-        size = (x1-x0) * (y1-y0)
-        pnz = nz / size
-        if pnz >= crit:
-            cv2.rectangle(mask_gndt2, (x0, y0), (x1, y1), (255, 255, 255), -1)
+with imgtrace.stage('mask', kind='bbox', count=len(boxes)):
+    mask_gndt2 = expand_mask_by_boxes(mask_gndt, boxes, crit)
 
 
 print( "\t".join( [ "crit", str(crit) ] ) )
 
-calculate_two_class_stats(mask_gndt2, mask_pred)
+with imgtrace.stage('stats'):
+    calculate_two_class_stats(mask_gndt2, mask_pred)
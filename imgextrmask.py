@@ -5,38 +5,7 @@ import time
 import sys
 import cv2
 
-
-def get_ground_truth_mask(fn_src1, fn_src2):
-    src1 = cv2.imread(fn_src1, -1) 
-    src2 = cv2.imread(fn_src2, -1)
-    diff = cv2.subtract(src1, src2)
-
-    (B1, G1, R1) = cv2.split(src1)
-    (B2, G2, R2) = cv2.split(src2)
-
-    diffB1 = cv2.subtract(B1, B2)
-    diffG1 = cv2.subtract(G1, G2)
-    diffR1 = cv2.subtract(R1, R2)
-    diffB2 = cv2.subtract(B2, B1)
-    diffG2 = cv2.subtract(G2, G1)
-    diffR2 = cv2.subtract(R2, R1)
-    
-    ret, diffB1 = cv2.threshold(diffB1, 64, 255, cv2.THRESH_BINARY)  
-    ret, diffG1 = cv2.threshold(diffG1, 64, 255, cv2.THRESH_BINARY)  
-    ret, diffR1 = cv2.threshold(diffR1, 64, 255, cv2.THRESH_BINARY)  
-    ret, diffB2 = cv2.threshold(diffB2, 64, 255, cv2.THRESH_BINARY)  
-    ret, diffG2 = cv2.threshold(diffG2, 64, 255, cv2.THRESH_BINARY)  
-    ret, diffR2 = cv2.threshold(diffR2, 64, 255, cv2.THRESH_BINARY)  
-    
-    diff2 = diffB1
-    diff2 = cv2.bitwise_or(diff2, diffG1)
-    diff2 = cv2.bitwise_or(diff2, diffR1)
-    diff2 = cv2.bitwise_or(diff2, diffB2)
-    diff2 = cv2.bitwise_or(diff2, diffG2)
-    diff2 = cv2.bitwise_or(diff2, diffR2)
-    
-    ret, diff = cv2.threshold(diff2, 64, 255, cv2.THRESH_BINARY)  
-    return diff
+from imgmask import get_ground_truth_mask
 
 
 def calculate_two_class_stats(arg_mask_gndt, arg_mask_pred):
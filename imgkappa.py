@@ -2,62 +2,22 @@
 from __future__ import print_function
 
 from PIL import Image
+import os
 import time
 import sys
+import itertools
+import multiprocessing as mp
 import cv2
 import numpy as np
-from sklearn.metrics import cohen_kappa_score
-from statsmodels.stats import inter_rater as irr
-
-
-def get_ground_truth_mask(fn_src1, fn_src2):
-    src1 = cv2.imread(fn_src1, -1) 
-    src2 = cv2.imread(fn_src2, -1)
-    diff = cv2.subtract(src1, src2)
-
-    (B1, G1, R1) = cv2.split(src1)
-    (B2, G2, R2) = cv2.split(src2)
-
-    diffB1 = cv2.subtract(B1, B2)
-    diffG1 = cv2.subtract(G1, G2)
-    diffR1 = cv2.subtract(R1, R2)
-    diffB2 = cv2.subtract(B2, B1)
-    diffG2 = cv2.subtract(G2, G1)
-    diffR2 = cv2.subtract(R2, R1)
-    
-    ret, diffB1 = cv2.threshold(diffB1, 64, 255, cv2.THRESH_BINARY)  
-    ret, diffG1 = cv2.threshold(diffG1, 64, 255, cv2.THRESH_BINARY)  
-    ret, diffR1 = cv2.threshold(diffR1, 64, 255, cv2.THRESH_BINARY)  
-    ret, diffB2 = cv2.threshold(diffB2, 64, 255, cv2.THRESH_BINARY)  
-    ret, diffG2 = cv2.threshold(diffG2, 64, 255, cv2.THRESH_BINARY)  
-    ret, diffR2 = cv2.threshold(diffR2, 64, 255, cv2.THRESH_BINARY)  
-    
-    diff2 = diffB1
-    diff2 = cv2.bitwise_or(diff2, diffG1)
-    diff2 = cv2.bitwise_or(diff2, diffR1)
-    diff2 = cv2.bitwise_or(diff2, diffB2)
-    diff2 = cv2.bitwise_or(diff2, diffG2)
-    diff2 = cv2.bitwise_or(diff2, diffR2)
-    
-    ret, diff = cv2.threshold(diff2, 64, 255, cv2.THRESH_BINARY)  
-    return diff
-
-
-def calculate_pixel_fleiss_kappa(image1, image2, image3):
-    # Flatten images to 1D arrays
-    img1_flat = image1.flatten()
-    img2_flat = image2.flatten()
-    img3_flat = image3.flatten()
-
-    combined = np.column_stack((img1_flat, img2_flat, img3_flat))
-
-    aggregated, cats = irr.aggregate_raters(combined )
-    # print (aggregated)
-    # print (cats)
-    
-    kappa = irr.fleiss_kappa(aggregated, method='fleiss')
-
-    return kappa
+
+import imgtrace
+from imgmask import get_ground_truth_mask, integral_mask, count_nonzero_boxes
+from imgstats import CHUNK_PIXELS, vote_code_counts, merge_code_counts, cohen_kappa_from_counts, fleiss_kappa_from_counts
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
 
 def scale_mask(img):
 	scale_percent = 1/50*100 # percent of original size
@@ -69,81 +29,144 @@ def scale_mask(img):
 	return diff
 
 
+# Marks each incr x incr block whose occupancy reaches crit. The occupancy of
+# all blocks is looked up at once in the summed-area table of img.
+
 def mk_saliance_map(img, incr=20, crit=0.1):
 	height = img.shape[0]
 	width = img.shape[1]
-	# retval = img
+	y0, x0 = np.meshgrid( np.arange(0, height, incr), np.arange(0, width, incr), indexing='ij' )
+	nz = count_nonzero_boxes( integral_mask(img), y0, x0, y0 + incr-1, x0 + incr-1 )
+	size = (incr-1) * (incr-1)
+	salient = ( nz / size ) >= crit
+	salient = np.repeat( np.repeat(salient, incr, axis=0), incr, axis=1 )[ :height, :width ]
 	retval = np.zeros((height, width, 3), dtype = np.uint8)
-	
-	for x0 in range(0, width, int(incr / 1) ):
-		x1 = x0 + incr-1
-		for y0 in range(0, height, int(incr / 1) ):
-			y1 = y0 + incr-1
-			cropped_image = img[ y0:y1, x0:x1 ]
-			nz = cv2.countNonZero(cropped_image);
-			size = (x1-x0) * (y1-y0)
-			pnz = nz / size
-			if pnz >= crit:
-				cv2.rectangle(retval, (x0, y0), (x1, y1), (255, 255, 255), -1)
+	retval[salient] = 255
 	return retval
 
 
-def transform_and_flatten_image(fn_img, tmp_fn_pre="/tmp/immoda.png", tmp_fn_post="/tmp/immodb.png"):
-	img = get_ground_truth_mask(fn_source, fn_img)
-	cv2.imwrite(tmp_fn_pre, img)
-	img = mk_saliance_map(img, 50, 0.05) 
-	cv2.imwrite(tmp_fn_post, img)
-	img_flat = scale_mask(img).flatten()
-	return img_flat 
+# Packs a mask into flat bits as np.packbits(mask.ravel() > 0) does, a band of
+# rows at a time; bands of a multiple of 8 rows pack to whole bytes.
 
+def pack_votes(img):
+	rows = max( 8, CHUNK_PIXELS // max(img.shape[1], 1) // 8 * 8 )
+	return np.concatenate( [ np.packbits( img[r:r + rows].ravel() > 0 ) for r in range(0, img.shape[0], rows) ] )
 
-if len(sys.argv)<3:
+
+# Returns the rater's votes as flat packed bits and the number of pixels. By
+# default the votes are those of the saliency map of 50x50 blocks, downscaled
+# 50x as before. With full_resolution, every pixel of the ground truth mask
+# votes, without the saliency map. The intermediate masks stay in memory, so
+# any number of copies can run at once.
+
+def transform_and_flatten_image(fn_source, fn_img, full_resolution=False):
+	img = get_ground_truth_mask(fn_source, fn_img)
+	if full_resolution:
+		return pack_votes(img), img.size
+	with imgtrace.stage('mask', kind='saliency'):
+		img = mk_saliance_map(img, 50, 0.05) 
+		img = scale_mask(img)
+		img = img[:, :, 0]
+		return np.packbits( img.ravel() > 0 ), img.size
+
+
+def rater_pairs(n_raters):
+	if n_raters == 3:
+		return [ (0, 1), (1, 2), (0, 2) ]
+	return list( itertools.combinations( range(n_raters), 2 ) )
+
+
+def calculate_kappas(code_counts, n_flats, n_raters):
+	pairs = list( itertools.combinations( range(n_raters), 2 ) )
+	if code_counts is None or n_flats < 2:
+		return [ 'NA' ] * ( 1 + len(pairs) )
+	codes, counts = code_counts
+	kappas = [ fleiss_kappa_from_counts(codes, counts, n_flats) ]
+	for i, j in pairs:
+		kappas.append( cohen_kappa_from_counts(codes, counts, i, j) if j < n_flats else 'NA' )
+	return kappas
+
+
+#####################################################################################################
+# Cohort mode: one manifest row per slide (source image followed by the images 
+# annotated by each rater, tab-separated). Slides are processed in a pool of 
+# worker processes; intermediate masks stay in memory and only the vote code
+# counts of each slide are sent back, so pooling is a sum of counts.
+
+def read_manifest(fn_manifest):
+	rows = []
+	with open(fn_manifest) as f:
+		for line in f:
+			line = line.rstrip("\n")
+			if len(line.strip()) == 0 or line.startswith('#'):
+				continue
+			rows.append( [ v for v in line.split("\t") if len(v) > 0 ] )
+	return rows
+
+
+def process_slide(args):
+	row, full_resolution = args
+	fn_source = row[0]
+	imgtrace.set_context(slide=fn_source)
+	try:
+		votes = [ transform_and_flatten_image(fn_source, fn_img, full_resolution) for fn_img in row[1:] ]
+		with imgtrace.stage('stats', count=len(votes)):
+			return fn_source, vote_code_counts( [ v for v, n in votes ], n_pixels=votes[0][1] ), len(votes)
+	except Exception as e:
+		eprint("imgkappa.py: " + fn_source + ": " + str(e))
+		return fn_source, None, 0
+
+
+def run_manifest(fn_manifest, n_workers, full_resolution):
+	rows = [ row for row in read_manifest(fn_manifest) if len(row) >= 3 ]
+	n_raters = max( [ len(row) - 1 for row in rows ] + [ 2 ] )
+	pairs = list( itertools.combinations( range(n_raters), 2 ) )
+	print( "Srcfile", "Raters", "Fleiss", *[ "Cohen{}{}".format(i+1, j+1) for i, j in pairs ], sep="\t" )
+
+	pooled = []
+	with mp.get_context('fork').Pool(n_workers, initializer=cv2.setNumThreads, initargs=(1,)) as pool:
+		for fn_source, code_counts, n_flats in pool.imap(process_slide, [ (row, full_resolution) for row in rows ]):
+			print( fn_source, n_flats if code_counts is not None else 'NA', *calculate_kappas(code_counts, n_flats, n_raters), sep="\t" )
+			sys.stdout.flush()
+			if code_counts is not None and n_flats == n_raters:
+				pooled.append( code_counts )
+
+	code_counts = merge_code_counts(pooled) if len(pooled) > 0 else None
+	print( "POOLED", len(pooled), *calculate_kappas(code_counts, n_raters, n_raters), sep="\t" )
+
+
+sys.argv = imgtrace.parse_argv(sys.argv)
+full_resolution = ( '--full' in sys.argv )
+argv = [ a for a in sys.argv if a != '--full' ]
+
+if len(argv)>=3 and argv[1] == '--manifest':
+	n_workers = int(argv[3]) if len(argv) > 3 else os.cpu_count()
+	run_manifest(argv[2], n_workers, full_resolution)
+	sys.exit(0)
+
+if len(argv)<3:
     sys.stderr.write("FATAL: Insufficient arguments\n\n")
-    sys.stderr.write("Usage: imgkappa.py SrcImage annotated_image_1 annotated_image_2 [annotated_image_3] ...\n\n")
+    sys.stderr.write("Usage: imgkappa.py [--full] [--trace File] SrcImage annotated_image_1 annotated_image_2 [annotated_image_3] ...\n")
+    sys.stderr.write("       imgkappa.py [--full] [--trace File] --manifest Manifest.tsv [NWorkers]\n\n")
     sys.exit(1)
 
-fn_source = sys.argv[1]
-fn_img1 = sys.argv[2]
-fn_img2 = sys.argv[3]
-fn_img3 = None
-if len(sys.argv) > 4:
-	fn_img3 = sys.argv[4]
+fn_source = argv[1]
+fn_imgs = argv[2:]
 
-# Flatten the images into 1D arrays
-img1_flat = transform_and_flatten_image(fn_img1, "/tmp/immod1a.png", "/tmp/immod1b.png" )
-img2_flat = transform_and_flatten_image(fn_img2, "/tmp/immod2a.png", "/tmp/immod2b.png" )
-# cv2.imwrite('/tmp/immod1a.png', img1)
-# img1 = mk_saliance_map(img1, 50, 0.1) 
-# cv2.imwrite('/tmp/immod1b.png', img1)
-# img1_flat = scale_mask(img1).flatten()
+imgtrace.set_context(slide=fn_source)
 
-# img2 = get_ground_truth_mask(fn_source, fn_img2)
-# img2_flat = scale_mask(img2).flatten()
+votes = [ transform_and_flatten_image(fn_source, fn_img, full_resolution) for fn_img in fn_imgs ]
+with imgtrace.stage('stats', count=len(votes)):
+	codes, counts = vote_code_counts( [ v for v, n in votes ], n_pixels=votes[0][1] )
 
-
-# print( fn_img1 )
-if fn_img3 is None:
+if len(fn_imgs) == 2:
 	# Calculate Cohen's kappa
-	kappa = cohen_kappa_score(img1_flat, img2_flat, labels=None)
+	kappa = cohen_kappa_from_counts(codes, counts, 0, 1)
 	print(fn_source, "Cohen's kappa", kappa, sep="\t")
 else:
-	# img3 = get_ground_truth_mask(fn_source, fn_img3);
-	# img3_flat = scale_mask(img3).flatten()
-	img3_flat = transform_and_flatten_image(fn_img3, "/tmp/immod3a.png", "/tmp/immod3b.png" )
-	
-	# print("Cohen's kappa 1-2:", cohen_kappa_score(img1_flat, img2_flat, labels=None), fn_img1, fn_img2, sep="\t")
-	# print("Cohen's kappa 2-3:", cohen_kappa_score(img2_flat, img3_flat, labels=None), fn_img2, fn_img3, sep="\t")
-	# print("Cohen's kappa 1-3:", cohen_kappa_score(img1_flat, img3_flat, labels=None), fn_img1, fn_img3, sep="\t")
-	# print("Fleiss's kappa:", calculate_pixel_fleiss_kappa(img1_flat, img2_flat, img3_flat), sep="\t")
-
-	# print("Cohen's kappa 1-2:", cohen_kappa_score(img1_flat, img2_flat, labels=None), fn_img1, fn_img2, sep="\t")
-	# print("Cohen's kappa 2-3:", cohen_kappa_score(img2_flat, img3_flat, labels=None), fn_img2, fn_img3, sep="\t")
-	# print("Cohen's kappa 1-3:", cohen_kappa_score(img1_flat, img3_flat, labels=None), fn_img1, fn_img3, sep="\t")
-	print("Srcfile", "Fleiss", "Cohen12", "Cohen23", "Cohen13");
+	pairs = rater_pairs( len(fn_imgs) )
+	print("Srcfile", "Fleiss", *[ "Cohen{}{}".format(i+1, j+1) for i, j in pairs ]);
 	print( fn_source, 
-		calculate_pixel_fleiss_kappa(img1_flat, img2_flat, img3_flat),
-		cohen_kappa_score(img1_flat, img2_flat, labels=None), 
-		cohen_kappa_score(img2_flat, img3_flat, labels=None), 
-		cohen_kappa_score(img1_flat, img3_flat, labels=None), 
+		fleiss_kappa_from_counts(codes, counts, len(fn_imgs)),
+		*[ cohen_kappa_from_counts(codes, counts, i, j) for i, j in pairs ],
 		sep="\t")
-
@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+from __future__ import print_function
+
+# Manifest of the tiles written to an output directory, so that an
+# interrupted tiling job can be rerun and only does the work that is left.
+# Outdir/.tiles-manifest is an append-only file of JSON lines, shared by
+# all the slides tiled into Outdir:
+#
+#   {"slide": "/abs/slide.tif", "size": ..., "mtime_ns": ..., "sha": ..., "tool": "imgsplit.py", "params": {...}, "run": ...}
+#   {"run": ..., "tile": "Y/0123456789abcdef-0000-0224.jpg"}
+#   {"run": ..., "done": true, "tiles": 1234, "listing": [...]}
+#
+# A run starts with the source record. Each tile is recorded after it has
+# been written, so a tile in the manifest is complete even if the job was
+# killed, and a slide is done once its done record is there. A rerun of a
+# slide with the same path, size and modification time does not hash it
+# again. With the same tiling parameters it skips the slide if it is done,
+# and otherwise the tiles already written by earlier runs. Lines cut short
+# by a crash are ignored.
+
+import os
+import json
+import time
+import threading
+
+from imgtiles import hash_file
+
+MANIFEST_NAME = ".tiles-manifest"
+
+
+# Path, size, modification time and hash of another input of the tiling,
+# e.g. the annotated image, to put in the params, so that editing it in
+# place invalidates the earlier runs.
+
+def file_identity(fn):
+	st = os.stat(fn)
+	return { 'path': os.path.abspath(fn), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha': hash_file(fn) }
+
+
+class TilingManifest:
+	def __init__(self, dir_out, fn_source, tool, params):
+		self.dir_out = dir_out
+		self.fn = os.path.join(dir_out, MANIFEST_NAME)
+		self.fn_source = os.path.abspath(fn_source)
+		st = os.stat(fn_source)
+		self.source = { 'slide': self.fn_source, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns }
+		self.tool = tool
+		self.params = json.loads( json.dumps(params) )
+		self.sha = None
+		self.done_record = None
+		self.tiles = set()
+		self.run = None
+		self.file = None
+		self.lock = threading.Lock()
+		self.load()
+
+	def same_source(self, record):
+		return all( record.get(k) == v for k, v in self.source.items() )
+
+	# Finds the hash of the source and the tiles and done record of the
+	# earlier runs with the same source and parameters. A run of the source
+	# with other parameters may have overwritten the tiles, so only the runs
+	# since the last such run count.
+
+	def load(self):
+		if not os.path.isfile(self.fn):
+			return
+		runs = set()
+		with open(self.fn) as f:
+			for line in f:
+				try:
+					record = json.loads(line)
+				except ValueError:
+					continue
+				if 'slide' in record:
+					if self.same_source(record):
+						self.sha = record['sha']
+						if record.get('tool') == self.tool and record.get('params') == self.params:
+							runs.add( record['run'] )
+						else:
+							runs.clear()
+							self.tiles.clear()
+							self.done_record = None
+				elif record.get('run') in runs:
+					if 'tile' in record:
+						self.tiles.add( record['tile'] )
+					elif record.get('done'):
+						self.done_record = record
+
+	def source_sha(self):
+		if self.sha is None:
+			self.sha = hash_file(self.fn_source)
+		return self.sha
+
+	# The done record of an earlier run, unless some of its tiles were
+	# deleted since.
+
+	def done(self):
+		if self.done_record is None:
+			return None
+		if not all( os.path.isfile( os.path.join(self.dir_out, t) ) for t in self.tiles ):
+			return None
+		return self.done_record
+
+	# A tile is skipped when an earlier run recorded it and it still exists.
+
+	def has_tile(self, fn):
+		rel = os.path.relpath(fn, self.dir_out)
+		return rel in self.tiles and os.path.isfile(fn)
+
+	def append(self, record):
+		line = json.dumps(record) + "\n"
+		with self.lock:
+			self.file.write(line)
+			self.file.flush()
+
+	def begin(self):
+		os.makedirs(self.dir_out, exist_ok=True)
+		self.file = open(self.fn, 'a')
+		self.run = "{}-{}-{}".format( self.source_sha(), os.getpid(), int(time.time() * 1000) )
+		record = dict(self.source)
+		record.update( sha=self.source_sha(), tool=self.tool, params=self.params, run=self.run )
+		self.append(record)
+
+	# Passed to imgtiles.TileWriter as on_written.
+
+	def add_tile(self, fn):
+		self.append( { 'run': self.run, 'tile': os.path.relpath(fn, self.dir_out) } )
+
+	def finish(self, n_tiles, listing=None):
+		record = { 'run': self.run, 'done': True, 'tiles': n_tiles }
+		if listing is not None:
+			record['listing'] = listing
+		self.append(record)
+		self.file.close()
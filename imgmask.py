@@ -0,0 +1,240 @@
+#!/usr/bin/python3
+from __future__ import print_function
+
+# Ground truth masks from a source image and its annotated copy. A pixel is
+# annotated when any colour channel differs by more than 64 between the two
+# images. Masks are cached on disk as bit-packed arrays keyed by the content
+# hashes of both images, so repeated evaluations of a slide read 1 bit per
+# pixel instead of decoding two full-colour images.
+#
+# The cache is per user and kept under a size limit: every hit refreshes the
+# modification time of its file, and when the cache outgrows the limit the
+# least recently used masks are deleted. A cache that cannot be read or
+# written is skipped and the mask computed.
+
+import os
+import sys
+import glob
+import tempfile
+
+import cv2
+import numpy as np
+
+import imgtrace
+from imgtiles import hash_file, ImageBands
+
+DIFF_THRESHOLD = 64
+
+# Eviction frees this fraction of the size limit at once, so that it does
+# not run on every store.
+EVICT_SLACK = 0.1
+
+
+def default_cache_dir():
+	base = os.environ.get('XDG_CACHE_HOME') or os.path.join( os.path.expanduser('~'), '.cache' )
+	return os.path.join(base, 'imgmask')
+
+
+# Set IMGMASK_CACHE to another directory, or to an empty string to disable
+# the cache, and IMGMASK_CACHE_MB to its size limit (0 = no limit).
+cache_dir = os.environ.get('IMGMASK_CACHE', default_cache_dir())
+cache_max_bytes = int( float( os.environ.get('IMGMASK_CACHE_MB', 4096) ) * 1024 * 1024 )
+
+
+def cache_warning(action, e):
+	sys.stderr.write("Mask cache " + cache_dir + ": unable to " + action + ", computing the mask: " + str(e) + "\n")
+
+
+def diff_mask(src1, src2, thres=DIFF_THRESHOLD):
+	diff = cv2.absdiff(src1, src2)
+	if diff.ndim == 3:
+		diff = diff.max(axis=2)
+	return np.where(diff > thres, np.uint8(255), np.uint8(0))
+
+
+def pack_mask(mask):
+	return np.packbits(mask > 0, axis=1)
+
+
+def unpack_mask(packed, width):
+	return np.unpackbits(packed, axis=1, count=width) * np.uint8(255)
+
+
+def mask_cache_key(fn_src1, fn_src2, thres=DIFF_THRESHOLD):
+	return "{}-{}-t{}".format(hash_file(fn_src1), hash_file(fn_src2), thres)
+
+
+# Returns the cached bit-packed mask as a read-only memory map together with
+# the image width, or (None, None) if it is not cached yet.
+
+def load_packed_mask(key):
+	if not cache_dir:
+		return None, None
+	for fn in glob.glob( os.path.join(cache_dir, key + "-w*.npy") ):
+		width = int( fn[ fn.rindex("-w") + 2 : -4 ] )
+		try:
+			packed = np.load(fn, mmap_mode='r')
+		except FileNotFoundError:
+			continue
+		except OSError as e:
+			cache_warning("read", e)
+			return None, None
+		try:
+			os.utime(fn)
+		except OSError:
+			pass
+		return packed, width
+	return None, None
+
+
+def save_packed_mask(key, mask):
+	if not cache_dir:
+		return
+	fn_tmp = None
+	try:
+		os.makedirs(cache_dir, exist_ok=True)
+		fd, fn_tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+		with os.fdopen(fd, 'wb') as f:
+			np.save(f, pack_mask(mask))
+		commit_packed_mask(fn_tmp, key, mask.shape[1])
+	except OSError as e:
+		cache_warning("write", e)
+		if fn_tmp is not None and os.path.exists(fn_tmp):
+			os.remove(fn_tmp)
+
+
+def commit_packed_mask(fn_tmp, key, width):
+	os.replace(fn_tmp, os.path.join(cache_dir, "{}-w{}.npy".format(key, width)))
+	evict_masks()
+
+
+# Deletes the least recently used masks until the cache is EVICT_SLACK below
+# its limit. Masks deleted by another process meanwhile are skipped; a mask
+# that is still memory-mapped stays readable until it is closed.
+
+def evict_masks():
+	if cache_max_bytes <= 0:
+		return 0
+	files = []
+	for fn in glob.glob( os.path.join(cache_dir, "*.npy") ):
+		try:
+			st = os.stat(fn)
+		except OSError:
+			continue
+		files.append( (st.st_mtime, st.st_size, fn) )
+	used = sum( size for _, size, _ in files )
+	if used <= cache_max_bytes:
+		return 0
+	n_evicted = 0
+	for _, size, fn in sorted(files):
+		if used <= cache_max_bytes * (1 - EVICT_SLACK):
+			break
+		try:
+			os.remove(fn)
+			n_evicted += 1
+		except OSError:
+			pass
+		used -= size
+	return n_evicted
+
+
+# src1 may be passed in by callers that have already decoded the source image.
+
+def get_ground_truth_mask(fn_src1, fn_src2, src1=None):
+	key = mask_cache_key(fn_src1, fn_src2) if cache_dir else None
+	if key is not None:
+		packed, width = load_packed_mask(key)
+		if packed is not None:
+			with imgtrace.stage('mask', cached=True):
+				return unpack_mask(packed, width)
+
+	with imgtrace.stage('decode', count=2 if src1 is None else 1):
+		if src1 is None:
+			src1 = cv2.imread(fn_src1, -1)
+		src2 = cv2.imread(fn_src2, -1)
+	with imgtrace.stage('mask', cached=False):
+		mask = diff_mask(src1, src2)
+		if key is not None:
+			save_packed_mask(key, mask)
+	return mask
+
+
+# Ground truth mask read band by band, for slides too large to hold the two
+# images and their mask in memory at once. src1 is the ImageBands of the
+# source image, shared with the caller; the annotated image is only opened
+# when the mask is not cached. A mask computed here is written to the cache
+# row by row through a memory map, and kept once every row has been seen.
+
+class GroundTruthBands:
+	def __init__(self, fn_src1, fn_src2, src1):
+		self.src1 = src1
+		self.src2 = None
+		self.fn_src2 = fn_src2
+		self.key = mask_cache_key(fn_src1, fn_src2) if cache_dir else None
+		self.packed, self.width = load_packed_mask(self.key) if self.key is not None else (None, None)
+		self.out = None
+		self.fn_tmp = ""
+		self.rows_done = 0
+		if self.packed is None:
+			self.src2 = ImageBands(fn_src2)
+			self.width = src1.width
+			if self.key is not None:
+				try:
+					os.makedirs(cache_dir, exist_ok=True)
+					fd, self.fn_tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+					os.close(fd)
+					self.out = np.lib.format.open_memmap(self.fn_tmp, mode='w+', dtype=np.uint8, shape=(src1.height, (self.width + 7) // 8))
+				except OSError as e:
+					cache_warning("write", e)
+					self.out = None
+					if os.path.exists(self.fn_tmp):
+						os.remove(self.fn_tmp)
+
+	def read_rows(self, r0, r1):
+		if self.packed is not None:
+			with imgtrace.timed('mask'):
+				return unpack_mask(self.packed[r0:r1], self.width)
+		src1 = self.src1.read_rows(r0, r1)
+		src2 = self.src2.read_rows(r0, r1)
+		with imgtrace.timed('mask'):
+			mask = diff_mask(src1, src2)
+			r1 = r0 + mask.shape[0]
+			if self.out is not None and r0 <= self.rows_done < r1:
+				self.out[ self.rows_done : r1 ] = pack_mask( mask[ self.rows_done - r0 : ] )
+				self.rows_done = r1
+		return mask
+
+	def close(self):
+		if self.out is None:
+			return
+		self.out.flush()
+		self.out = None
+		try:
+			if self.rows_done == self.src1.height:
+				commit_packed_mask(self.fn_tmp, self.key, self.width)
+			else:
+				os.remove(self.fn_tmp)
+		except OSError as e:
+			cache_warning("write", e)
+
+
+# Summed-area table of the nonzero pixels of mask, one row and column larger
+# than the mask, so that the nonzero count of any rectangle is an O(1) lookup.
+
+def integral_mask(mask):
+	sdepth = cv2.CV_32S if mask.size < 2**31 else cv2.CV_64F
+	return cv2.integral( (mask > 0).view(np.uint8), sdepth=sdepth )
+
+
+# Number of nonzero pixels in mask[y0:y1, x0:x1]. The coordinates may be
+# scalars or NumPy arrays of boxes, and are clipped to the mask.
+
+def count_nonzero_boxes(integral, y0, x0, y1, x1):
+	h = integral.shape[0] - 1
+	w = integral.shape[1] - 1
+	y0 = np.clip(y0, 0, h)
+	y1 = np.clip(y1, 0, h)
+	x0 = np.clip(x0, 0, w)
+	x1 = np.clip(x1, 0, w)
+	nz = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+	return np.asarray(nz).astype(np.int64)
@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+from __future__ import print_function
+
+# Persistent cache of tile predictions, so that rescoring unchanged slides
+# with an unchanged model skips the model. Predictions are kept in one SQLite
+# file keyed by the hash of the model and a key of the tile: the content hash
+# of an image file or of a shard tile, or the name of a tile cut from a slide
+# (the slide hash, scale and box). The file is opened in WAL mode, so any
+# number of processes can read and add predictions at once; writers wait for
+# each other. WAL needs shared memory, so the file must be on a local disk,
+# not NFS.
+#
+# Every lookup refreshes the access time of the rows it finds, and when the
+# file outgrows its size limit the least recently used predictions are
+# deleted; SQLite reuses their pages, so the file stops growing.
+
+import os
+import time
+import sqlite3
+import hashlib
+
+import numpy as np
+
+from imgtiles import hash_file
+
+# Keys per SELECT, under the SQLite limit of 999 parameters.
+LOOKUP_CHUNK = 500
+
+# Hits refresh the access time of rows not accessed for this many seconds,
+# so that rereading a cached slide does not rewrite every row.
+ATIME_RESOLUTION = 60
+
+# Eviction frees this fraction of the size limit at once, so that it does
+# not run on every store.
+EVICT_SLACK = 0.1
+
+
+# Hash of a model file, or of all files of a SavedModel directory.
+
+def model_hash(fn_model):
+	if not os.path.isdir(fn_model):
+		return hash_file(fn_model)
+	h = hashlib.sha1()
+	for root, dirs, files in os.walk(fn_model):
+		dirs.sort()
+		for fn in sorted(files):
+			path = os.path.join(root, fn)
+			h.update( os.path.relpath(path, fn_model).encode() )
+			h.update( hash_file(path).encode() )
+	return h.hexdigest()[0:16]
+
+
+class PredictionCache:
+	def __init__(self, fn_cache, model, max_mb=1024):
+		self.fn_cache = fn_cache
+		self.model = model
+		self.max_bytes = int( max_mb * 1024 * 1024 )
+		self.hits = 0
+		self.misses = 0
+		os.makedirs( os.path.dirname( os.path.abspath(fn_cache) ), exist_ok=True )
+		self.connect()
+
+	# A connection must not be used across fork(); forked workers call
+	# connect() again.
+
+	def connect(self):
+		self.db = sqlite3.connect(self.fn_cache, timeout=600, isolation_level=None)
+		self.db.execute("PRAGMA journal_mode=WAL")
+		self.db.execute("PRAGMA synchronous=NORMAL")
+		self.db.execute("CREATE TABLE IF NOT EXISTS predictions (model TEXT NOT NULL, key TEXT NOT NULL, probs BLOB NOT NULL, atime REAL NOT NULL, PRIMARY KEY (model, key)) WITHOUT ROWID")
+		self.db.execute("CREATE INDEX IF NOT EXISTS predictions_atime ON predictions (atime)")
+
+	# Returns the cached predictions of the keys that are found, by key.
+
+	def lookup(self, keys):
+		found = {}
+		unique = list( dict.fromkeys(keys) )
+		for i in range(0, len(unique), LOOKUP_CHUNK):
+			chunk = unique[ i : i + LOOKUP_CHUNK ]
+			rows = self.db.execute( "SELECT key, probs FROM predictions WHERE model = ? AND key IN (" + ",".join( "?" * len(chunk) ) + ")", [ self.model ] + chunk )
+			for key, probs in rows:
+				found[key] = np.frombuffer(probs, dtype=np.float32)
+		if len(found) > 0:
+			now = time.time()
+			with self.db:
+				self.db.execute("BEGIN")
+				self.db.executemany( "UPDATE predictions SET atime = ? WHERE model = ? AND key = ? AND atime < ?", [ (now, self.model, k, now - ATIME_RESOLUTION) for k in found ] )
+		n_hits = sum( 1 for k in keys if k in found )
+		self.hits += n_hits
+		self.misses += len(keys) - n_hits
+		return found
+
+	def store(self, keys, predictions):
+		now = time.time()
+		rows = [ (self.model, k, np.asarray(p, dtype=np.float32).tobytes(), now) for k, p in zip(keys, predictions) ]
+		with self.db:
+			self.db.execute("BEGIN IMMEDIATE")
+			self.db.executemany("INSERT OR REPLACE INTO predictions (model, key, probs, atime) VALUES (?, ?, ?, ?)", rows)
+			self.evict()
+
+	def size_bytes(self):
+		page_size = self.db.execute("PRAGMA page_size").fetchone()[0]
+		page_count = self.db.execute("PRAGMA page_count").fetchone()[0]
+		freelist_count = self.db.execute("PRAGMA freelist_count").fetchone()[0]
+		return ( page_count - freelist_count ) * page_size
+
+	# Deletes the least recently used predictions, of any model, until the
+	# file is EVICT_SLACK below its limit. Runs inside the store transaction.
+
+	def evict(self):
+		used = self.size_bytes()
+		if self.max_bytes <= 0 or used <= self.max_bytes:
+			return 0
+		n_rows = self.db.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+		n_evict = min( n_rows, int( np.ceil( ( used - self.max_bytes * (1 - EVICT_SLACK) ) / max(used / max(n_rows, 1), 1) ) ) )
+		self.db.execute("DELETE FROM predictions WHERE (model, key) IN (SELECT model, key FROM predictions ORDER BY atime LIMIT ?)", (n_evict,))
+		return n_evict
+
+	# Returns one row of predictions per key, in order, computing only the
+	# rows missing from the cache with predict_missing(indices), which must
+	# return their predictions in the order of the indices. found may hold the
+	# result of an earlier lookup of the keys.
+
+	def predict(self, keys, predict_missing, found=None):
+		if found is None:
+			found = self.lookup(keys)
+		missing = [ i for i, k in enumerate(keys) if k not in found ]
+		new = predict_missing(missing) if len(missing) > 0 else None
+		if new is not None:
+			self.store( [ keys[i] for i in missing ], new )
+			width = new.shape[1]
+		else:
+			width = len( next( iter( found.values() ) ) ) if len(found) > 0 else 0
+		out = np.empty( (len(keys), width), dtype=np.float32 )
+		for i, k in enumerate(keys):
+			if k in found:
+				out[i] = found[k]
+		if new is not None:
+			out[missing] = new
+		return out
+
+	def hit_rate(self):
+		return self.hits / max(self.hits + self.misses, 1)
+
+	def report(self):
+		return "Prediction cache {}: {} of {} tiles cached ({:.1f}%), {:.1f} MB".format( self.fn_cache, self.hits, self.hits + self.misses, 100 * self.hit_rate(), self.size_bytes() / 1024 / 1024 )
+
+	def close(self):
+		self.db.close()
@@ -0,0 +1,249 @@
+#!/usr/bin/python3
+from __future__ import print_function
+
+# Tile probability rasters. Tile names in the score files of imgclassify.pl
+# predict --split-tiles carry the tile box in one of three schemes, tried in
+# this order as imgprob.pl does:
+#
+#   ...-y-x-y1-x1.jpg   (gen_tiles, imgtiles.tile_name; inclusive corners)
+#   ...-S.SSSx-y-x.jpg  (scaled tiles of 224 * S pixels)
+#   ...-y-x.jpg         (imgsplit.py, 224 pixels)
+#
+# The probabilities of all tiles are combined on the grid of cells cut by the
+# tile edges, which is uniform inside every cell, so a slide of thousands of
+# tiles is rasterised in milliseconds. Full-resolution heatmaps and masks for
+# any threshold are only expanded from the cells when asked for, and the
+# confusion counts against a ground truth mask need no full-resolution
+# raster at all.
+
+import os
+import re
+import sys
+
+import cv2
+import numpy as np
+
+from imgmask import count_nonzero_boxes
+from imgtiles import ImageBands
+
+TILE_SIZE = 224
+
+TILE_BOX_PATTERNS = [
+	re.compile(r'-(\d+)-(\d+)-(\d+)-(\d+).jpe?g$'),
+	re.compile(r'([\d\.]+)x-(\d+)-(\d+).jpe?g$'),
+	re.compile(r'-(\d+)-(\d+).jpe?g$'),
+	]
+
+SUMMARY_ROW = re.compile(r'(median|min|max|vote|infogain)\s*$')
+
+METHODS = [ 'mean', 'max', 'coverage' ]
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+def get_abspath(path):
+	return path if path.startswith('/') else os.getcwd() + '/' + path
+
+
+# Returns the inclusive box (y0, x0, y1, x1) of a tile name, or None.
+
+def get_tile_box(tile, tile_size=TILE_SIZE):
+	m = TILE_BOX_PATTERNS[0].search(tile)
+	if m:
+		return tuple( int(v) for v in m.groups() )
+	m = TILE_BOX_PATTERNS[1].search(tile)
+	if m:
+		scale = float(m.group(1))
+		y0, x0 = int(m.group(2)), int(m.group(3))
+		return (y0, x0, y0 + int(tile_size * scale) - 1, x0 + int(tile_size * scale) - 1)
+	m = TILE_BOX_PATTERNS[2].search(tile)
+	if m:
+		y0, x0 = int(m.group(1)), int(m.group(2))
+		return (y0, x0, y0 + tile_size - 1, x0 + tile_size - 1)
+	return None
+
+
+# Boxes of many tile names as an n x 4 array, and which names had one.
+
+def get_tile_boxes(tiles, tile_size=TILE_SIZE):
+	boxes = np.full( (len(tiles), 4), -1, dtype=np.int64 )
+	for i, tile in enumerate(tiles):
+		box = get_tile_box(tile, tile_size)
+		if box is not None:
+			boxes[i] = box
+	return boxes, boxes[:, 0] >= 0
+
+
+# Returns the Y probability of every tile of fn_source keyed by its box, as
+# imgprob.pl does, and all Y scores of the source, as imgtistats.pl collects
+# them for the quantiles (including the summary rows).
+
+def load_tile_scores(fn_score, fn_source):
+	fn_source = get_abspath(fn_source)
+	tile_probs = {}
+	scores = []
+	with open(fn_score) as f:
+		for line in f:
+			parts = line.rstrip("\n").split("\t")
+			if len(parts) > 1 and parts[1].endswith('.model'):
+				continue
+			if parts[0].endswith('.model'):
+				parts = parts[1:]
+			if len(parts) < 2:
+				continue
+			primary, sep, tile = parts[0].partition(':')
+			if get_abspath(primary) != fn_source:
+				continue
+			y_probs = [ p[2:] for p in parts[2:] if p.startswith('Y:') ]
+			scores.extend(y_probs)
+			if SUMMARY_ROW.search(tile):
+				continue
+			box = get_tile_box(tile)
+			if box is None:
+				eprint( os.path.basename(sys.argv[0]) + ": unrecognised tile name: " + tile )
+				continue
+			y_prob = y_probs[0] if len(y_probs) > 0 else 'NA'
+			tile_probs[box] = 0.0 if y_prob == 'NA' else float(y_prob)
+	return tile_probs, [ float(v) for v in scores if v != 'NA' ]
+
+
+def tile_arrays(tile_probs):
+	boxes = sorted(tile_probs)
+	return np.array(boxes, dtype=np.int64).reshape(-1, 4), np.array( [ tile_probs[b] for b in boxes ], dtype=np.float64 )
+
+
+# Combination of the tile probabilities over an image of shape (rows, cols):
+#
+#   mean      mean probability of the tiles covering a pixel
+#   max       highest probability of the tiles covering a pixel, as the
+#             overlay drawn by imgprob.pl
+#   coverage  mean weighted by the fraction of each tile inside the image, so
+#             that padded edge tiles count less
+#
+# Pixels no tile covers are 0 and not covered. values and covered hold one
+# entry per cell, between the edges ys and xs.
+
+class TileRaster:
+	def __init__(self, boxes, probs, shape, method='mean'):
+		if method not in METHODS:
+			raise ValueError("unknown combination " + method)
+		boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+		probs = np.asarray(probs, dtype=np.float64)
+		self.shape = ( int(shape[0]), int(shape[1]) )
+		h, w = self.shape
+		y0 = np.clip(boxes[:, 0], 0, h)
+		x0 = np.clip(boxes[:, 1], 0, w)
+		y1 = np.clip(boxes[:, 2] + 1, 0, h)
+		x1 = np.clip(boxes[:, 3] + 1, 0, w)
+		self.ys = np.unique( np.concatenate( ( [ 0, h ], y0, y1 ) ) )
+		self.xs = np.unique( np.concatenate( ( [ 0, w ], x0, x1 ) ) )
+		iy0 = np.searchsorted(self.ys, y0)
+		iy1 = np.searchsorted(self.ys, y1)
+		ix0 = np.searchsorted(self.xs, x0)
+		ix1 = np.searchsorted(self.xs, x1)
+		ny = len(self.ys) - 1
+		nx = len(self.xs) - 1
+
+		if method == 'max':
+			values = np.full( (ny, nx), -np.inf )
+			for i in np.argsort(probs, kind='stable'):
+				values[ iy0[i]:iy1[i], ix0[i]:ix1[i] ] = probs[i]
+			self.covered = values > -np.inf
+			self.values = np.where(self.covered, values, 0.0)
+			return
+
+		count = self.box_sums( (iy0, ix0, iy1, ix1), np.ones( len(probs), dtype=np.int64 ) )
+		weights = np.ones( len(probs) )
+		if method == 'coverage':
+			area = ( boxes[:, 2] - boxes[:, 0] + 1 ) * ( boxes[:, 3] - boxes[:, 1] + 1 )
+			weights = ( (y1 - y0) * (x1 - x0) ) / np.maximum(area, 1)
+		weight_sum = self.box_sums( (iy0, ix0, iy1, ix1), weights )
+		prob_sum = self.box_sums( (iy0, ix0, iy1, ix1), weights * probs )
+		self.covered = count > 0
+		with np.errstate(divide='ignore', invalid='ignore'):
+			self.values = np.where( self.covered & (weight_sum > 0), prob_sum / weight_sum, 0.0 )
+
+	# Sum of v over the boxes covering each cell, by 2D differences.
+
+	def box_sums(self, cell_boxes, v):
+		iy0, ix0, iy1, ix1 = cell_boxes
+		diff = np.zeros( ( len(self.ys), len(self.xs) ), dtype=v.dtype )
+		np.add.at( diff, (iy0, ix0), v )
+		np.add.at( diff, (iy0, ix1), -v )
+		np.add.at( diff, (iy1, ix0), -v )
+		np.add.at( diff, (iy1, ix1), v )
+		return diff.cumsum(axis=0).cumsum(axis=1)[ :-1, :-1 ]
+
+	def expand(self, cells):
+		return np.repeat( np.repeat( cells, np.diff(self.ys), axis=0 ), np.diff(self.xs), axis=1 )
+
+	def raster(self):
+		return self.expand( self.values.astype(np.float32) )
+
+	def mask(self, thres):
+		return self.expand( np.where( self.covered & (self.values >= thres), np.uint8(255), np.uint8(0) ) )
+
+	# tp, fn, fp, tn of the mask of every threshold against the ground truth
+	# mask given by its summed-area table (imgmask.integral_mask).
+
+	def confusion_counts(self, integral, thresholds):
+		y0, x0 = np.meshgrid( self.ys[:-1], self.xs[:-1], indexing='ij' )
+		y1, x1 = np.meshgrid( self.ys[1:], self.xs[1:], indexing='ij' )
+		pos = count_nonzero_boxes(integral, y0, x0, y1, x1)
+		neg = (y1 - y0) * (x1 - x0) - pos
+		n_gndt_pos = int( pos.sum() )
+		n_gndt_neg = int( neg.sum() )
+
+		order = np.argsort( self.values[self.covered], kind='stable' )
+		values = self.values[self.covered][order]
+		pos_above = np.concatenate( [ np.cumsum( pos[self.covered][order][::-1] )[::-1], [0] ] )
+		neg_above = np.concatenate( [ np.cumsum( neg[self.covered][order][::-1] )[::-1], [0] ] )
+
+		counts = []
+		for thres in thresholds:
+			i = np.searchsorted(values, thres, side='left')
+			n_tp = int( pos_above[i] )
+			n_fp = int( neg_above[i] )
+			counts.append( (n_tp, n_gndt_pos - n_tp, n_fp, n_gndt_neg - n_fp) )
+		return counts
+
+
+if __name__ == '__main__':
+	method = 'max'
+	thres = None
+	argv = [ sys.argv[0] ]
+	i = 1
+	while i < len(sys.argv):
+		if sys.argv[i] in ( '-m', '--method' ) and i + 1 < len(sys.argv):
+			method = sys.argv[i + 1]
+			i += 2
+		elif sys.argv[i] in ( '-t', '--threshold' ) and i + 1 < len(sys.argv):
+			thres = float(sys.argv[i + 1])
+			i += 2
+		else:
+			argv.append(sys.argv[i])
+			i += 1
+
+	if len(argv) < 4 or method not in METHODS:
+		sys.stderr.write("FATAL: Insufficient arguments\n\n")
+		sys.stderr.write("Usage: imgraster.py [-m mean|max|coverage] [-t Threshold] SourceImage ScoreFile Output.png|Output.npy\n\n")
+		sys.exit(1)
+
+	fn_source, fn_score, fn_out = argv[1:4]
+	tile_probs, scores = load_tile_scores(fn_score, fn_source)
+	if len(tile_probs) == 0:
+		eprint("imgraster.py: no tiles of " + fn_source + " in " + fn_score)
+		sys.exit(1)
+
+	src = ImageBands(fn_source)
+	boxes, probs = tile_arrays(tile_probs)
+	raster = TileRaster( boxes, probs, (src.height, src.width), method )
+
+	if fn_out.endswith('.npy'):
+		np.save( fn_out, raster.raster() )
+	elif thres is not None:
+		cv2.imwrite( fn_out, raster.mask(thres) )
+	else:
+		cv2.imwrite( fn_out, np.round( raster.raster() * 255 ).astype(np.uint8) )
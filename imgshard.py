@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+from __future__ import print_function
+
+# Tile shards: all tiles of a slide in one file instead of one file per tile.
+# A shard FILE is a contiguous blob of tiles, either JPEG-encoded or raw
+# uint8 pixels, and FILE.idx is a tab-separated index with one line per tile:
+#
+#   sha  scale  y  x  y1  x1  class  offset  length  height  width  channels  format
+#
+# y, x, y1 and x1 follow the tile file names of the tool that wrote the shard
+# (y1 and x1 are inclusive) and class is "." for unlabelled tiles. Shards are
+# read through a memory map, so raw tiles are views into the page cache and
+# JPEG tiles are decoded straight from it.
+
+import os
+import threading
+
+import cv2
+import numpy as np
+
+INDEX_FIELDS = [ 'sha', 'scale', 'y', 'x', 'y1', 'x1', 'class', 'offset', 'length', 'height', 'width', 'channels', 'format' ]
+
+SHARD_FORMATS = [ 'jpg', 'raw' ]
+
+SHARD_SUFFIX = ".tiles"
+
+
+def index_filename(fn_shard):
+	return fn_shard + ".idx"
+
+
+def is_shard(fn):
+	return fn.endswith(SHARD_SUFFIX) and os.path.isfile( index_filename(fn) )
+
+
+# Tile name in the style of the tile files: sha-yyyy-xxxx.jpg for tiles at the
+# original scale, the gen_tiles name sha-S.SSSx-y-x-y1-x1.jpg otherwise.
+
+def shard_tile_name(entry):
+	if float(entry['scale']) == 1.0:
+		return "{}-{:04d}-{:04d}.jpg".format(entry['sha'], int(entry['y']), int(entry['x']))
+	return "{}-{:.3f}x-{:04d}-{:04d}-{:04d}-{:04d}.jpg".format(entry['sha'], float(entry['scale']), int(entry['y']), int(entry['x']), int(entry['y1']), int(entry['x1']))
+
+
+# Appends tiles to a shard. add() may be called from several threads; tiles
+# are encoded by the calling thread and only the append is serialized. The
+# index is written on close(), in the order in which the tiles were added.
+
+class ShardWriter:
+	def __init__(self, fn_shard, fmt='jpg', quality=95):
+		if fmt not in SHARD_FORMATS:
+			raise ValueError("unknown shard format " + fmt)
+		self.fn_shard = fn_shard
+		self.fmt = fmt
+		self.params = [ cv2.IMWRITE_JPEG_QUALITY, int(quality) ]
+		self.blob = open(fn_shard, 'wb')
+		self.lock = threading.Lock()
+		self.offset = 0
+		self.entries = {}
+		self.n_added = 0
+
+	def reserve(self):
+		with self.lock:
+			seq = self.n_added
+			self.n_added += 1
+		return seq
+
+	def add(self, seq, tile, sha, scale, y, x, y1, x1, cls="."):
+		if self.fmt == 'jpg':
+			ok, data = cv2.imencode(".jpg", tile, self.params)
+			if not ok:
+				return False
+			data = data.tobytes()
+		else:
+			data = np.ascontiguousarray(tile).tobytes()
+		channels = tile.shape[2] if tile.ndim == 3 else 1
+		with self.lock:
+			self.blob.write(data)
+			self.entries[seq] = [ sha, "{:.3f}".format(scale), y, x, y1, x1, cls, self.offset, len(data), tile.shape[0], tile.shape[1], channels, self.fmt ]
+			self.offset += len(data)
+		return True
+
+	def close(self):
+		self.blob.close()
+		with open( index_filename(self.fn_shard), 'w' ) as f:
+			f.write( "\t".join(INDEX_FIELDS) + "\n" )
+			for seq in sorted(self.entries):
+				f.write( "\t".join( [ str(v) for v in self.entries[seq] ] ) + "\n" )
+
+
+def read_shard_index(fn_shard):
+	with open( index_filename(fn_shard) ) as f:
+		header = f.readline().rstrip("\n").split("\t")
+		return [ dict( zip(header, line.rstrip("\n").split("\t")) ) for line in f if len(line.strip()) > 0 ]
+
+
+# Memory-mapped shard; tile(i) returns the i-th tile of the index as decoded
+# by cv2.imread(fn, cv2.IMREAD_COLOR), i.e. 3-channel BGR.
+
+class ShardReader:
+	def __init__(self, fn_shard):
+		self.fn_shard = fn_shard
+		self.entries = read_shard_index(fn_shard)
+		self.blob = np.memmap(fn_shard, dtype=np.uint8, mode='r') if os.path.getsize(fn_shard) > 0 else np.zeros(0, dtype=np.uint8)
+
+	def __len__(self):
+		return len(self.entries)
+
+	def tile(self, i):
+		e = self.entries[i]
+		data = self.blob[ int(e['offset']) : int(e['offset']) + int(e['length']) ]
+		if e['format'] == 'jpg':
+			return cv2.imdecode(data, cv2.IMREAD_COLOR)
+		tile = data.reshape( int(e['height']), int(e['width']), int(e['channels']) )
+		if tile.shape[2] == 1:
+			return cv2.cvtColor(tile, cv2.COLOR_GRAY2BGR)
+		if tile.shape[2] == 4:
+			return cv2.cvtColor(tile, cv2.COLOR_BGRA2BGR)
+		return tile
+
+	def tile_names(self):
+		return [ shard_tile_name(e) for e in self.entries ]
@@ -6,40 +6,162 @@ import time
 import sys
 import cv2
 import os
+import numpy as np
 
-import hashlib
-
-def hash_file(filename):
-	h = hashlib.sha1()
-	with open(filename,'rb') as file:
-		chunk = 0
-		while chunk != b'':
-			chunk = file.read(1024)
-			h.update(chunk)
-	return h.hexdigest()[0:16]
+import imgtrace
+from imgtiles import parse_tile_dim, tile_grid, crop_tile, pad_tile, scaled_size, pyramid_levels, tile_box, tile_name, ImageBands, TileWriter
+from imgshard import ShardWriter, SHARD_FORMATS, SHARD_SUFFIX
+from imgtissue import thumbnail, load_thumbnail, tissue_mask, tissue_fractions
+from imgmanifest import TilingManifest
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
-if len(sys.argv)<2:
+# Cuts the tiles as ImageUtils::gen_tiles does for imgclassify.pl
+# --split-tiles: tiles of tile_w x tile_h at every scale, padded to
+# size_w x size_h and named sha[-WxH]-S.SSSx-y-x-y1-x1.jpg with the box in
+# original pixels. The image is decoded once and every scale is cut from a
+# pyramid built by area interpolation, instead of rescaling the full image
+# for each scale. Tiles already in the manifest are not cut again. Returns
+# the number of tiles that could not be written.
+
+def split_pyramid(src_bands, fn_image_src, dir_image_out, scales, tile_w, tile_h, size_w, size_h, stride_factor, manifest):
+	zsuffix = "-{}x{}".format(tile_w, tile_h) if ( tile_w != size_w or tile_h != size_h ) else ""
+	with imgtrace.stage('hash'):
+		image_stem = manifest.source_sha()
+	img = src_bands.img if src_bands.img is not None else src_bands.read_rows(0, src_bands.height)
+
+	# The grid of every scale depends only on its size, so all tiles are
+	# planned (and filtered by tissue) before any level is built.
+	level_origins = {}
+	if min_tissue > 0:
+		with imgtrace.stage('mask', kind='tissue'):
+			mask = tissue_mask( thumbnail(img) )
+	for scale in scales:
+		level_w, level_h = scaled_size(src_bands.width, src_bands.height, scale)
+		origins = tile_grid(level_w, level_h, tile_w, tile_h, stride_factor)
+		n_grid = len(origins)
+		if min_tissue > 0:
+			tile_y = np.array( [ y for (y, x) in origins ], dtype=np.int64 )
+			tile_x = np.array( [ x for (y, x) in origins ], dtype=np.int64 )
+			tissue = tissue_fractions( mask, level_h, level_w, tile_y, tile_x, tile_y + tile_h, tile_x + tile_w )
+			origins = [ o for o, f in zip(origins, tissue) if f >= min_tissue ]
+		level_origins[scale] = origins
+		eprint("Image size {}x{} ({}x{}). Scale {:.3f}x. Tiles {} of {}.".format(level_w, level_h, size_w, size_h, scale, len(origins), n_grid))
+
+	n_tiles = sum( len(o) for o in level_origins.values() )
+	fn_shard = os.path.join(dir_image_out, image_stem + SHARD_SUFFIX)
+	manifest.begin()
+	shard = ShardWriter(fn_shard, shard_format, jpeg_quality) if shard_format is not None else None
+	writer = TileWriter(n_workers, jpeg_quality, total=n_tiles, shard=shard, on_written=manifest.add_tile if shard is None else None)
+
+	n_done = 0
+	for scale, level in pyramid_levels(img, scales):
+		for (y, x) in level_origins[scale]:
+			out_fn = os.path.join( dir_image_out, tile_name(image_stem, scale, y, x, tile_h, tile_w, "jpg", zsuffix) )
+			if shard is None and manifest.has_tile(out_fn):
+				n_done += 1
+				continue
+			with imgtrace.timed('crop'):
+				tile = pad_tile( crop_tile(level, y, x, tile_h, tile_w), size_h, size_w )
+			orig_y, orig_x, orig_y1, orig_x1 = tile_box(scale, y, x, tile_h, tile_w)
+			writer.write(out_fn, tile, dict(sha=image_stem, scale=scale, y=orig_y, x=orig_x, y1=orig_y1, x1=orig_x1))
+	if n_done > 0:
+		eprint("Resumed: " + str(n_done) + " of " + str(n_tiles) + " tiles already written")
+
+	with imgtrace.stage('output', count=n_tiles):
+		n_failed = writer.close()
+	if n_failed == 0:
+		if shard is not None:
+			manifest.add_tile(fn_shard)
+		manifest.finish(n_tiles)
+	return n_failed
+
+
+# -w NWorkers, -q JpegQuality, -s ShardFormat, -t MinTissue, -a Scales,
+# -d TileDim, -z InputDim, -r Stride and --trace File may be given before the
+# positional arguments.
+n_workers = os.cpu_count()
+jpeg_quality = 95
+shard_format = None
+min_tissue = 0.0
+scales = None
+tile_dim = None
+input_dim = None
+stride_factor = 1
+sys.argv = imgtrace.parse_argv(sys.argv)
+argv = [ sys.argv[0] ]
+i = 1
+while i < len(sys.argv):
+	if sys.argv[i] in ( '-w', '--workers' ) and i + 1 < len(sys.argv):
+		n_workers = int(sys.argv[i + 1])
+		i += 2
+	elif sys.argv[i] in ( '-q', '--quality' ) and i + 1 < len(sys.argv):
+		jpeg_quality = int(sys.argv[i + 1])
+		i += 2
+	elif sys.argv[i] in ( '-s', '--shard' ) and i + 1 < len(sys.argv):
+		shard_format = sys.argv[i + 1]
+		i += 2
+	elif sys.argv[i] in ( '-t', '--min-tissue' ) and i + 1 < len(sys.argv):
+		min_tissue = float(sys.argv[i + 1])
+		i += 2
+	elif sys.argv[i] in ( '-a', '--augscales' ) and i + 1 < len(sys.argv):
+		scales = [ float(v) for v in sys.argv[i + 1].split(',') if len(v) > 0 ]
+		i += 2
+	elif sys.argv[i] in ( '-d', '--tile-dim' ) and i + 1 < len(sys.argv):
+		tile_dim = parse_tile_dim(sys.argv[i + 1])
+		i += 2
+	elif sys.argv[i] in ( '-z', '--input-dim' ) and i + 1 < len(sys.argv):
+		input_dim = parse_tile_dim(sys.argv[i + 1])
+		i += 2
+	elif sys.argv[i] in ( '-r', '--stride' ) and i + 1 < len(sys.argv):
+		stride_factor = float(sys.argv[i + 1])
+		i += 2
+	else:
+		argv.append(sys.argv[i])
+		i += 1
+
+if len(argv)<3:
     sys.stderr.write("FATAL: Insufficient arguments\n\n")
-    sys.stderr.write("Usage: imgsplit.py SourceImage Outdir\n\n")
+    sys.stderr.write("Usage: imgsplit.py [-w NWorkers] [-q JpegQuality] [-s jpg|raw] [-t MinTissue] [-a Scales] [-d TileDim] [-z InputDim] [-r Stride] [--trace File] SourceImage Outdir\n\n")
     sys.exit(1)
 
-fn_image_src  = sys.argv[1]
-dir_image_out = sys.argv[2]
+fn_image_src  = argv[1]
+dir_image_out = argv[2]
+
+if shard_format is not None and shard_format not in SHARD_FORMATS:
+    sys.stderr.write("FATAL: Unknown shard format " + shard_format + "\n\n")
+    sys.exit(1)
 
 eprint("fn_image_src  = "  + fn_image_src )
 eprint("dir_image_out = "  + dir_image_out )
 
-src_image = cv2.imread(fn_image_src, -1) 
+imgtrace.set_context(slide=fn_image_src)
+
+# Outdir/.tiles-manifest records the tiles written for each slide and
+# tiling, so that a rerun skips a slide that is done, and otherwise the
+# tiles written before the job was interrupted.
+params = dict(scales=scales, tile_dim=tile_dim, input_dim=input_dim, stride=stride_factor, min_tissue=min_tissue, quality=jpeg_quality, shard=shard_format)
+manifest = TilingManifest(dir_image_out, fn_image_src, "imgsplit.py", params)
+if manifest.done() is not None:
+	eprint(fn_image_src + " : already tiled in " + dir_image_out + " (" + str(manifest.done()['tiles']) + " tiles)")
+	sys.exit(0)
+
+src_bands = ImageBands(fn_image_src)
+
+# With -a, -d or -z, the tiles and their names are those of gen_tiles.
+if scales is not None or tile_dim is not None or input_dim is not None:
+	tile_w, tile_h = tile_dim or (224, 224)
+	size_w, size_h = input_dim or (tile_w, tile_h)
+	if split_pyramid(src_bands, fn_image_src, dir_image_out, scales or [1.0], tile_w, tile_h, size_w, size_h, stride_factor, manifest) > 0:
+		sys.exit(1)
+	sys.exit(0)
 
-stride_factor = 1
 tile_w = 224
 tile_h = 224
-img_w = src_image.shape[0]
-img_h = src_image.shape[1]
+img_w = src_bands.height
+img_h = src_bands.width
 
 
 ntiles_w = math.ceil( img_w / tile_w );
@@ -51,40 +173,63 @@ img_h_stride = stride_factor * ( 1 - ( ( ( ntiles_h * tile_h - img_h ) / (ntiles
 
 eprint("Image size " + str(img_w) + "x" + str(img_h) + "(" + str(tile_w) + "x" + str(tile_h) +"). Extra " + str(img_w_extra) +"x" + str(img_h_extra) + ". Tiles " + str(ntiles_w) +"x"+ str(ntiles_h) +". Stride "+ str(img_w_stride) +"x"+ str(img_h_stride) +". \n");
 
-image_stem = hash_file(fn_image_src);
-
-r=0
-while (r * tile_h) <= img_h:
-	y = math.floor( r * tile_h )
-	if y >= img_h:
-		y = (img_h - tile_h - 1) 
-	
-	c=0
-	while (c * tile_w) <= img_w:
-		x = int( c * tile_w );
-		if x >= img_w:
-			x = (img_w - tile_w - 1)
+with imgtrace.stage('hash'):
+	image_stem = manifest.source_sha()
+
+# x indexes the rows and y the columns of the image. The image is streamed in
+# bands of rows, one per row of tiles, so that only one band is held in memory.
+origins = tile_grid(img_w, img_h, tile_w, tile_h, stride_factor)
+
+# With -t, tiles with less than MinTissue of tissue in the thumbnail are not cut.
+if min_tissue > 0:
+	with imgtrace.stage('mask', kind='tissue'):
+		thumb = thumbnail(src_bands.img) if src_bands.img is not None else load_thumbnail(fn_image_src)
+		tile_y = np.array( [ y for (y, x) in origins ], dtype=np.int64 )
+		tile_x = np.array( [ x for (y, x) in origins ], dtype=np.int64 )
+		tissue = tissue_fractions( tissue_mask(thumb), img_w, img_h, tile_x, tile_y, tile_x + tile_w - 1, tile_y + tile_h - 1 )
+	eprint("Tissue: " + str(np.count_nonzero(tissue >= min_tissue)) + " of " + str(len(origins)) + " tiles with tissue fraction >= " + str(min_tissue))
+	origins = [ o for o, f in zip(origins, tissue) if f >= min_tissue ]
+
+def tile_filename(y, x):
+	return os.path.join( dir_image_out, "{}-{:04d}-{:04d}.jpg".format(image_stem, y, x) )
+
+# Bands whose tiles were all written by an earlier run are not read. A shard
+# is always written whole.
+n_tiles = len(origins)
+if shard_format is None:
+	origins = [ (y, x) for (y, x) in origins if not manifest.has_tile( tile_filename(y, x) ) ]
+	if len(origins) < n_tiles:
+		eprint("Resumed: " + str(n_tiles - len(origins)) + " of " + str(n_tiles) + " tiles already written")
+
+band_tiles = {}
+for (y, x) in origins:
+	band_tiles.setdefault(x, []).append(y)
+
+# With -s, all tiles go to the shard Outdir/<sha>.tiles instead of one file each.
+fn_shard = os.path.join(dir_image_out, image_stem + SHARD_SUFFIX)
+manifest.begin()
+shard = ShardWriter(fn_shard, shard_format, jpeg_quality) if shard_format is not None else None
+writer = TileWriter(n_workers, jpeg_quality, total=len(origins), shard=shard, on_written=manifest.add_tile if shard is None else None)
+
+for x in sorted(band_tiles):
+	src_band = src_bands.read_rows(x, x + tile_w - 1)
+	for y in band_tiles[x]:
 		x0 = x
 		y0 = y
 		x1 = x + tile_w - 1
 		y1 = y + tile_h - 1
 
-		if not os.path.isdir(dir_image_out):
-			os.mkdir(dir_image_out)
-		
-		subdir = os.path.join(dir_image_out)
-		if not os.path.isdir( subdir ):
-			os.mkdir( subdir )
-		
-		out_fn = os.path.join( subdir, "{}-{:04d}-{:04d}.jpg".format(image_stem, y, x) )
-		cropped_image = src_image[ x0:x1, y0:y1 ]
-		cv2.imwrite(out_fn, cropped_image)
-
-		if x + tile_w + 1 >= img_w:
-			break
-		else:
-			c += img_w_stride
-	if y + tile_h + 1 >= img_h:
-		break
-	else:
-		r += img_h_stride
+		with imgtrace.timed('crop'):
+			out_fn = tile_filename(y, x)
+			cropped_image = src_band[ 0:x1-x0, y0:y1 ]
+		writer.write(out_fn, cropped_image, dict(sha=image_stem, scale=1.0, y=y, x=x, y1=y + cropped_image.shape[1] - 1, x1=x + cropped_image.shape[0] - 1))
+
+with imgtrace.stage('output', count=len(origins)):
+	n_failed = writer.close()
+
+if n_failed > 0:
+	sys.exit(1)
+
+if shard is not None:
+	manifest.add_tile(fn_shard)
+manifest.finish(n_tiles)
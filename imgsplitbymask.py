@@ -6,54 +6,17 @@ import time
 import sys
 import cv2
 import os
+import numpy as np
 
-import hashlib
-
-def hash_file(filename):
-	h = hashlib.sha1()
-	with open(filename,'rb') as file:
-		chunk = 0
-		while chunk != b'':
-			chunk = file.read(1024)
-			h.update(chunk)
-	return h.hexdigest()[0:16]
+import imgtrace
+from imgmask import GroundTruthBands, integral_mask, count_nonzero_boxes
+from imgtiles import tile_grid, ImageBands, TileWriter
+from imgshard import ShardWriter, SHARD_FORMATS, SHARD_SUFFIX
+from imgmanifest import TilingManifest, file_identity
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
-def get_ground_truth_mask(fn_src1, fn_src2):
-    src1 = cv2.imread(fn_src1, -1) 
-    src2 = cv2.imread(fn_src2, -1)
-    diff = cv2.subtract(src1, src2)
-
-    (B1, G1, R1) = cv2.split(src1)
-    (B2, G2, R2) = cv2.split(src2)
-
-    diffB1 = cv2.subtract(B1, B2)
-    diffG1 = cv2.subtract(G1, G2)
-    diffR1 = cv2.subtract(R1, R2)
-    diffB2 = cv2.subtract(B2, B1)
-    diffG2 = cv2.subtract(G2, G1)
-    diffR2 = cv2.subtract(R2, R1)
-    
-    ret, diffB1 = cv2.threshold(diffB1, 64, 255, cv2.THRESH_BINARY)  
-    ret, diffG1 = cv2.threshold(diffG1, 64, 255, cv2.THRESH_BINARY)  
-    ret, diffR1 = cv2.threshold(diffR1, 64, 255, cv2.THRESH_BINARY)  
-    ret, diffB2 = cv2.threshold(diffB2, 64, 255, cv2.THRESH_BINARY)  
-    ret, diffG2 = cv2.threshold(diffG2, 64, 255, cv2.THRESH_BINARY)  
-    ret, diffR2 = cv2.threshold(diffR2, 64, 255, cv2.THRESH_BINARY)  
-    
-    diff2 = diffB1
-    diff2 = cv2.bitwise_or(diff2, diffG1)
-    diff2 = cv2.bitwise_or(diff2, diffR1)
-    diff2 = cv2.bitwise_or(diff2, diffB2)
-    diff2 = cv2.bitwise_or(diff2, diffG2)
-    diff2 = cv2.bitwise_or(diff2, diffR2)
-    
-    ret, diff = cv2.threshold(diff2, 64, 255, cv2.THRESH_BINARY)  
-    return diff
-
-
 def calculate_two_class_stats(arg_mask_gndt, arg_mask_pred):
     dimensions = mask_gndt.shape
     dimensions_pred = mask_pred.shape
@@ -91,33 +54,72 @@ def calculate_two_class_stats(arg_mask_gndt, arg_mask_pred):
 
 
 
-if len(sys.argv)<3:
+# -w NWorkers, -q JpegQuality, -s ShardFormat and --trace File may be given
+# before the positional arguments.
+n_workers = os.cpu_count()
+jpeg_quality = 95
+shard_format = None
+sys.argv = imgtrace.parse_argv(sys.argv)
+argv = [ sys.argv[0] ]
+i = 1
+while i < len(sys.argv):
+	if sys.argv[i] in ( '-w', '--workers' ) and i + 1 < len(sys.argv):
+		n_workers = int(sys.argv[i + 1])
+		i += 2
+	elif sys.argv[i] in ( '-q', '--quality' ) and i + 1 < len(sys.argv):
+		jpeg_quality = int(sys.argv[i + 1])
+		i += 2
+	elif sys.argv[i] in ( '-s', '--shard' ) and i + 1 < len(sys.argv):
+		shard_format = sys.argv[i + 1]
+		i += 2
+	else:
+		argv.append(sys.argv[i])
+		i += 1
+
+if len(argv)<4:
     sys.stderr.write("FATAL: Insufficient arguments\n\n")
-    sys.stderr.write("Usage: imgsplitbymask.py SourceImage SourceImageLabelledGroundTruth Outdir [Crit|0.95]\n\n")
+    sys.stderr.write("Usage: imgsplitbymask.py [-w NWorkers] [-q JpegQuality] [-s jpg|raw] [--trace File] SourceImage SourceImageLabelledGroundTruth Outdir [Crit|0.95]\n\n")
     sys.exit(1)
 
 
 crit = 0.95
 crit_low = crit
-fn_image_src  = sys.argv[1]
-fn_image_gndt = sys.argv[2]
-dir_image_out = sys.argv[3]
+fn_image_src  = argv[1]
+fn_image_gndt = argv[2]
+dir_image_out = argv[3]
 
-if len(sys.argv)>=5:
-    crit=float(sys.argv[4])
-    crit_low = crit
-if len(sys.argv)>=6:
-    crit_low=float(sys.argv[5])
+if shard_format is not None and shard_format not in SHARD_FORMATS:
+    sys.stderr.write("FATAL: Unknown shard format " + shard_format + "\n\n")
+    sys.exit(1)
 
-src_image = cv2.imread(fn_image_src, -1) 
-mask_gndt = get_ground_truth_mask(fn_image_src, fn_image_gndt)
-ret, mask_gndt = cv2.threshold(mask_gndt, 127, 255, cv2.THRESH_BINARY)
+if len(argv)>=5:
+    crit=float(argv[4])
+    crit_low = crit
+if len(argv)>=6:
+    crit_low=float(argv[5])
+
+imgtrace.set_context(slide=fn_image_src)
+
+# Outdir/.tiles-manifest records the tiles written and the listing, so that
+# a rerun of a slide that is done only prints the listing again, and a rerun
+# of an interrupted slide does not write its tiles twice. The annotated image
+# is part of the params, so relabelling it invalidates the earlier runs.
+params = dict(ground_truth=file_identity(fn_image_gndt), crit=crit, crit_low=crit_low, tile_size=224, stride=1, quality=jpeg_quality, shard=shard_format)
+manifest = TilingManifest(dir_image_out, fn_image_src, "imgsplitbymask.py", params)
+if manifest.done() is not None:
+	eprint(fn_image_src + " : already tiled in " + dir_image_out + " (" + str(manifest.done()['tiles']) + " tiles)")
+	for cls, pnz, rel in manifest.done()['listing']:
+		print( "\t".join( [cls, pnz, os.path.join(dir_image_out, rel)] ) )
+	sys.exit(0)
+
+src_bands = ImageBands(fn_image_src)
+mask_bands = GroundTruthBands(fn_image_src, fn_image_gndt, src_bands)
 
 stride_factor = 1
 tile_w = 224
 tile_h = 224
-img_w = mask_gndt.shape[0]
-img_h = mask_gndt.shape[1]
+img_w = src_bands.height
+img_h = src_bands.width
 
 
 
@@ -131,50 +133,80 @@ img_h_stride = stride_factor * ( 1 - ( ( ( ntiles_h * tile_h - img_h ) / (ntiles
 eprint("Image size " + str(img_w) + "x" + str(img_h) + "(" + str(tile_w) + "x" + str(img_h) +"). Extra " + str(img_w_extra) +"x" + str(img_h_extra) + ". Tiles " + str(ntiles_w) +"x"+ str(ntiles_h) +". Stride "+ str(img_w_stride) +"x"+ str(img_h_stride) +". \n");
 
 
-image_stem = hash_file(fn_image_src);
-
-r=0
-while (r * tile_h) <= img_h:
-	y = math.floor( r * tile_h )
-	if y >= img_h:
-		y = (img_h - tile_h - 1) 
-	
-	c=0
-	while (c * tile_w) <= img_w:
-		x = int( c * tile_w );
-		if x >= img_w:
-			x = (img_w - tile_w - 1)
+with imgtrace.stage('hash'):
+	image_stem = manifest.source_sha()
+
+# As in the loop below, x indexes the rows and y the columns of the image.
+# The source image and the mask are streamed in bands of rows, one band per
+# row of tiles, so that only one band of each is held in memory. Bands run
+# from one row of tiles to the next so that every row of the mask is seen.
+origins = tile_grid(img_w, img_h, tile_w, tile_h, stride_factor)
+band_tiles = {}
+for i, (y, x) in enumerate(origins):
+	band_tiles.setdefault(x, []).append( (i, y) )
+band_x = sorted(band_tiles)
+listing = [ None ] * len(origins)
+
+# With -s, Y and N tiles go to the shard Outdir/<sha>.tiles, labelled by the
+# class column of its index, and are listed as Outdir/<sha>.tiles:<tile name>.
+manifest.begin()
+class_dirs = set()
+fn_shard = os.path.join(dir_image_out, image_stem + SHARD_SUFFIX)
+shard = ShardWriter(fn_shard, shard_format, jpeg_quality) if shard_format is not None else None
+writer = TileWriter(n_workers, jpeg_quality, shard=shard, on_written=manifest.add_tile if shard is None else None)
+n_done = 0
+
+for b, bx in enumerate(band_x):
+	bx1 = band_x[b + 1] if b + 1 < len(band_x) else img_w
+	src_band = src_bands.read_rows(bx, max(bx1, bx + tile_w - 1))
+	mask_band = mask_bands.read_rows(bx, max(bx1, bx + tile_w - 1))
+
+	with imgtrace.timed('crop', len(band_tiles[bx])):
+		ret, mask_band = cv2.threshold(mask_band, 127, 255, cv2.THRESH_BINARY)
+		tile_y = np.array( [ y for (i, y) in band_tiles[bx] ], dtype=np.int64 )
+		tile_nz = count_nonzero_boxes( integral_mask(mask_band), 0, tile_y, tile_w - 1, tile_y + tile_h - 1 )
+
+	for (i, y), nz in zip(band_tiles[bx], tile_nz):
+		x = bx
 		x0 = x
 		y0 = y
 		x1 = x + tile_w - 1
 		y1 = y + tile_h - 1
-		cropped_mask = mask_gndt[ x0:x1, y0:y1 ]
-		nz = cv2.countNonZero( cropped_mask );
 		size = (x1-x0 + 1) * (y1- y0 + 1)
 		pnz = nz / size
 		cls = "Y" if pnz > crit else "N"
 		if (pnz <= crit) and (pnz > crit_low):
 			cls = "?"
 
-		if not os.path.isdir(dir_image_out):
-			os.mkdir(dir_image_out)
-		
-		subdir = os.path.join(dir_image_out, cls)
-		if not os.path.isdir( subdir ):
-			os.mkdir( subdir )
-		
-		out_fn = os.path.join( subdir, "{}-{:04d}-{:04d}.jpg".format(image_stem, y, x) )
-		print ( "\t".join( [cls, "{:.6f}".format(pnz), out_fn] ) )
-		if cls != "?":
-			cropped_image = src_image[ x0:x1, y0:y1 ]
-			cv2.imwrite(out_fn, cropped_image)
-
-		if x + tile_w + 1 >= img_w:
-			break
+		if shard is not None:
+			out_fn = fn_shard + ":" + "{}-{:04d}-{:04d}.jpg".format(image_stem, y, x)
 		else:
-			c += img_w_stride
-	if y + tile_h + 1 >= img_h:
-		break
-	else:
-		r += img_h_stride
-
+			subdir = os.path.join(dir_image_out, cls)
+			if cls not in class_dirs:
+				os.makedirs(subdir, exist_ok=True)
+				class_dirs.add(cls)
+			out_fn = os.path.join( subdir, "{}-{:04d}-{:04d}.jpg".format(image_stem, y, x) )
+
+		listing[i] = [cls, "{:.6f}".format(pnz), out_fn]
+		if cls != "?" and shard is None and manifest.has_tile(out_fn):
+			n_done += 1
+		elif cls != "?":
+			cropped_image = src_band[ 0:x1-x0, y0:y1 ]
+			writer.write(out_fn, cropped_image, dict(sha=image_stem, scale=1.0, y=y, x=x, y1=y + cropped_image.shape[1] - 1, x1=x + cropped_image.shape[0] - 1, cls=cls))
+
+with imgtrace.stage('output', count=len(listing)):
+	mask_bands.close()
+	n_failed = writer.close()
+
+	for line in listing:
+		print ( "\t".join(line) )
+
+if n_done > 0:
+	eprint("Resumed: " + str(n_done) + " tiles already written")
+
+if n_failed > 0:
+	sys.exit(1)
+
+if shard is not None:
+	manifest.add_tile(fn_shard)
+manifest.finish( len(listing), [ [cls, pnz, os.path.relpath(out_fn, dir_image_out)] for cls, pnz, out_fn in listing ] )
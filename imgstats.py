@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+from __future__ import print_function
+
+# Agreement statistics computed from pixel counts instead of flattened
+# per-pixel arrays. Each pixel's votes from N raters are encoded as an N-bit
+# code and the codes are counted chunk by chunk, so memory stays bounded
+# whatever the image size. Cohen's kappa for any pair of raters and Fleiss'
+# kappa for all raters then only need the (code, count) table.
+
+import numpy as np
+
+CHUNK_PIXELS = 1 << 22
+
+MAX_RATERS = 64
+
+
+def code_dtype(n_raters):
+	if n_raters <= 8:
+		return np.uint8
+	if n_raters <= 16:
+		return np.uint16
+	if n_raters <= 32:
+		return np.uint32
+	return np.uint64
+
+
+# masks are arrays of any shape (nonzero = positive vote), or, when n_pixels
+# is given, flat bit-packed votes as returned by np.packbits(mask.ravel() > 0).
+# Returns the codes that occur and how many pixels carry each of them; bit r
+# of a code is the vote of rater r.
+
+def vote_code_counts(masks, n_pixels=None, chunk_pixels=CHUNK_PIXELS):
+	n_raters = len(masks)
+	if n_raters > MAX_RATERS:
+		raise ValueError("at most {} raters are supported".format(MAX_RATERS))
+	dtype = code_dtype(n_raters)
+
+	packed = n_pixels is not None
+	if not packed:
+		masks = [ m.reshape(-1) for m in masks ]
+		n_pixels = masks[0].size
+	chunk_pixels = max( 8, chunk_pixels - chunk_pixels % 8 )
+
+	dense = np.zeros( 1 << n_raters, dtype=np.int64 ) if n_raters <= 16 else None
+	sparse = []
+	for p0 in range(0, n_pixels, chunk_pixels):
+		p1 = min(p0 + chunk_pixels, n_pixels)
+		code = np.zeros( p1 - p0, dtype=dtype )
+		for r, m in enumerate(masks):
+			if packed:
+				votes = np.unpackbits( m[ p0 // 8 : (p1 + 7) // 8 ], count=p1 - p0 )
+			else:
+				votes = m[p0:p1] > 0
+			code |= np.left_shift( votes.astype(dtype), dtype(r) )
+		if dense is not None:
+			dense += np.bincount( code, minlength=len(dense) )
+		else:
+			sparse.append( np.unique(code, return_counts=True) )
+
+	if dense is not None:
+		codes = np.flatnonzero(dense).astype(np.uint64)
+		return codes, dense[codes]
+	return merge_code_counts(sparse)
+
+
+# Sums several (codes, counts) tables, e.g. to pool slides.
+
+def merge_code_counts(tables):
+	if len(tables) == 0:
+		return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+	codes = np.concatenate( [ np.asarray(c, dtype=np.uint64) for c, n in tables ] )
+	counts = np.concatenate( [ np.asarray(n, dtype=np.int64) for c, n in tables ] )
+	codes, inverse = np.unique(codes, return_inverse=True)
+	return codes, np.bincount( inverse.reshape(-1), weights=counts ).astype(np.int64)
+
+
+def rater_votes(codes, r):
+	return ( np.asarray(codes, dtype=np.uint64) >> np.uint64(r) ) & np.uint64(1)
+
+
+def cohen_kappa_from_counts(codes, counts, i, j):
+	table = np.zeros( (2, 2) )
+	np.add.at( table, ( rater_votes(codes, i).astype(np.intp), rater_votes(codes, j).astype(np.intp) ), counts )
+	n = table.sum()
+	p_o = np.trace(table) / n
+	p_e = np.dot( table.sum(axis=1), table.sum(axis=0) ) / (n * n)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		return (p_o - p_e) / (1 - p_e)
+
+
+def fleiss_kappa_from_counts(codes, counts, n_raters):
+	k = sum( rater_votes(codes, r) for r in range(n_raters) ).astype(np.float64)
+	counts = np.asarray(counts, dtype=np.float64)
+	n = n_raters
+	N = counts.sum()
+	p_pos = np.sum(counts * k) / (N * n)
+	P_i = ( k * (k - 1) + (n - k) * (n - k - 1) ) / ( n * (n - 1) )
+	P_bar = np.sum(counts * P_i) / N
+	P_e = p_pos * p_pos + (1 - p_pos) * (1 - p_pos)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		return (P_bar - P_e) / (1 - P_e)
+
+
+# Bits set in every byte value, to count bit-packed pixels.
+POPCOUNT = np.unpackbits( np.arange(256, dtype=np.uint8)[:, None], axis=1 ).sum(axis=1).astype(np.int64)
+
+
+# tp, fn, fp, tn of a predicted mask against a ground truth mask, counted
+# chunk by chunk in one pass without any image-sized temporary. The masks
+# are arrays of the same shape (pixels above thres are positive) or, when
+# n_pixels is given, masks bit-packed the same way, either flat as
+# np.packbits(mask.ravel() > 0) or by row as imgmask.pack_mask; the padding
+# bits are zero in both, so they count as neither. Only the positives and the
+# pixels positive in both are counted, the other cells follow from them.
+
+def confusion_counts(gndt, pred, n_pixels=None, thres=0, chunk_pixels=CHUNK_PIXELS):
+	if gndt.shape != pred.shape:
+		raise ValueError("mask shapes differ: {} and {}".format(gndt.shape, pred.shape))
+	gndt = gndt.reshape(-1)
+	pred = pred.reshape(-1)
+
+	packed = n_pixels is not None
+	if packed:
+		chunk = max( 1, chunk_pixels // 8 )
+	else:
+		chunk = chunk_pixels
+		n_pixels = gndt.size
+
+	n_both = 0
+	n_gndt = 0
+	n_pred = 0
+	for p0 in range(0, gndt.size, chunk):
+		g = gndt[ p0 : p0 + chunk ]
+		p = pred[ p0 : p0 + chunk ]
+		if packed:
+			n_both += int( POPCOUNT[ g & p ].sum() )
+			n_gndt += int( POPCOUNT[g].sum() )
+			n_pred += int( POPCOUNT[p].sum() )
+		else:
+			g = g > thres
+			p = p > thres
+			n_both += np.count_nonzero( g & p )
+			n_gndt += np.count_nonzero(g)
+			n_pred += np.count_nonzero(p)
+
+	n_tp = n_both
+	n_fn = n_gndt - n_both
+	n_fp = n_pred - n_both
+	n_tn = n_pixels - n_gndt - n_pred + n_both
+	return n_tp, n_fn, n_fp, n_tn
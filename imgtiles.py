@@ -0,0 +1,284 @@
+#!/usr/bin/python3
+from __future__ import print_function
+
+# Tile geometry shared by the Python tiling and prediction tools. The grid
+# follows ImageUtils::gen_tiles so that tile names stay compatible with
+# ImageClassifier::predict and imgprob.pl.
+
+import os
+import sys
+import time
+import math
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import imgtrace
+
+try:
+	import pyvips
+except ImportError:
+	pyvips = None
+
+VIPS_DTYPES = {
+	'uchar': np.uint8, 'char': np.int8, 'ushort': np.uint16, 'short': np.int16,
+	'uint': np.uint32, 'int': np.int32, 'float': np.float32, 'double': np.float64,
+}
+
+
+HASH_CHUNK = 4 << 20
+
+
+# First 16 hex digits of the SHA-1 of a file, as ImageUtils::get_file_sha1_b16.
+# The file is read unbuffered into one reused 4 MB buffer.
+
+def hash_file(filename):
+	h = hashlib.sha1()
+	buf = bytearray(HASH_CHUNK)
+	view = memoryview(buf)
+	with open(filename, 'rb', buffering=0) as file:
+		n = file.readinto(buf)
+		while n:
+			h.update(view[:n])
+			n = file.readinto(buf)
+	return h.hexdigest()[0:16]
+
+
+def parse_tile_dim(dim):
+	parts = [ int(d) for d in str(dim).lower().split('x') if len(d) > 0 ]
+	tile_w = parts[0]
+	tile_h = parts[1] if len(parts) > 1 else tile_w
+	return (tile_w, tile_h)
+
+
+def tile_stride(img_size, tile_size, stride_factor=1.0):
+	ntiles = math.ceil( img_size / tile_size )
+	return stride_factor * ( 1 - ( ( ( ntiles * tile_size - img_size ) / ( (ntiles - 1) or 1 ) ) / tile_size ) )
+
+
+# Returns the (y, x) origins of all tiles in row-major order, with the same
+# stride and edge handling as gen_tiles.
+
+def tile_grid(img_w, img_h, tile_w, tile_h, stride_factor=1.0):
+	img_w_stride = tile_stride(img_w, tile_w, stride_factor)
+	img_h_stride = tile_stride(img_h, tile_h, stride_factor)
+
+	origins = []
+	r = 0
+	while r * tile_h <= img_h:
+		y = int( r * tile_h )
+		if y >= img_h:
+			y = img_h - tile_h - 1
+		c = 0
+		while c * tile_w <= img_w:
+			x = int( c * tile_w )
+			if x >= img_w:
+				x = img_w - tile_w - 1
+			origins.append( (max(y, 0), max(x, 0)) )
+			if x + tile_w + 1 >= img_w:
+				break
+			c += img_w_stride
+		if y + tile_h + 1 >= img_h:
+			break
+		r += img_h_stride
+	return origins
+
+
+# Returns a view into img when the tile lies inside the image, otherwise a
+# copy padded with black pixels to the full tile size.
+
+def crop_tile(img, y, x, tile_h, tile_w):
+	tile = img[ y:y + tile_h, x:x + tile_w ]
+	if tile.shape[0] == tile_h and tile.shape[1] == tile_w:
+		return tile
+	return cv2.copyMakeBorder(tile, 0, tile_h - tile.shape[0], 0, tile_w - tile.shape[1], cv2.BORDER_CONSTANT, value=0)
+
+
+# Centres a tile on a black canvas of size_h x size_w, as gen_tiles does when
+# the model input is larger than the tiles (cropping it when smaller).
+
+def pad_tile(tile, size_h, size_w):
+	if tile.shape[0] == size_h and tile.shape[1] == size_w:
+		return tile
+	canvas = np.zeros( (size_h, size_w) + tile.shape[2:], dtype=tile.dtype )
+	dy = ( size_h - tile.shape[0] ) // 2
+	dx = ( size_w - tile.shape[1] ) // 2
+	sy = max(-dy, 0)
+	sx = max(-dx, 0)
+	h = min( tile.shape[0] - sy, size_h - max(dy, 0) )
+	w = min( tile.shape[1] - sx, size_w - max(dx, 0) )
+	canvas[ max(dy, 0):max(dy, 0) + h, max(dx, 0):max(dx, 0) + w ] = tile[ sy:sy + h, sx:sx + w ]
+	return canvas
+
+
+def scaled_size(img_w, img_h, scale):
+	return ( max( 1, int(round(img_w * scale)) ), max( 1, int(round(img_h * scale)) ) )
+
+
+# Yields (scale, image) for every scale of an image already in memory, from
+# the largest scale down. A downscaled level is resized with area
+# interpolation from the smallest level already built that is an integer
+# multiple of it (e.g. 0.25 from 0.5), which averages the same pixels as
+# resizing the full image, so a pyramid of halvings costs little more than its
+# first level. Other scales are resized from the full image. Scale 1.0 is the
+# image itself; scales above 1.0 are enlarged from it.
+
+def pyramid_levels(img, scales):
+	img_h, img_w = img.shape[0:2]
+	levels = { 1.0: img }
+	for scale in sorted( set(scales), reverse=True ):
+		if scale == 1.0:
+			yield scale, img
+			continue
+		with imgtrace.timed('resize'):
+			if scale > 1.0:
+				level = cv2.resize( img, scaled_size(img_w, img_h, scale), interpolation=cv2.INTER_CUBIC )
+			else:
+				base = min( [ s for s in levels if abs( s / scale - round(s / scale) ) < 1e-6 ], default=1.0 )
+				level = cv2.resize( levels[base], scaled_size(img_w, img_h, scale), interpolation=cv2.INTER_AREA )
+				levels[scale] = level
+		yield scale, level
+
+
+# Inclusive box (y, x, y1, x1) in original pixels of a tile cut at (y, x) from
+# the image scaled by scale.
+
+def tile_box(scale, y, x, tile_h, tile_w):
+	orig_y = int( y / scale )
+	orig_x = int( x / scale )
+	return ( orig_y, orig_x, orig_y + int( tile_h / scale ) - 1, orig_x + int( tile_w / scale ) - 1 )
+
+
+def tile_name(stem, scale, y, x, tile_h, tile_w, ext="jpg", zsuffix=""):
+	orig_y, orig_x, orig_y1, orig_x1 = tile_box(scale, y, x, tile_h, tile_w)
+	return "{}{}-{:.3f}x-{:04d}-{:04d}-{:04d}-{:04d}.{}".format(stem, zsuffix, scale, orig_y, orig_x, orig_y1, orig_x1, ext)
+
+
+# Reads an image in horizontal bands of rows, with the same channels and depth
+# as cv2.imread(fn, -1). With pyvips installed, tiled and striped TIFFs are
+# read by region, so only the current band is held in memory (other formats
+# are decoded by libvips, to a temporary file when large); otherwise the
+# image is decoded at once and bands are views into it. Rows still buffered from the previous band are not
+# read again, so bands must be requested from top to bottom.
+
+class ImageBands:
+	def __init__(self, fn):
+		self.img = None
+		self.vimg = None
+		if pyvips is not None:
+			try:
+				self.vimg = pyvips.Image.new_from_file(fn, access='random')
+			except pyvips.Error:
+				self.vimg = None
+		if self.vimg is not None:
+			self.height = self.vimg.height
+			self.width = self.vimg.width
+		else:
+			with imgtrace.timed('decode'):
+				self.img = cv2.imread(fn, -1)
+			if self.img is None:
+				raise IOError("cannot read image " + fn)
+			self.height = self.img.shape[0]
+			self.width = self.img.shape[1]
+		self.buf = None
+		self.buf_r0 = 0
+
+	def read_vips_rows(self, r0, r1):
+		region = self.vimg.crop(0, r0, self.width, r1 - r0)
+		with imgtrace.timed('decode'):
+			rows = np.ndarray( buffer=region.write_to_memory(), dtype=VIPS_DTYPES[region.format], shape=(r1 - r0, self.width, region.bands) )
+		if region.bands == 1:
+			return rows[:, :, 0]
+		if region.bands == 2:
+			return np.dstack( (rows[:, :, 0], rows[:, :, 0], rows[:, :, 0], rows[:, :, 1]) )
+		if region.bands == 3:
+			return np.ascontiguousarray( rows[:, :, ::-1] )
+		return np.ascontiguousarray( rows[:, :, [2, 1, 0, 3]] )
+
+	def read_rows(self, r0, r1):
+		r1 = min(r1, self.height)
+		if self.img is not None:
+			return self.img[r0:r1]
+
+		buf_r1 = self.buf_r0 + ( len(self.buf) if self.buf is not None else 0 )
+		if self.buf is not None and r0 >= self.buf_r0 and r1 <= buf_r1:
+			return self.buf[ r0 - self.buf_r0 : r1 - self.buf_r0 ]
+		if self.buf is None or r0 < self.buf_r0 or r0 > buf_r1:
+			self.buf = self.read_vips_rows(r0, r1)
+		else:
+			self.buf = np.concatenate( ( self.buf[ r0 - self.buf_r0 : ], self.read_vips_rows(buf_r1, r1) ) )
+		self.buf_r0 = r0
+		return self.buf
+
+
+# Encodes and writes tiles in a pool of threads; OpenCV releases the GIL while
+# encoding, so the encodes run on all cores. At most 4 tiles per thread are
+# queued, so memory stays bounded when the caller produces crops faster than
+# they are written. With a shard (imgshard.ShardWriter), tiles are appended
+# to it with the index fields in meta instead of being written to fn.
+# on_written(fn), if given, is called from the writing thread for every tile
+# written successfully. Progress and throughput go to stderr.
+
+class TileWriter:
+	def __init__(self, n_workers=None, quality=95, total=None, label="tiles", shard=None, on_written=None):
+		self.n_workers = n_workers or os.cpu_count() or 1
+		self.params = [ cv2.IMWRITE_JPEG_QUALITY, int(quality) ]
+		self.total = total
+		self.label = label
+		self.shard = shard
+		self.on_written = on_written
+		self.pool = ThreadPoolExecutor(self.n_workers)
+		self.slots = threading.BoundedSemaphore(4 * self.n_workers)
+		self.lock = threading.Lock()
+		self.n_written = 0
+		self.n_failed = 0
+		self.t0 = time.time()
+		self.t_report = self.t0
+
+	def write(self, fn, tile, meta=None):
+		self.slots.acquire()
+		try:
+			seq = self.shard.reserve() if self.shard is not None else None
+			self.pool.submit(self.write_tile, fn, tile, seq, meta)
+		except Exception:
+			self.slots.release()
+			raise
+
+	def write_tile(self, fn, tile, seq=None, meta=None):
+		try:
+			with imgtrace.timed('write'):
+				if self.shard is not None:
+					ok = self.shard.add(seq, tile, **meta)
+				else:
+					ok = cv2.imwrite(fn, tile, self.params)
+		except cv2.error:
+			ok = False
+		finally:
+			self.slots.release()
+		if ok and self.on_written is not None:
+			self.on_written(fn)
+		with self.lock:
+			self.n_written += 1
+			if not ok:
+				self.n_failed += 1
+				sys.stderr.write("Failed to write " + fn + "\n")
+			t = time.time()
+			if t - self.t_report >= 1:
+				self.t_report = t
+				self.report(t)
+
+	def report(self, t):
+		total = "/" + str(self.total) if self.total is not None else ""
+		sys.stderr.write("{}{} {} written, {:.1f} {}/sec\n".format(self.n_written, total, self.label, self.n_written / max(t - self.t0, 1e-6), self.label))
+
+	# Waits for the queued tiles and returns the number that could not be written.
+
+	def close(self):
+		self.pool.shutdown(wait=True)
+		if self.shard is not None:
+			self.shard.close()
+		self.report(time.time())
+		return self.n_failed
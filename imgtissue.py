@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+from __future__ import print_function
+
+# Tissue detection on a low-resolution thumbnail, so that tiles of blank
+# background are dropped before they are cut, encoded or scored. A thumbnail
+# pixel is tissue when it is coloured (saturation) or darker than the white
+# background, but not the black border some scanners leave around the slide.
+# The tissue fraction of every tile is then one summed-area table lookup.
+
+import cv2
+import numpy as np
+
+from imgmask import integral_mask, count_nonzero_boxes
+
+try:
+	import pyvips
+except ImportError:
+	pyvips = None
+
+THUMB_SIZE = 2048
+
+SAT_THRESHOLD = 20
+
+WHITE_THRESHOLD = 220
+
+DARK_THRESHOLD = 25
+
+
+def to_bgr8(img):
+	if img.dtype == np.uint16:
+		img = ( img >> 8 ).astype(np.uint8)
+	elif img.dtype != np.uint8:
+		img = cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+	if img.ndim == 2:
+		return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+	if img.shape[2] == 4:
+		return cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+	return img
+
+
+# Downscales an image already in memory so that its longer side is at most
+# max_size pixels.
+
+def thumbnail(img, max_size=THUMB_SIZE):
+	scale = min( 1.0, max_size / max(img.shape[0], img.shape[1]) )
+	if scale < 1.0:
+		img = cv2.resize( img, ( max(1, round(img.shape[1] * scale)), max(1, round(img.shape[0] * scale)) ), interpolation=cv2.INTER_AREA )
+	return to_bgr8(img)
+
+
+# Thumbnail of an image file without decoding it at full resolution when
+# pyvips is installed (it shrinks on load and uses TIFF pyramids); otherwise
+# the image is decoded with OpenCV, at 1/8 scale for JPEGs.
+
+def load_thumbnail(fn, max_size=THUMB_SIZE):
+	if pyvips is not None:
+		try:
+			thumb = pyvips.Image.thumbnail(fn, max_size, height=max_size, size='down')
+			if thumb.format != 'uchar':
+				thumb = thumb.cast('uchar', shift=(thumb.format == 'ushort'))
+			img = np.ndarray( buffer=thumb.write_to_memory(), dtype=np.uint8, shape=(thumb.height, thumb.width, thumb.bands) )
+			if thumb.bands >= 3:
+				img = img[:, :, [2, 1, 0]]
+			else:
+				img = img[:, :, 0]
+			return thumbnail( np.ascontiguousarray(img), max_size )
+		except pyvips.Error:
+			pass
+	img = cv2.imread(fn, cv2.IMREAD_REDUCED_COLOR_8) if fn.lower().endswith( ('.jpg', '.jpeg') ) else cv2.imread(fn, -1)
+	if img is None:
+		raise IOError("cannot read image " + fn)
+	return thumbnail(img, max_size)
+
+
+def tissue_mask(thumb, sat_thres=SAT_THRESHOLD, white_thres=WHITE_THRESHOLD, dark_thres=DARK_THRESHOLD):
+	hsv = cv2.cvtColor(thumb, cv2.COLOR_BGR2HSV)
+	darkest = thumb.min(axis=2)
+	brightest = hsv[:, :, 2]
+	tissue = ( ( hsv[:, :, 1] > sat_thres ) | ( darkest < white_thres ) ) & ( brightest > dark_thres )
+	return np.where(tissue, np.uint8(255), np.uint8(0))
+
+
+# Fraction of tissue in each box [r0, r1) x [c0, c1) given in full-resolution
+# pixels of an image of img_rows x img_cols. The boxes may be NumPy arrays;
+# each is mapped to the thumbnail pixels it overlaps.
+
+def tissue_fractions(mask, img_rows, img_cols, r0, c0, r1, c1):
+	sr = mask.shape[0] / img_rows
+	sc = mask.shape[1] / img_cols
+	tr0 = np.floor( np.asarray(r0) * sr ).astype(np.int64)
+	tc0 = np.floor( np.asarray(c0) * sc ).astype(np.int64)
+	tr1 = np.maximum( np.ceil( np.asarray(r1) * sr ).astype(np.int64), tr0 + 1 )
+	tc1 = np.maximum( np.ceil( np.asarray(c1) * sc ).astype(np.int64), tc0 + 1 )
+	nz = count_nonzero_boxes( integral_mask(mask), tr0, tc0, tr1, tc1 )
+	area = ( np.minimum(tr1, mask.shape[0]) - np.minimum(tr0, mask.shape[0]) ) * ( np.minimum(tc1, mask.shape[1]) - np.minimum(tc0, mask.shape[1]) )
+	return nz / np.maximum(area, 1)
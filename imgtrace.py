@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+from __future__ import print_function
+
+# Opt-in timing of the processing stages of the Python tools, written as JSON
+# lines. Set IMGTRACE to a file (or "-" for stderr), or pass --trace FILE to a
+# tool, and records are appended to it, one JSON object per line:
+#
+#   {"time": ..., "tool": "imgsplit.py", "host": ..., "pid": ..., "stage": "decode",
+#    "seconds": 1.52, "count": 12, "calls": 12, "slide": ..., "peak_rss_mb": 143.2}
+#
+# Stages timed once (stage) are written when they end. Stages timed per tile
+# or per batch (timed) are summed and written once per stage when the process
+# exits or flush() is called, with the number of calls; their seconds are
+# summed over threads. The fields set by set_context, e.g. the slide, are
+# added to every record, so the records of many tools and slides can go to
+# one file. With IMGTRACE_PROFILE=FILE the process also runs under cProfile
+# and its stats are dumped to FILE at exit. When tracing is off, stage and
+# timed cost a function call.
+
+import os
+import sys
+import json
+import time
+import atexit
+import socket
+import resource
+import threading
+import cProfile
+from contextlib import contextmanager
+
+sink = None
+profiler = None
+context = {}
+totals = {}
+lock = threading.Lock()
+tool = os.path.basename(sys.argv[0]) if len(sys.argv) > 0 and sys.argv[0] else "python"
+host = socket.gethostname()
+
+
+def enable(fn_sink, fn_profile=None):
+	global sink, profiler
+	if not fn_sink or sink is not None:
+		return
+	sink = sys.stderr if fn_sink == '-' else open(fn_sink, 'a')
+	atexit.register(flush)
+	if fn_profile:
+		profiler = cProfile.Profile()
+		profiler.enable()
+		atexit.register(dump_profile, fn_profile)
+
+
+def enabled():
+	return sink is not None
+
+
+# Removes --trace FILE from a command line and enables tracing to FILE.
+
+def parse_argv(argv):
+	out = []
+	i = 0
+	while i < len(argv):
+		if argv[i] == '--trace' and i + 1 < len(argv):
+			enable( argv[i + 1], os.environ.get('IMGTRACE_PROFILE') )
+			i += 2
+			continue
+		out.append(argv[i])
+		i += 1
+	return out
+
+
+def set_context(**fields):
+	context.update(fields)
+
+
+def peak_rss_mb():
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def emit(stage_name, seconds, count=None, **fields):
+	if sink is None:
+		return
+	record = { 'time': round(time.time(), 3), 'tool': tool, 'host': host, 'pid': os.getpid(), 'stage': stage_name, 'seconds': round(seconds, 6) }
+	if count is not None:
+		record['count'] = count
+	record.update(context)
+	record.update(fields)
+	record['peak_rss_mb'] = round(peak_rss_mb(), 1)
+	line = json.dumps(record, default=str) + "\n"
+	with lock:
+		sink.write(line)
+		sink.flush()
+
+
+# Times the block as one record. The block may set 'count' and other fields
+# in the dict it gets.
+
+@contextmanager
+def stage(stage_name, **fields):
+	if sink is None:
+		yield fields
+		return
+	t0 = time.perf_counter()
+	try:
+		yield fields
+	finally:
+		emit(stage_name, time.perf_counter() - t0, **fields)
+
+
+def add(stage_name, seconds, count=1):
+	with lock:
+		total = totals.setdefault(stage_name, [ 0.0, 0, 0 ])
+		total[0] += seconds
+		total[1] += count
+		total[2] += 1
+
+
+# Times the block and adds it to the total of the stage.
+
+@contextmanager
+def timed(stage_name, count=1):
+	if sink is None:
+		yield
+		return
+	t0 = time.perf_counter()
+	try:
+		yield
+	finally:
+		add(stage_name, time.perf_counter() - t0, count)
+
+
+def flush():
+	with lock:
+		pending = sorted( totals.items() )
+		totals.clear()
+	for stage_name, (seconds, count, calls) in pending:
+		emit(stage_name, seconds, count, calls=calls)
+
+
+def dump_profile(fn_profile):
+	profiler.disable()
+	profiler.dump_stats(fn_profile)
+
+
+enable( os.environ.get('IMGTRACE'), os.environ.get('IMGTRACE_PROFILE') )
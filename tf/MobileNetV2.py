@@ -2,21 +2,34 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import os
+import re
 import sys
+import signal
+import fcntl
+import hashlib
+import tempfile
+import time
+
+startup_t0 = time.time()
+
+import random
+import socket
+import subprocess
+import contextlib
+import cv2
 import numpy as np
-import pandas as pd
 import pathlib
 
-import tensorflow as tf
-import tensorflow_hub as hub
+import shutil
 import multiprocessing as mp
 
-from sklearn.utils import class_weight
-
-from tensorflow.keras.callbacks import EarlyStopping, ModelCheckpoint
-from keras_preprocessing.image import ImageDataGenerator
-
-tf.executing_eagerly()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import imgtiles
+import imgshard
+import imgtissue
+import imgtrace
+import imgpredcache
 
 
 from optparse import OptionParser
@@ -24,12 +37,22 @@ from optparse import OptionParser
 parser = OptionParser()
 
 parser.usage = "%prog [options] train filename.model img_data_dir\n\
-       %prog [options] predict filename.model image_file image_file ...\n\
+       %prog [options] train filename.model shard.tiles shard.tiles ...\n\
+       %prog [options] predict filename.model image_file|shard.tiles image_file|shard.tiles ...\n\
+       %prog [options] serve filename.model\n\
+       %prog [options] predict-slide filename.model image_file image_file ...\n\
+       %prog [options] tune filename.model image_file image_file ...\n\
+       %prog [options] export filename.model filename.tflite [image_file image_file ...]\n\
+       %prog [options] fetch-arch hub_dir\n\
 "
 parser.add_option("-l", "--hidden-layers", dest="hidden_layers", default="",
                   help="hiddern layers structure 3,4,6,... before the final softmax layer [default: %default]", metavar="LAYERS")
 parser.add_option("-a", "--arch", dest="arch", default="google/tf2-preview/mobilenet_v2/feature_vector/4",
-                  help="Model architecture [default: %default]", metavar="")
+                  help="Model architecture: a TensorFlow Hub feature vector, or keras/mobilenet_v2 for the Keras MobileNetV2 with its pooling layer exposed, which predict-slide --dense can split [default: %default]", metavar="")
+parser.add_option("-H", "--hub-dir", dest="hub_dir", default=os.environ.get('TFIMGCLF_HUB_DIR', ''),
+                  help="Load architectures from the SavedModels in DIR/ARCH instead of tfhub.dev [default: $TFIMGCLF_HUB_DIR]", metavar="DIR")
+parser.add_option("-F", "--save-format", dest="save_format", default="h5", type="choice", choices=[ "h5", "tf" ],
+                  help="train: save the model as one HDF5 file (h5) or as a self-contained SavedModel directory (tf) [default: %default]", metavar="FORMAT")
 parser.add_option("-c", "--class-labels-file", dest="fn_class_label", default="",
                   help="Export the labels corresponding to trained model to FILE [default: model_name.labels]", metavar="FILE")
 parser.add_option("-s", "--validation-split", dest="validation_split", default=0.2,
@@ -37,22 +60,66 @@ parser.add_option("-s", "--validation-split", dest="validation_split", default=0
 parser.add_option("-r", "--learning-rate", dest="learning_rate", default=0.01,
                   help="Learning rate of Adam optimizer [default: %default]", metavar="FRAC")
 parser.add_option("-b", "--batch-size", dest="batch_size", default=24,
-                  help="Batch size of N used durign training [default: %default]", metavar="N")
+                  help="Batch size of N used during training and prediction [default: %default]", metavar="N")
 parser.add_option("-e", "--epochs", dest="epochs", default=10,
                   help="Training the network with N epochs [default: %default]", metavar="N")
 parser.add_option("-p", "--patience", dest="patience", default=3,
                   help="Early stopping after N epochs [default: %default]", metavar="N")
 parser.add_option("-t", "--trainable", dest="trainable", default=False,
                   help="The network is trainable", action="store_true")
+parser.add_option("-C", "--cache", dest="cache", default="memory",
+                  help="train: cache decoded tiles in memory, in FILE on local disk, or none [default: %default]", metavar="FILE")
+parser.add_option("-E", "--embedding-cache", dest="embedding_cache", default="",
+                  help="train: with a frozen backbone, fit only the head on feature vectors cached in DIR", metavar="DIR")
+parser.add_option("-K", "--augmented-views", dest="augmented_views", default=0,
+                  help="train: with -E, also cache and train on N augmented views of each tile [default: %default]", metavar="N")
 parser.add_option("-A", "--augmentation", dest="augmentation", default="FZRC",
                   help="Augmentation options: Flip, Zoom, Translate, Rotate, Contrast [default: %default] " )
+parser.add_option("-w", "--workers", dest="workers", default=1,
+                  help="Number of worker processes forked by serve, each loading the model [default: %default]", metavar="N")
+parser.add_option("-S", "--socket", dest="socket", default="",
+                  help="serve: listen on Unix socket FILE instead of stdin/stdout", metavar="FILE")
+parser.add_option("-T", "--tile-size", dest="tile_size", default="224",
+                  help="predict-slide: split the image into tiles of WxH pixels [default: %default]", metavar="WxH")
+parser.add_option("-d", "--tile-stride", dest="tile_stride", default=1.0,
+                  help="predict-slide: tile stride as a fraction of the tile size [default: %default]", metavar="FRAC")
+parser.add_option("-m", "--min-tissue", dest="min_tissue", default=0.0,
+                  help="predict-slide: skip tiles with less than FRAC of tissue in the slide thumbnail [default: %default]", metavar="FRAC")
+parser.add_option("--dense", dest="dense", default=False, action="store_true",
+                  help="predict-slide: run the backbone once over regions of the slide and pool every tile from its feature map, instead of running each tile through the whole model")
+parser.add_option("--dense-region", dest="dense_region", default=2048,
+                  help="predict-slide --dense: size of the regions the backbone is run on, in model input pixels [default: %default]", metavar="PIXELS")
+parser.add_option("--dense-check", dest="dense_check", default=32,
+                  help="predict-slide --dense: also run N tiles of each slide through the whole model and report the difference on stderr [default: %default]", metavar="N")
+parser.add_option("-i", "--intra-op-threads", dest="intra_op_threads", default=0,
+                  help="Threads used within each operation (TensorFlow, OpenCV and input pipeline) [default: all cores]", metavar="N")
+parser.add_option("-j", "--inter-op-threads", dest="inter_op_threads", default=0,
+                  help="Operations run concurrently by TensorFlow [default: all cores]", metavar="N")
+parser.add_option("--tune-sample", dest="tune_sample", default=512,
+                  help="tune: number of tiles benchmarked per configuration [default: %default]", metavar="N")
+parser.add_option("--tune-output", dest="tune_output", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mlev_config.local'),
+                  help="tune: save the best configuration to FILE [default: mlev_config.local]", metavar="FILE")
+parser.add_option("--quantize", dest="quantize", default="dynamic", type="choice", choices=[ "none", "dynamic", "int8" ],
+                  help="export: TFLite quantization, none, dynamic (int8 weights) or int8 (weights and activations, calibrated on the images) [default: %default]", metavar="MODE")
+parser.add_option("--calibration-size", dest="calibration_size", default=200,
+                  help="export: number of images used to calibrate int8 quantization; the other images are held out for the parity report [default: %default]", metavar="N")
+parser.add_option("-P", "--prediction-cache", dest="prediction_cache", default=os.environ.get('TFIMGCLF_PREDICTION_CACHE', ''),
+                  help="predict, predict-slide, serve: reuse the predictions of tiles already scored by the same model, kept in the SQLite FILE on local disk [default: $TFIMGCLF_PREDICTION_CACHE]", metavar="FILE")
+parser.add_option("--prediction-cache-size", dest="prediction_cache_size", default=1024,
+                  help="Evict the least recently used predictions when the prediction cache exceeds MB [default: %default]", metavar="MB")
+parser.add_option("--trace", dest="trace", default="",
+                  help="Append JSON lines with the time of each stage (model load, decode, inference, output) to FILE, or - for stderr [default: $IMGTRACE]", metavar="FILE")
+parser.add_option("--startup-time", dest="startup_time", default=False, action="store_true",
+                  help="Report the time taken by the imports, loading the model and the first predictions on stderr")
 parser.add_option("-q", "--quiet",
                   action="store_false", dest="verbose", default=True,
                   help="don't print status messages to stdout")
 
 (options, args) = parser.parse_args()
 
-if len(args) < 3:
+imgtrace.enable( options.trace, os.environ.get('IMGTRACE_PROFILE') )
+
+if len(args) < 2 or ( args[0] not in ( 'serve', 'fetch-arch' ) and len(args) < 3 ):
 	print(options);
 	print(args);
 	parser.error("Wrong number of arguments")
@@ -61,7 +128,6 @@ if len(args) < 3:
 action    = args[0]
 fn_model  = args[1]
 
-feature_extractor_model = "https://tfhub.dev/" + options.arch
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
@@ -74,44 +140,1036 @@ if options.arch == "inception_v3":
 	img_height = 299
 	img_width = 299
 
+
+# Thread budget of this process; with several prediction processes per host
+# the product of processes and threads should not exceed the cores.
+
+intra_op_threads = int(options.intra_op_threads)
+inter_op_threads = int(options.inter_op_threads)
+
+if intra_op_threads > 0:
+	cv2.setNumThreads(intra_op_threads)
+
+
+def report_startup(stage):
+	if options.startup_time:
+		eprint("startup: {} {:.3f}s".format(stage, time.time() - startup_t0))
+
+
+# TensorFlow, TensorFlow Hub and scikit-learn take seconds to import, so they
+# are only imported once the arguments have been checked, by the actions that
+# use them; hub is not needed to predict with a SavedModel or a tflite model.
+
+tf = None
+hub = None
+
+def import_tensorflow(with_hub=False):
+	global tf, hub
+	if tf is None:
+		import tensorflow
+		tf = tensorflow
+		if intra_op_threads > 0:
+			tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+		if inter_op_threads > 0:
+			tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+	if with_hub and hub is None:
+		import tensorflow_hub
+		hub = tensorflow_hub
+	report_startup("imports")
+
+
+# Maps a hub handle (an arch name, a tfhub.dev URL or the path it was loaded
+# from when the model was trained) to the SavedModel of that arch in the
+# --hub-dir directory, so that nothing is downloaded. Without --hub-dir the
+# tfhub.dev URL is returned.
+
+def resolve_hub_handle(handle):
+	if os.path.isfile( os.path.join(handle, 'saved_model.pb') ):
+		return handle
+	parts = re.sub(r'^https?://tfhub\.dev/', '', handle).strip('/').split('/')
+	if not options.hub_dir:
+		return "https://tfhub.dev/" + "/".join(parts)
+	for i in range( len(parts) ):
+		local = os.path.join( options.hub_dir, *parts[i:] )
+		if os.path.isfile( os.path.join(local, 'saved_model.pb') ):
+			return local
+	eprint("Architecture " + handle + " not found in " + options.hub_dir + "; run fetch-arch on a host with network access")
+	sys.exit(1)
+
+
+def local_keras_layer(handle, **kwargs):
+	return hub.KerasLayer( resolve_hub_handle(handle), **kwargs )
+
+
+# Backbones built from tf.keras.applications instead of a hub layer. They
+# take inputs of any size and are followed by a GlobalAveragePooling2D layer
+# of their own, so that predict-slide --dense can run them on whole regions.
+# Their ImageNet weights are saved by fetch-arch as DIR/ARCH/weights.h5.
+
+KERAS_ARCHS = { 'keras/mobilenet_v2': 'MobileNetV2' }
+
+
+def keras_arch_weights(arch):
+	if not options.hub_dir:
+		return 'imagenet'
+	fn_weights = os.path.join( options.hub_dir, *arch.split('/'), 'weights.h5' )
+	if not os.path.isfile(fn_weights):
+		eprint("Architecture " + arch + " not found in " + options.hub_dir + "; run fetch-arch on a host with network access")
+		sys.exit(1)
+	return fn_weights
+
+
+def keras_arch_backbone(arch, weights):
+	return getattr( tf.keras.applications, KERAS_ARCHS[arch] )( input_shape=(None, None, 3), include_top=False, weights=weights )
+
+
+# Layers mapping a tile to its feature vector. The Keras applications expect
+# inputs in [-1, 1] rather than [0, 1].
+
+def feature_extractor_layers(trainable):
+	if options.arch in KERAS_ARCHS:
+		base = keras_arch_backbone( options.arch, keras_arch_weights(options.arch) )
+		base.trainable = trainable
+		return [ tf.keras.layers.experimental.preprocessing.Rescaling( 2.0, offset=-1.0, input_shape=(img_height, img_width, 3) ), base, tf.keras.layers.GlobalAveragePooling2D() ]
+	return [ hub.KerasLayer( resolve_hub_handle(options.arch), input_shape=(img_width, img_height, 3), trainable=trainable ) ]
+
+
+def with_thread_budget(ds):
+	if intra_op_threads > 0:
+		ds_options = tf.data.Options()
+		ds_options.threading.private_threadpool_size = intra_op_threads
+		ds = ds.with_options(ds_options)
+	return ds
+
+
+# TFLite backend with the same predict, predict_on_batch and output_shape as
+# a Keras model, so that every action can run on an exported .tflite model.
+# The builtin op resolver applies the XNNPACK delegate to float and
+# quantized CPU kernels.
+
+class TFLiteModel:
+	def __init__(self, fn_model):
+		self.interpreter = tf.lite.Interpreter( model_path=fn_model,
+			num_threads=intra_op_threads if intra_op_threads > 0 else os.cpu_count(),
+			experimental_op_resolver_type=tf.lite.experimental.OpResolverType.BUILTIN )
+		self.input = self.interpreter.get_input_details()[0]
+		self.output = self.interpreter.get_output_details()[0]
+		self.output_shape = ( None, int(self.output['shape'][-1]) )
+		self.batch_size = None
+
+	def predict_on_batch(self, batch):
+		batch = np.asarray(batch, dtype=np.float32)
+		if self.batch_size != len(batch):
+			self.interpreter.resize_tensor_input( self.input['index'], [ len(batch) ] + list(batch.shape[1:]) )
+			self.interpreter.allocate_tensors()
+			self.input = self.interpreter.get_input_details()[0]
+			self.output = self.interpreter.get_output_details()[0]
+			self.batch_size = len(batch)
+		if self.input['dtype'] != np.float32:
+			scale, zero_point = self.input['quantization']
+			batch = np.round( batch / scale + zero_point ).astype( self.input['dtype'] )
+		self.interpreter.set_tensor(self.input['index'], batch)
+		self.interpreter.invoke()
+		out = self.interpreter.get_tensor(self.output['index'])
+		if self.output['dtype'] != np.float32:
+			scale, zero_point = self.output['quantization']
+			out = ( out.astype(np.float32) - zero_point ) * scale
+		return out
+
+	def predict(self, ds):
+		predictions = [ np.zeros( (0, self.output_shape[1]), dtype=np.float32 ) ]
+		for batch in ds.as_numpy_iterator():
+			predictions.append( self.predict_on_batch(batch) )
+		return np.concatenate(predictions)
+
+
+# With a prediction cache the model is only loaded when a tile is missing
+# from the cache, so rescoring cached slides does not start TensorFlow.
+
+class LazyModel:
+	def __init__(self, fn_model):
+		self.fn_model = fn_model
+		self.model = None
+
+	def __getattr__(self, name):
+		if self.model is None:
+			self.model = load_predict_model(self.fn_model)
+		return getattr(self.model, name)
+
+
+pred_cache = None
+
+def open_prediction_cache(fn_model):
+	global pred_cache
+	if options.prediction_cache:
+		with imgtrace.stage('hash', model=fn_model):
+			model_sha = imgpredcache.model_hash(fn_model)
+		pred_cache = imgpredcache.PredictionCache(options.prediction_cache, model_sha, float(options.prediction_cache_size))
+	return pred_cache
+
+
+# Runs predict_missing(indices) on the tiles whose keys are not in the
+# prediction cache and returns the predictions of all keys in order.
+
+def cached_predict(keys, predict_missing):
+	if pred_cache is None or len(keys) == 0:
+		return predict_missing( list( range(len(keys)) ) )
+	with imgtrace.stage('cache', count=len(keys)) as rec:
+		found = pred_cache.lookup(keys)
+		rec['hits'] = sum( 1 for k in keys if k in found )
+	return pred_cache.predict(keys, predict_missing, found)
+
+
+def close_prediction_cache():
+	if pred_cache is not None:
+		eprint( pred_cache.report() )
+		pred_cache.close()
+
+
+# A SavedModel directory written by train -F tf carries the backbone and loads
+# without tensorflow_hub; an HDF5 model rebuilds its hub layer from the arch,
+# which is resolved in --hub-dir.
+
+def load_predict_model(fn_model):
+	is_h5 = not fn_model.endswith('.tflite') and not os.path.isdir(fn_model)
+	with imgtrace.stage('model_load', model=fn_model):
+		import_tensorflow(with_hub=is_h5)
+		tf.config.set_visible_devices([], 'GPU')
+		if fn_model.endswith('.tflite'):
+			model = TFLiteModel(fn_model)
+		elif is_h5:
+			model = tf.keras.models.load_model(fn_model, custom_objects={'KerasLayer':local_keras_layer}, compile=False)
+		else:
+			model = tf.keras.models.load_model(fn_model, compile=False)
+	report_startup("model")
+	return model
+
+
+PREDICT_EXTENSIONS = ( '.png', '.jpg', '.jpeg', '.bmp', '.ppm', '.tif', '.tiff' )
+
+
+def read_image_rgb(fn):
+	img = cv2.imread(fn.decode(), cv2.IMREAD_COLOR)
+	return np.ascontiguousarray( img[:, :, ::-1] )
+
+
+# Decodes an image as keras load_img does: RGB, JPEGs with the accurate
+# integer DCT, nearest-neighbour resize to the model input size. TIFF and PPM
+# are not decoded by TensorFlow and go through OpenCV.
+
+def load_predict_image(fn):
+	def decode():
+		raw = tf.io.read_file(fn)
+		return tf.cond( tf.io.is_jpeg(raw),
+			lambda: tf.io.decode_jpeg(raw, channels=3, dct_method='INTEGER_ACCURATE'),
+			lambda: tf.io.decode_image(raw, channels=3, expand_animations=False) )
+
+	def decode_cv2():
+		return tf.numpy_function(read_image_rgb, [fn], tf.uint8)
+
+	img = tf.cond( tf.strings.regex_full_match( tf.strings.lower(fn), r'.*\.(tiff?|ppm)' ), decode_cv2, decode )
+	img.set_shape( [ None, None, 3 ] )
+	img = tf.image.resize(img, (img_height, img_width), method=tf.image.ResizeMethod.NEAREST_NEIGHBOR)
+	return tf.cast(img, tf.float32) * (1./255.)
+
+
+# One row of predictions per image, in the order given. Images are decoded
+# and resized by parallel calls and prefetched while the model runs. Like
+# flow_from_dataframe, files that do not exist or are not images are skipped.
+
+def predict_images(loaded_model, images_to_test, batch_size=None):
+	batch_size = batch_size or int(options.batch_size)
+	valid = [ fn for fn in images_to_test if fn.lower().endswith(PREDICT_EXTENSIONS) and os.path.isfile(fn) ]
+	if len(valid) < len(images_to_test):
+		eprint("Skipped " + str(len(images_to_test) - len(valid)) + " of " + str(len(images_to_test)) + " images that do not exist or are not images")
+	if len(valid) == 0:
+		return np.zeros( (0, loaded_model.output_shape[-1]), dtype=np.float32 )
+
+	def predict_missing(idx):
+		predict = loaded_model.predict
+		AUTOTUNE = tf.data.AUTOTUNE
+		ds = tf.data.Dataset.from_tensor_slices( np.array( [ valid[i] for i in idx ], dtype=str ) )
+		ds = ds.map(load_predict_image, num_parallel_calls=AUTOTUNE, deterministic=True)
+		ds = ds.batch(batch_size).prefetch(buffer_size=AUTOTUNE)
+
+		# Decoding overlaps the model in the pipeline, so both are timed as one.
+		with imgtrace.stage('inference', count=len(idx), batch_size=batch_size, decode=True):
+			return predict( with_thread_budget(ds) )
+
+	keys = valid
+	if pred_cache is not None:
+		with imgtrace.stage('hash', count=len(valid)):
+			keys = [ "file-" + imgtiles.hash_file(fn) for fn in valid ]
+	return cached_predict(keys, predict_missing)
+
+
+def print_predictions(predictions, file=sys.stdout):
+	nc = predictions.shape[1]
+
+	with imgtrace.stage('output', count=len(predictions)):
+		for pred_dict in predictions:
+			p = list( map(lambda c: pred_dict[c], range(nc)) )
+			print(*p, sep="\t", file=file)
+
+
+def load_class_labels(fn_model):
+	fn_class_label = options.fn_class_label
+	if not fn_class_label:
+		fn_class_label = fn_model + '.labels'
+	if not os.path.isfile(fn_class_label):
+		return None
+	with open( fn_class_label, 'r' ) as f:
+		return [ l.strip() for l in f.readlines() if len(l.strip()) > 0 ]
+
+
+def format_class_probs(class_labels, probs):
+	order = sorted( range(len(probs)), key=lambda c: -probs[c] )
+	return [ class_labels[c] + ":" + str(probs[c]) for c in order ]
+
+
+def entropy(p):
+	if p >= 1 or p <= 0:
+		return 0
+	q = 1 - p
+	return ( - ( p * np.log(p) ) - ( q * np.log(q) ) ) / np.log(2)
+
+
+# Prints the per-tile rows and the median/max/min/vote/infogain summary rows
+# in the same format as ImageClassifier::predict with --split-tiles.
+
+def print_slide_predictions(fn_image, tile_names, class_labels, predictions):
+	for name, probs in zip(tile_names, predictions):
+		print(fn_image + ":" + name, class_labels[np.argmax(probs)], *format_class_probs(class_labels, probs), sep="\t")
+
+	if len(tile_names) <= 1:
+		return
+
+	for metric, metric_func in [ ('median', np.median), ('max', np.max), ('min', np.min) ]:
+		probs = metric_func(predictions, axis=0)
+		print(fn_image + ":" + metric, class_labels[np.argmax(probs)], *format_class_probs(class_labels, probs), sep="\t")
+
+	votes = np.bincount( np.argmax(predictions, axis=1), minlength=len(class_labels) ) / len(tile_names)
+	voted = [ c for c in range(len(class_labels)) if votes[c] > 0 ]
+	if len(voted) > 1:
+		order = sorted( voted, key=lambda c: -votes[c] )
+		print(fn_image + ":vote", class_labels[order[0]], *[ class_labels[c] + ":" + str(votes[c]) for c in order ], sep="\t")
+
+	if 'Y' in class_labels:
+		p = predictions[:, class_labels.index('Y')]
+		p0 = np.median(p)
+		print(fn_image + ":infogain", "?", np.mean([ entropy(p0) - entropy(pi) for pi in p ]), sep="\t")
+
+
+# BGR tiles to a model input batch: RGB, resized to the model input size with
+# nearest-neighbour interpolation as predict does, rescaled by 1/255.
+
+def tiles_to_batch(tiles):
+	tiles = [ t[:, :, ::-1] for t in tiles ]
+	tiles = [ t if t.shape[0:2] == (img_height, img_width) else cv2.resize(t, (img_width, img_height), interpolation=cv2.INTER_NEAREST) for t in tiles ]
+	return np.stack(tiles).astype(np.float32) * (1./255.)
+
+
+# Dense inference for predict-slide --dense. A model whose backbone is
+# convolutional up to a GlobalAveragePooling2D layer, either directly (as
+# train builds with -a keras/mobilenet_v2) or inside a nested Keras model, is
+# split into the backbone and the head (the layers after the pooling). The
+# backbone is run once over each region of the slide, with a halo of
+# DENSE_HALO pixels of context around it, and every tile is pooled from the
+# cells of the feature map under it, so overlapping tiles share the backbone
+# compute. A tile sees its neighbours instead of zero padding at its edges,
+# so the probabilities differ slightly from those of per-tile inference.
+# Hub feature vector layers pool inside their SavedModel and TFLite models
+# are opaque, so their tiles are predicted one by one as before.
+
+DENSE_HALO = 128
+
+
+# A copy of a functional model that takes inputs of any height and width,
+# with the same weights.
+
+def variable_input_model(model):
+	config = model.get_config()
+	for layer in config['layers']:
+		if layer['class_name'] == 'InputLayer':
+			layer['config']['batch_input_shape'] = ( None, None, None, model.input_shape[-1] )
+	clone = tf.keras.Model.from_config(config)
+	clone.set_weights( model.get_weights() )
+	return clone
+
+
+class DenseModel:
+	def __init__(self, model, region=2048):
+		self.model = model
+		self.region = region
+		self.backbone = None
+		self.head = None
+		self.checked = False
+
+	# Builds the backbone on inputs of any size and the head on pooled
+	# features; returns False when the model has no pooling layer to split at.
+
+	def split(self):
+		if self.checked:
+			return self.backbone is not None
+		self.checked = True
+		layers = list( getattr(self.model, 'layers', None) or [] )
+		trunk = None
+		pools = [ i for i, l in enumerate(layers) if isinstance(l, tf.keras.layers.GlobalAveragePooling2D) ]
+		if len(pools) > 0:
+			head = layers[ pools[-1] + 1 : ]
+			trunk = layers[ : pools[-1] ]
+		elif len(layers) > 0 and isinstance(layers[0], tf.keras.Model):
+			inner = layers[0]
+			pools = [ i for i, l in enumerate(inner.layers) if isinstance(l, tf.keras.layers.GlobalAveragePooling2D) ]
+			if len(pools) > 0:
+				head = inner.layers[ pools[-1] + 1 : ] + layers[1:]
+				clone = variable_input_model(inner)
+				trunk = [ tf.keras.Model( clone.inputs, clone.get_layer( inner.layers[ pools[-1] ].name ).input ) ]
+		if trunk is None:
+			eprint("predict-slide --dense: the model has no GlobalAveragePooling2D layer to split at (train it with -a keras/mobilenet_v2); predicting tiles one by one")
+			return False
+
+		x = inputs = tf.keras.Input( shape=(None, None, 3) )
+		for layer in trunk:
+			x = layer(x)
+		self.backbone = tf.keras.Model(inputs, x)
+		x = features = tf.keras.Input( shape=( self.backbone.output_shape[-1], ) )
+		for layer in head:
+			x = layer(x)
+		self.head = tf.keras.Model(features, x)
+
+		probe = self.backbone.predict_on_batch( np.zeros( (1, img_height, img_width, 3), dtype=np.float32 ) )
+		self.win_h, self.win_w = np.asarray(probe).shape[1:3]
+		self.stride = max( 1, int(round( img_height / self.win_h )) )
+		self.halo = -( -DENSE_HALO // self.stride )
+		eprint("predict-slide --dense: feature map cells of {} pixels, {} x {} cells per tile".format(self.stride, self.win_w, self.win_h))
+		return True
+
+	# Number of offsets per axis at which the backbone is run so that tiles
+	# step pixels apart fall on distinct positions: the smallest divisor k of
+	# the cell size with cells / k <= step. Each offset is a full backbone
+	# pass, so steps finer than a cell cost k * k times more.
+
+	def phases(self, step):
+		for k in range(1, self.stride + 1):
+			if self.stride % k == 0 and self.stride / k <= step:
+				return k
+		return self.stride
+
+	# Predictions of the tiles at origins (y, x) of img, which is scaled to
+	# the model input size, in the order given; step is the distance between
+	# neighbouring tiles. Tile origins are rounded to a grid of stride / k
+	# pixels, and the tiles are grouped by region of the cell grid and by
+	# offset within a cell. Each region is cropped at its offset with its
+	# halo, padded with black beyond the slide, and run through the backbone
+	# once.
+
+	def predict_tiles(self, img, origins, step):
+		s = self.stride
+		k = self.phases(step)
+		q = s // k
+		if k > 1:
+			eprint("predict-slide --dense: tiles {:.0f} pixels apart are finer than the {} pixel cells; running the backbone at {} x {} offsets".format(step, s, k, k))
+		units = np.rint( np.asarray(origins, dtype=np.float64).reshape(-1, 2) / q ).astype(np.int64)
+		cells = units // k
+		offsets = ( units % k ) * q
+		groups, group_of = np.unique( np.hstack( ( cells // max( 1, self.region // s ), offsets ) ), axis=0, return_inverse=True )
+		out = np.zeros( ( len(cells), self.head.output_shape[-1] ), dtype=np.float32 )
+		for g in range( len(groups) ):
+			sel = np.flatnonzero( group_of.reshape(-1) == g )
+			c0 = cells[sel].min(axis=0) - self.halo
+			c1 = cells[sel].max(axis=0) + (self.win_h, self.win_w) + self.halo
+			p0 = c0 * s + groups[g, 2:]
+			p1 = c1 * s + groups[g, 2:]
+			with imgtrace.timed('crop'):
+				region = np.zeros( ( p1[0] - p0[0], p1[1] - p0[1], 3 ), dtype=img.dtype )
+				y0, x0 = max( p0[0], 0 ), max( p0[1], 0 )
+				y1, x1 = min( p1[0], img.shape[0] ), min( p1[1], img.shape[1] )
+				if y1 > y0 and x1 > x0:
+					region[ y0 - p0[0] : y1 - p0[0], x0 - p0[1] : x1 - p0[1] ] = img[y0:y1, x0:x1]
+				batch = region[np.newaxis, :, :, ::-1].astype(np.float32) * (1./255.)
+			with imgtrace.timed('inference', len(sel)):
+				fmap = np.asarray( self.backbone.predict_on_batch(batch) )[0].astype(np.float64)
+			with imgtrace.timed('pool', len(sel)):
+				sums = np.zeros( ( fmap.shape[0] + 1, fmap.shape[1] + 1, fmap.shape[2] ) )
+				sums[1:, 1:] = fmap.cumsum(axis=0).cumsum(axis=1)
+				ty0 = np.clip( cells[sel, 0] - c0[0], 0, fmap.shape[0] - 1 )
+				tx0 = np.clip( cells[sel, 1] - c0[1], 0, fmap.shape[1] - 1 )
+				ty1 = np.minimum( ty0 + self.win_h, fmap.shape[0] )
+				tx1 = np.minimum( tx0 + self.win_w, fmap.shape[1] )
+				pooled = ( sums[ty1, tx1] - sums[ty0, tx1] - sums[ty1, tx0] + sums[ty0, tx0] ) / ( (ty1 - ty0) * (tx1 - tx0) )[:, np.newaxis]
+			with imgtrace.timed('inference', len(sel)):
+				out[sel] = self.head.predict_on_batch( pooled.astype(np.float32) )
+		return out
+
+
+# Runs n tiles spread over idx through the whole model as well and reports
+# how far the dense predictions are from theirs, and the time per tile of
+# both.
+
+def dense_check(fn_image, idx, predictions, predict_tiles, n, t_dense):
+	n = min( n, len(idx) )
+	if n <= 0:
+		return
+	sample = np.unique( np.linspace( 0, len(idx) - 1, n ).astype(np.int64) )
+	t0 = time.time()
+	reference = predict_tiles( [ idx[i] for i in sample ] )
+	t_tile = ( time.time() - t0 ) / len(sample)
+	diff = np.abs( predictions[sample] - reference )
+	agree = np.mean( np.argmax(predictions[sample], axis=1) == np.argmax(reference, axis=1) )
+	imgtrace.emit( 'dense_check', time.time() - t0, len(sample), max_abs_diff=float(diff.max()), mean_abs_diff=float(diff.mean()), argmax_agreement=float(agree) )
+	eprint("{} : dense vs per-tile on {} tiles: max |diff| {:.4g}, mean |diff| {:.4g}, argmax agreement {:.1f}%; {:.2f} ms per tile dense, {:.2f} ms per tile alone".format(
+		fn_image, len(sample), diff.max(), diff.mean(), 100 * agree, 1000 * t_dense / len(idx), 1000 * t_tile ))
+
+
+# Decodes the slide once and feeds the tiles to the model as batches built
+# from views into the decoded image, without writing tile files. With
+# min_tissue, tiles of blank background are skipped before they are scored.
+# With dense (a DenseModel), the tiles are pooled from the feature map of
+# the backbone and keyed apart from per-tile predictions in the cache.
+
+def predict_slide(loaded_model, fn_image, tile_w, tile_h, stride_factor, batch_size, min_tissue=0.0, dense=None):
+	imgtrace.set_context(slide=fn_image)
+	with imgtrace.stage('decode'):
+		src_image = cv2.imread(fn_image, cv2.IMREAD_COLOR)
+	if src_image is None:
+		eprint("predict-slide: unable to read " + fn_image)
+		return None, None
+
+	img_h, img_w = src_image.shape[0:2]
+	with imgtrace.stage('hash'):
+		image_stem = imgtiles.hash_file(fn_image)
+	origins = imgtiles.tile_grid(img_w, img_h, tile_w, tile_h, stride_factor)
+	eprint(fn_image + " : Image size " + str(img_w) + " x " + str(img_h) + ". Tiles " + str(len(origins)) + " (" + str(tile_w) + " x " + str(tile_h) + ")")
+
+	if min_tissue > 0:
+		tile_y = np.array( [ y for (y, x) in origins ], dtype=np.int64 )
+		tile_x = np.array( [ x for (y, x) in origins ], dtype=np.int64 )
+		with imgtrace.stage('mask', kind='tissue'):
+			mask = imgtissue.tissue_mask( imgtissue.thumbnail(src_image) )
+			tissue = imgtissue.tissue_fractions( mask, img_h, img_w, tile_y, tile_x, tile_y + tile_h, tile_x + tile_w )
+		origins = [ o for o, f in zip(origins, tissue) if f >= min_tissue ]
+		eprint(fn_image + " : " + str(len(origins)) + " tiles with tissue fraction >= " + str(min_tissue))
+
+	def predict_tiles(idx):
+		predictions = [ np.zeros( (0, loaded_model.output_shape[-1]), dtype=np.float32 ) ]
+		for i in range(0, len(idx), batch_size):
+			with imgtrace.timed('crop', len(idx[i:i + batch_size])):
+				batch = tiles_to_batch( [ imgtiles.crop_tile(src_image, origins[j][0], origins[j][1], tile_h, tile_w) for j in idx[i:i + batch_size] ] )
+			with imgtrace.timed('inference', len(batch)):
+				predictions.append( loaded_model.predict_on_batch(batch) )
+		return np.concatenate(predictions)
+
+	# Tiles of another size than the model input are resized to it, so the
+	# slide is resized once with the same nearest-neighbour interpolation.
+	def predict_dense(idx):
+		if not dense.split():
+			return predict_tiles(idx)
+		t0 = time.time()
+		fy = img_height / tile_h
+		fx = img_width / tile_w
+		img = src_image
+		if (tile_h, tile_w) != (img_height, img_width):
+			with imgtrace.timed('resize'):
+				img = cv2.resize(src_image, None, fx=fx, fy=fy, interpolation=cv2.INTER_NEAREST)
+		step = min( imgtiles.tile_stride(img_h, tile_h, stride_factor) * tile_h * fy, imgtiles.tile_stride(img_w, tile_w, stride_factor) * tile_w * fx )
+		predictions = dense.predict_tiles( img, [ ( origins[j][0] * fy, origins[j][1] * fx ) for j in idx ], step )
+		dense_check(fn_image, idx, predictions, predict_tiles, int(options.dense_check), time.time() - t0)
+		return predictions
+
+	# The tile names carry the slide hash and the tile box, so they key the
+	# prediction cache.
+	tile_names = [ imgtiles.tile_name(image_stem, 1.0, y, x, tile_h, tile_w) for (y, x) in origins ]
+	if dense is None:
+		return tile_names, cached_predict(tile_names, predict_tiles)
+	return tile_names, cached_predict( [ "dense-" + name for name in tile_names ], predict_dense )
+
+
+# Predicts the tiles of a shard in index order, decoding them straight from
+# the memory-mapped blob.
+
+def predict_shard(loaded_model, fn_shard, batch_size=None):
+	batch_size = batch_size or int(options.batch_size)
+	shard = imgshard.ShardReader(fn_shard)
+
+	def predict_missing(idx):
+		predictions = [ np.zeros( (0, loaded_model.output_shape[-1]), dtype=np.float32 ) ]
+		for i in range(0, len(idx), batch_size):
+			with imgtrace.timed('decode', len(idx[i:i + batch_size])):
+				batch = tiles_to_batch( [ shard.tile(j) for j in idx[i:i + batch_size] ] )
+			with imgtrace.timed('inference', len(batch)):
+				predictions.append( loaded_model.predict_on_batch(batch) )
+		return np.concatenate(predictions)
+
+	keys = list( range(len(shard)) )
+	if pred_cache is not None:
+		with imgtrace.stage('hash', count=len(shard)):
+			keys = [ "tile-" + h for h in tile_hashes( [ (0, i) for i in keys ], [ shard ] ) ]
+	return cached_predict(keys, predict_missing)
+
+
+# Image files and shards may be mixed; one row of predictions is returned per
+# image file and per tile of each shard, in the order given.
+
+def predict_inputs(loaded_model, inputs):
+	predictions = []
+	images = []
+	for fn in inputs + [ None ]:
+		if fn is not None and not imgshard.is_shard(fn):
+			images.append(fn)
+			continue
+		if len(images) > 0:
+			predictions.append( predict_images(loaded_model, images) )
+			images = []
+		if fn is not None:
+			predictions.append( predict_shard(loaded_model, fn) )
+	return np.concatenate(predictions)
+
+
+IMAGE_EXTENSIONS = ( '.bmp', '.gif', '.jpeg', '.jpg', '.png' )
+
+
+# Lists the training tiles and their labels without decoding any of them:
+# the image files in the class subdirectories of img_data_dir, or the
+# labelled tiles in the indexes of shards. Class names are in alphabetical
+# order, as with image_dataset_from_directory. For shards, items are
+# (shard, tile) pairs into the returned readers.
+
+def list_training_data(sources):
+	if len(sources) == 1 and os.path.isdir(sources[0]):
+		data_root = sources[0]
+		class_names = sorted( d for d in os.listdir(data_root) if os.path.isdir( os.path.join(data_root, d) ) )
+		items = []
+		labels = []
+		for c, name in enumerate(class_names):
+			for root, dirs, files in os.walk( os.path.join(data_root, name) ):
+				dirs.sort()
+				for fn in sorted(files):
+					if fn.lower().endswith(IMAGE_EXTENSIONS):
+						items.append( os.path.join(root, fn) )
+						labels.append(c)
+		return np.array(items, dtype=str), np.array(labels, dtype=np.int32), class_names, None
+
+	readers = [ imgshard.ShardReader(fn) for fn in sources ]
+	tiles = [ (s, i, e['class']) for s, r in enumerate(readers) for i, e in enumerate(r.entries) if e['class'] != '.' ]
+	class_names = sorted( set( c for (s, i, c) in tiles ) )
+	class_index = { c: k for k, c in enumerate(class_names) }
+	items = np.array( [ (s, i) for (s, i, c) in tiles ], dtype=np.int64 ).reshape(-1, 2)
+	labels = np.array( [ class_index[c] for (s, i, c) in tiles ], dtype=np.int32 )
+	return items, labels, class_names, readers
+
+
+# Seeded shuffle of the tiles; the last validation_split of them are held out.
+
+def split_training_data(n, validation_split, seed=0):
+	order = np.random.RandomState(seed).permutation(n)
+	n_val = int( validation_split * n )
+	return order[ : n - n_val ], order[ n - n_val : ]
+
+
+# Decodes and resizes the tiles with num_parallel_calls; image files are
+# decoded by TensorFlow, shard tiles by OpenCV straight from the memory map.
+
+def decode_dataset(items, labels, readers, image_size, deterministic=False):
+	AUTOTUNE = tf.data.AUTOTUNE
+	if readers is None:
+		def load(fn, y):
+			img = tf.image.decode_image( tf.io.read_file(fn), channels=3, expand_animations=False )
+			return tf.image.resize(img, image_size), y
+
+		ds = tf.data.Dataset.from_tensor_slices( (items, labels) )
+		return ds.map(load, num_parallel_calls=AUTOTUNE, deterministic=deterministic)
+
+	def load_tile(s, i):
+		return np.ascontiguousarray( readers[s].tile(i)[:, :, ::-1] )
+
+	def load(s, i, y):
+		img = tf.numpy_function(load_tile, [s, i], tf.uint8)
+		img.set_shape( [ None, None, 3 ] )
+		return tf.image.resize(img, image_size), y
+
+	ds = tf.data.Dataset.from_tensor_slices( (items[:, 0], items[:, 1], labels) )
+	return ds.map(load, num_parallel_calls=AUTOTUNE, deterministic=deterministic)
+
+
+# Augmentation layers selected by the letters of -A: Flip, Zoom, Translate,
+# Rotate, Contrast.
+
+def augmentation_model(augmentation):
+	layers = []
+	if 'Z' in augmentation:
+		layers.append( tf.keras.layers.experimental.preprocessing.RandomZoom( height_factor=(-0.1, 0.1), fill_mode="constant" ) )
+	if 'T' in augmentation:
+		layers.append( tf.keras.layers.experimental.preprocessing.RandomTranslation( 0.1, 0.1, fill_mode="constant" ) )
+	if 'R' in augmentation:
+		layers.append( tf.keras.layers.experimental.preprocessing.RandomRotation(1.0) )
+	if 'C' in augmentation:
+		layers.append( tf.keras.layers.experimental.preprocessing.RandomContrast(0.1) )
+	if 'F' in augmentation:
+		layers.append( tf.keras.layers.experimental.preprocessing.RandomFlip("horizontal_and_vertical") )
+	return tf.keras.Sequential(layers) if len(layers) > 0 else None
+
+
+# Input pipeline: decode, rescale, cache (in memory, to a file on local disk,
+# or not at all), shuffle, batch, then augment the training batches in
+# parallel. The cache holds decoded tiles, so it comes before augmentation.
+
+def training_dataset(items, labels, readers, image_size, batch_size, cache, augment=None, shuffle=False, deterministic=False):
+	AUTOTUNE = tf.data.AUTOTUNE
+	ds = decode_dataset(items, labels, readers, image_size, deterministic)
+	ds = ds.map( lambda x, y: (x * (1./256), y), num_parallel_calls=AUTOTUNE )
+	if cache == "memory":
+		ds = ds.cache()
+	elif cache != "none":
+		ds = ds.cache(cache)
+	if shuffle:
+		ds = ds.shuffle( batch_size * 8, seed=0, reshuffle_each_iteration=True )
+	ds = ds.batch(batch_size)
+	if augment is not None:
+		ds = ds.map( lambda x, y: (augment(x, training=True), y), num_parallel_calls=AUTOTUNE )
+	return with_thread_budget( ds.prefetch(buffer_size=AUTOTUNE) )
+
+
+# Embedding cache for training with a frozen backbone. The feature vector of
+# each tile is computed once per --arch and augmentation view, keyed by the
+# content hash of the tile, and kept in DIR as a float32 .npy memory map with
+# a .keys file giving the tile hash of each row. View 0 is the tile itself,
+# views 1..K are augmented with the -A layers.
+
+def embedding_cache_stem(cache_dir, view):
+	arch = re.sub( r'[^A-Za-z0-9_.-]+', '_', options.arch )
+	if view == 0:
+		return os.path.join(cache_dir, arch + "-v0")
+	return os.path.join(cache_dir, arch + "-" + options.augmentation + "-v" + str(view))
+
+
+def load_embedding_cache(stem):
+	if not os.path.isfile(stem + ".keys"):
+		return [], None
+	with open(stem + ".keys") as f:
+		keys = [ l.strip() for l in f ]
+	return keys, np.load(stem + ".npy", mmap_mode='r')
+
+
+def tile_hashes(items, readers):
+	if readers is None:
+		return [ imgtiles.hash_file(fn) for fn in items ]
+	hashes = []
+	for s, i in items:
+		e = readers[s].entries[i]
+		hashes.append( hashlib.sha1( readers[s].blob[ int(e['offset']) : int(e['offset']) + int(e['length']) ] ).hexdigest()[0:16] )
+	return hashes
+
+
+# Returns the memory-mapped embeddings of one view and the row of each tile,
+# running the backbone only on tiles that are not cached yet. New rows are
+# appended by writing a new file that replaces the old one. The .npy and
+# .keys files are replaced one after the other, so concurrent trainings on
+# the same DIR are serialised by an exclusive lock on stem.lock, taken
+# before the cache is read.
+
+def cached_embeddings(backbone, cache_dir, view, items, readers, hashes, image_size, batch_size):
+	stem = embedding_cache_stem(cache_dir, view)
+	os.makedirs(cache_dir, exist_ok=True)
+	with open(stem + ".lock", 'a') as lock:
+		fcntl.flock(lock, fcntl.LOCK_EX)
+		keys, emb = load_embedding_cache(stem)
+		row = { k: r for r, k in enumerate(keys) }
+
+		first = {}
+		for j, h in enumerate(hashes):
+			if h not in row and h not in first:
+				first[h] = j
+		eprint("Embedding cache " + stem + ": " + str(len(hashes) - len(first)) + " of " + str(len(hashes)) + " tiles cached")
+
+		if len(first) > 0:
+			idx = np.array( list( first.values() ), dtype=np.int64 )
+			augment = augmentation_model(options.augmentation) if view > 0 else None
+			tf.random.set_seed(view)
+			ds = training_dataset(items[idx], np.zeros( len(idx), dtype=np.int32 ), readers, image_size, batch_size, "none", augment=augment, deterministic=True)
+			new = backbone.predict( ds.map( lambda x, y: x ) )
+
+			fd, fn_tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+			os.close(fd)
+			out = np.lib.format.open_memmap(fn_tmp, mode='w+', dtype=np.float32, shape=( len(keys) + len(idx), new.shape[1] ))
+			if len(keys) > 0:
+				out[ : len(keys) ] = emb
+			out[ len(keys) : ] = new
+			out.flush()
+			del out
+			os.replace(fn_tmp, stem + ".npy")
+
+			with open(stem + ".keys.tmp", 'w') as f:
+				f.write( "".join( k + "\n" for k in keys + list(first) ) )
+			os.replace(stem + ".keys.tmp", stem + ".keys")
+
+			keys, emb = load_embedding_cache(stem)
+			row = { k: r for r, k in enumerate(keys) }
+
+	return emb, np.array( [ row[h] for h in hashes ], dtype=np.int64 )
+
+
+# Batches of cached embeddings: rows[v] are the rows of the tiles in the
+# memory map embs[v] of view v, and every view of every tile is one sample.
+
+def embedding_dataset(embs, rows, labels, batch_size, shuffle=False):
+	n_views = len(embs)
+	view_of = np.repeat( np.arange(n_views), len(labels) )
+	row_of = np.concatenate(rows)
+	label_of = np.tile(labels, n_views)
+	dim = embs[0].shape[1]
+
+	def gen():
+		order = np.random.permutation( len(row_of) ) if shuffle else np.arange( len(row_of) )
+		for b in range(0, len(order), batch_size):
+			sel = order[ b : b + batch_size ]
+			x = np.empty( (len(sel), dim), dtype=np.float32 )
+			for v in range(n_views):
+				m = view_of[sel] == v
+				if np.any(m):
+					x[m] = embs[v][ row_of[sel][m] ]
+			yield x, label_of[sel]
+
+	ds = tf.data.Dataset.from_generator(gen, output_signature=(
+		tf.TensorSpec(shape=(None, dim), dtype=tf.float32),
+		tf.TensorSpec(shape=(None,), dtype=tf.int32) ))
+	return ds.prefetch(buffer_size=tf.data.AUTOTUNE)
+
+
+# Request protocol of the serve action: image paths one per line, terminated
+# by an empty line. The reply is one row of probabilities per image, in the
+# same format as predict, terminated by an empty line.
+
+def serve_stream(loaded_model, rfile, wfile):
+	batch = []
+	for line in rfile:
+		line = line.strip()
+		if len(line) > 0:
+			batch.append(line)
+			continue
+		if len(batch) > 0:
+			with contextlib.redirect_stdout(sys.stderr):
+				predictions = predict_images(loaded_model, batch)
+			print_predictions(predictions, file=wfile)
+		wfile.write("\n")
+		wfile.flush()
+		batch = []
+	if len(batch) > 0:
+		with contextlib.redirect_stdout(sys.stderr):
+			predictions = predict_images(loaded_model, batch)
+		print_predictions(predictions, file=wfile)
+		wfile.flush()
+
+
+def serve_connections(loaded_model, server):
+	while True:
+		conn, addr = server.accept()
+		with conn, conn.makefile('r') as rfile, conn.makefile('w') as wfile:
+			serve_stream(loaded_model, rfile, wfile)
+
+
+# TensorFlow is not fork-safe: a process forked after TensorFlow has started
+# its thread pools may deadlock on locks held by threads that do not exist in
+# it. The workers are therefore forked before TensorFlow is imported and each
+# loads the model itself; they all accept() on the same listening socket,
+# which is bound under a temporary name and only moved to fn_socket once
+# every worker has loaded the model, so clients that wait for fn_socket (as
+# CL-TFImage.pl does) find the server ready.
+
+def serve_socket(fn_model, fn_socket, n_workers):
+	fn_bind = fn_socket + ".loading"
+	for fn in ( fn_socket, fn_bind ):
+		if os.path.exists(fn):
+			os.unlink(fn)
+	server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	server.bind(fn_bind)
+	server.listen(max(n_workers, 1) * 4)
+
+	def shutdown(signum, frame):
+		sys.exit(0)
+
+	signal.signal(signal.SIGTERM, shutdown)
+
+	children = []
+	try:
+		if n_workers <= 1:
+			loaded_model = load_predict_model(fn_model)
+			os.rename(fn_bind, fn_socket)
+			eprint("Serving " + fn_model + " on " + fn_socket + " with 1 worker(s)")
+			serve_connections(loaded_model, server)
+
+		ready_r, ready_w = os.pipe()
+		for i in range(n_workers):
+			pid = os.fork()
+			if pid == 0:
+				signal.signal(signal.SIGTERM, signal.SIG_DFL)
+				os.close(ready_r)
+				if pred_cache is not None:
+					pred_cache.connect()
+				try:
+					loaded_model = load_predict_model(fn_model)
+					os.write(ready_w, b".")
+					os.close(ready_w)
+					serve_connections(loaded_model, server)
+				except Exception as e:
+					eprint("serve: worker " + str(i) + ": " + str(e))
+					os._exit(1)
+				finally:
+					os._exit(0)
+			children.append(pid)
+
+		# Every worker writes one byte once its model is loaded; a worker
+		# that fails closes its end of the pipe without writing.
+		os.close(ready_w)
+		n_ready = 0
+		while n_ready < n_workers:
+			ready = os.read(ready_r, n_workers)
+			if len(ready) == 0:
+				break
+			n_ready += len(ready)
+		os.close(ready_r)
+		if n_ready < n_workers:
+			eprint("serve: " + str(n_workers - n_ready) + " of " + str(n_workers) + " workers could not load " + fn_model)
+			sys.exit(1)
+		os.rename(fn_bind, fn_socket)
+		eprint("Serving " + fn_model + " on " + fn_socket + " with " + str(n_workers) + " worker(s)")
+
+		for pid in children:
+			os.waitpid(pid, 0)
+	finally:
+		for pid in children:
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except ProcessLookupError:
+				pass
+		server.close()
+		for fn in ( fn_socket, fn_bind ):
+			if os.path.exists(fn):
+				os.unlink(fn)
+
+def read_image_list(args):
+	if args[0].find('index:') != -1:
+		with open(args[0][6:], "r") as f:
+			return [ x.strip() for x in f.readlines() if len(x.strip()) > 0 ]
+	return args
+
+
+# Runs one configuration of the tune action: n_workers processes predicting
+# the sample concurrently, each with n_threads intra-op threads and batches of
+# batch_size. Returns the aggregate throughput in images per minute.
+
+def bench_config(fn_model, fn_sample, n_workers, n_threads, batch_size):
+	cmd = [ sys.executable, os.path.abspath(__file__), '-a', options.arch, '-H', options.hub_dir, '-i', str(n_threads), '-j', '1', '-b', str(batch_size), 'bench', fn_model, 'index:' + fn_sample ]
+	env = dict(os.environ, TF_CPP_MIN_LOG_LEVEL='2')
+	workers = [ subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env, universal_newlines=True) for w in range(n_workers) ]
+	rate = 0.0
+	for p in workers:
+		out, err = p.communicate()
+		fields = out.strip().split("\t")
+		if p.returncode != 0 or len(fields) < 2:
+			return None
+		rate += 60 * float(fields[0]) / float(fields[1])
+	return rate
+
+
+# Writes the tuned keys into an mlev_config style file, keeping other keys.
+
+def save_tuned_config(fn_config, config, comment):
+	lines = []
+	if os.path.isfile(fn_config):
+		with open(fn_config) as f:
+			lines = [ l for l in f if l.split('=')[0].strip() not in config and not l.startswith('# Tuned by') ]
+	lines.append( "# Tuned by MobileNetV2.py tune: " + comment + "\n" )
+	lines += [ "{} = {}\n".format(k, v) for k, v in config.items() ]
+	with open(fn_config, 'w') as f:
+		f.write( "".join(lines) )
+
+
+# Converts a Keras model to TFLite. int8 quantization is calibrated on the
+# given images; the model input and output stay float32, so the tflite model
+# is a drop-in replacement for predict.
+
+def export_tflite(loaded_model, fn_tflite, quantize, calibration_images):
+	converter = tf.lite.TFLiteConverter.from_keras_model(loaded_model)
+	if quantize in ( "dynamic", "int8" ):
+		converter.optimizations = [ tf.lite.Optimize.DEFAULT ]
+	if quantize == "int8":
+		def representative_dataset():
+			for fn in calibration_images:
+				yield [ load_predict_image( tf.constant(fn) )[tf.newaxis] ]
+		converter.representative_dataset = representative_dataset
+		converter.target_spec.supported_ops = [ tf.lite.OpsSet.TFLITE_BUILTINS_INT8 ]
+	with open(fn_tflite, 'wb') as f:
+		f.write( converter.convert() )
+
+
+# Compares the tflite model with the float model on held-out images: per-class
+# mean and max absolute difference of the probabilities, argmax agreement,
+# model size and time per image. Written as TSV to fn_report.
+
+def parity_report(float_model, tflite_model, images, class_labels, fn_model, fn_tflite, fn_report):
+	t0 = time.time()
+	p_float = predict_images(float_model, images)
+	t1 = time.time()
+	p_tflite = predict_images(tflite_model, images)
+	t2 = time.time()
+
+	diff = np.abs(p_float - p_tflite)
+	rows = [ ( "class", "mean_abs_diff", "max_abs_diff", "float_mean_prob", "tflite_mean_prob" ) ]
+	for c, label in enumerate(class_labels):
+		rows.append( ( label, diff[:, c].mean(), diff[:, c].max(), p_float[:, c].mean(), p_tflite[:, c].mean() ) )
+	rows.append( ( "argmax_agreement", np.mean( np.argmax(p_float, axis=1) == np.argmax(p_tflite, axis=1) ) ) )
+	rows.append( ( "images", len(p_float) ) )
+	rows.append( ( "float_size_bytes", os.path.getsize(fn_model) ) )
+	rows.append( ( "tflite_size_bytes", os.path.getsize(fn_tflite) ) )
+	rows.append( ( "float_ms_per_image", 1000 * (t1 - t0) / max(len(p_float), 1) ) )
+	rows.append( ( "tflite_ms_per_image", 1000 * (t2 - t1) / max(len(p_float), 1) ) )
+
+	with open(fn_report, 'w') as f:
+		for row in rows:
+			print( *row, sep="\t", file=f )
+			print( *row, sep="\t", file=sys.stderr )
+
+
 if action == 'train':
-	data_root = args[2]
-	train_ds = tf.keras.preprocessing.image_dataset_from_directory(
-		str(data_root),
-		validation_split=options.validation_split,
-		subset="training",
-		seed=0,
-		image_size=(img_height, img_width),
-		batch_size=options.batch_size)
-
-	class_names = np.array(train_ds.class_names)
+	import_tensorflow(with_hub=True)
+	from sklearn.utils import class_weight
+	from tensorflow.keras.callbacks import EarlyStopping
+
+	items, labels, class_names, readers = list_training_data(args[2:])
+	train_idx, val_idx = split_training_data( len(labels), float(options.validation_split) )
+	eprint("Found " + str(len(labels)) + " tiles belonging to " + str(len(class_names)) + " classes. Using " + str(len(train_idx)) + " for training and " + str(len(val_idx)) + " for validation.")
+
+	class_names = np.array(class_names)
 	num_classes = len(class_names)
 	print(class_names)
 
-	normalization_layer = tf.keras.layers.experimental.preprocessing.Rescaling(1./256)
-	train_ds = train_ds.map(lambda x, y: (normalization_layer(x), y))
-
-	AUTOTUNE = tf.data.AUTOTUNE
-	train_ds = train_ds.cache().prefetch(buffer_size=AUTOTUNE)
-	
-	feature_extractor_layer = hub.KerasLayer(
-		feature_extractor_model, input_shape=(img_width, img_height, 3), trainable=options.trainable) # False
-
-	model = tf.keras.Sequential()
-	model.add( tf.keras.layers.experimental.preprocessing.RandomZoom( height_factor=(-0.1, 0.1), fill_mode="constant", input_shape=(img_height, img_width, 3)) )  
-	model.add( tf.keras.layers.experimental.preprocessing.RandomRotation(1.0) )
-	model.add( tf.keras.layers.experimental.preprocessing.RandomContrast(0.1) )
-	model.add( tf.keras.layers.experimental.preprocessing.RandomFlip("horizontal_and_vertical") )
-	
-	model.add(feature_extractor_layer);
+	batch_size = int(options.batch_size)
 	
+	feature_extractor = feature_extractor_layers(options.trainable) # False
+
 	layers_def = options.hidden_layers
 	layers_struct = [ int(l) for l in layers_def.split(',') if len(l) > 0 ]
 
-	for l in layers_struct:
-		model.add( tf.keras.layers.Dense(l, activation="relu") )
-	
-	model.add( tf.keras.layers.Dense(num_classes, activation="softmax", name="output") )
+	head = [ tf.keras.layers.Dense(l, activation="relu") for l in layers_struct ]
+	head.append( tf.keras.layers.Dense(num_classes, activation="softmax", name="output") )
+
+	# With a frozen backbone and -E, only the head is fitted, on cached
+	# embeddings; the saved model is the backbone followed by the head.
+	use_embeddings = options.embedding_cache and not options.trainable
+	if use_embeddings:
+		backbone = tf.keras.Sequential( feature_extractor )
+		hashes = tile_hashes(items, readers)
+		views = [ cached_embeddings(backbone, options.embedding_cache, v, items, readers, hashes, (img_height, img_width), batch_size) for v in range( int(options.augmented_views) + 1 ) ]
+		embs = [ emb for (emb, rows) in views ]
+		train_ds = embedding_dataset(embs, [ rows[train_idx] for (emb, rows) in views ], labels[train_idx], batch_size, shuffle=True)
+		val_ds = embedding_dataset(embs[0:1], [ views[0][1][val_idx] ], labels[val_idx], batch_size) if len(val_idx) > 0 else None
+		model = tf.keras.Sequential( [ tf.keras.layers.InputLayer( input_shape=(embs[0].shape[1],) ) ] + head )
+	else:
+		cache_val = options.cache if options.cache in ( "memory", "none" ) else options.cache + ".val"
+		train_ds = training_dataset(items[train_idx], labels[train_idx], readers, (img_height, img_width), batch_size, options.cache, augment=augmentation_model(options.augmentation), shuffle=True)
+		val_ds = training_dataset(items[val_idx], labels[val_idx], readers, (img_height, img_width), batch_size, cache_val) if len(val_idx) > 0 else None
+		model = tf.keras.Sequential( feature_extractor + head )
 		
 	model.summary()
 
@@ -121,16 +1179,20 @@ if action == 'train':
 		loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=False),
 		metrics=['acc'])
 
-	fit_callbacks = [EarlyStopping(monitor='loss', patience=int(options.patience), restore_best_weights=True)]
+	fit_callbacks = [EarlyStopping(monitor='val_loss' if val_ds is not None else 'loss', patience=int(options.patience), restore_best_weights=True)]
 
-	y_train = np.concatenate([y for x, y in train_ds], axis=0)
+	# Class weights come from the listing, so no tile is decoded for them.
+	y_train = labels[train_idx]
 	y_classes = np.unique(y_train)
 	class_weights = class_weight.compute_class_weight('balanced', classes=y_classes, y=y_train)
 	class_weights = {i : class_weights [i] for i in range( len(class_weights) )}
 
-	history = model.fit(train_ds, epochs=int(options.epochs), class_weight=class_weights, callbacks=[fit_callbacks])
+	history = model.fit(train_ds, validation_data=val_ds, epochs=int(options.epochs), class_weight=class_weights, callbacks=[fit_callbacks])
+
+	if use_embeddings:
+		model = tf.keras.Sequential( feature_extractor + head )
 	
-	model.save(fn_model, save_format="h5")
+	model.save(fn_model, save_format=options.save_format)
 	
 	fn_class_label = options.fn_class_label
 	
@@ -142,31 +1204,130 @@ if action == 'train':
 		f.close()
 	
 elif action == 'predict':
-	tf.config.set_visible_devices([], 'GPU')
-        
-	if ( args[2].find('index:') != -1 ) :
-		index_filename = args[2][6:];
-		f = open(index_filename, "r")
-		images_to_test = [x.strip() for x in f.readlines()]
-		f.close()
-	else :
-		images_to_test = args[2:] 
+	images_to_test = read_image_list(args[2:])
 	
-	loaded_model = tf.keras.models.load_model(fn_model, custom_objects={'KerasLayer':hub.KerasLayer})
+	loaded_model = LazyModel(fn_model) if open_prediction_cache(fn_model) is not None else load_predict_model(fn_model)
 
-	testdf=pd.DataFrame( { "fn": images_to_test }, dtype=str)
-	test_datagen=ImageDataGenerator(rescale=1./255.)
-	test_generator=test_datagen.flow_from_dataframe(dataframe=testdf, directory=".", x_col="fn", y_col=None, batch_size=8, shuffle=False, class_mode=None, target_size=(img_height,img_width) )
+	predictions = predict_inputs(loaded_model, images_to_test)
+	report_startup("predict")
 
-	test_generator.reset()
+	print_predictions(predictions)
+	close_prediction_cache()
 
-	predictions = loaded_model.predict ( test_generator )
+elif action == 'serve':
+	open_prediction_cache(fn_model)
 
-	nc = predictions.shape[1]
+	if options.socket:
+		serve_socket(fn_model, options.socket, int(options.workers))
+	else:
+		serve_stream(load_predict_model(fn_model), sys.stdin, sys.stdout)
 
-	i=0
-	for pred_dict in predictions:
-		p = list( map(lambda c: pred_dict[c], range(nc)) )
-		print(*p, sep="\t")
-		i += 1
-	
+elif action == 'predict-slide':
+	loaded_model = LazyModel(fn_model) if open_prediction_cache(fn_model) is not None else load_predict_model(fn_model)
+
+	tile_w, tile_h = imgtiles.parse_tile_dim(options.tile_size)
+	dense = DenseModel( loaded_model, int(options.dense_region) ) if options.dense else None
+
+	for fn_image in args[2:]:
+		tile_names, predictions = predict_slide(loaded_model, fn_image, tile_w, tile_h, float(options.tile_stride), int(options.batch_size), float(options.min_tissue), dense)
+		if tile_names is None:
+			continue
+		class_labels = load_class_labels(fn_model)
+		if class_labels is None:
+			class_labels = [ str(c) for c in range(predictions.shape[1]) ]
+		with imgtrace.stage('output', count=len(tile_names)):
+			print_slide_predictions(fn_image, tile_names, class_labels, predictions)
+	close_prediction_cache()
+
+elif action == 'bench':
+	images_to_test = read_image_list(args[2:])
+	loaded_model = load_predict_model(fn_model)
+	predict_inputs( loaded_model, images_to_test[ : int(options.batch_size) ] )
+
+	t_startup = time.time() - startup_t0
+
+	t0 = time.time()
+	predictions = predict_inputs(loaded_model, images_to_test)
+	print( len(predictions), time.time() - t0, t_startup, sep="\t" )
+
+elif action == 'tune':
+	images = read_image_list(args[2:])
+	sample = random.Random(0).sample( images, min( len(images), int(options.tune_sample) ) )
+	fd, fn_sample = tempfile.mkstemp(suffix=".txt")
+	with os.fdopen(fd, 'w') as f:
+		f.write( "".join( fn + "\n" for fn in sample ) )
+
+	# The batch size is tuned with one process using every core, then the
+	# split of the cores between processes at that batch size.
+	n_cpus = os.cpu_count() or 1
+	results = []
+	try:
+		for batch_size in [ 8, 16, 32, 64 ]:
+			results.append( (bench_config(fn_model, fn_sample, 1, n_cpus, batch_size), 1, n_cpus, batch_size) )
+			eprint("workers 1 x threads {} batch {}: {} images/min".format(n_cpus, batch_size, results[-1][0]))
+		if all( r[0] is None for r in results ):
+			eprint("tune: bench failed for every batch size")
+			sys.exit(1)
+		best_batch = max( [ r for r in results if r[0] is not None ] )[3]
+
+		n_workers = 2
+		while n_workers <= n_cpus:
+			n_threads = max( 1, n_cpus // n_workers )
+			results.append( (bench_config(fn_model, fn_sample, n_workers, n_threads, best_batch), n_workers, n_threads, best_batch) )
+			eprint("workers {} x threads {} batch {}: {} images/min".format(n_workers, n_threads, best_batch, results[-1][0]))
+			n_workers *= 2
+	finally:
+		os.unlink(fn_sample)
+
+	results = [ r for r in results if r[0] is not None ]
+	print("workers", "threads", "batch_size", "images_per_min", sep="\t")
+	for rate, n_workers, n_threads, batch_size in results:
+		print(n_workers, n_threads, batch_size, "{:.1f}".format(rate), sep="\t")
+
+	rate, n_workers, n_threads, batch_size = max(results)
+	save_tuned_config( options.tune_output, {
+		'CL-TFImage.predict.workers': n_workers,
+		'CL-TFImage.predict.threads': n_threads,
+		'CL-TFImage.predict.batch_size': batch_size,
+		}, "{} on {}, {:.1f} images/min".format( os.path.basename(fn_model), socket.gethostname(), rate ) )
+	eprint("Saved {} workers x {} threads, batch {} ({:.1f} images/min) to {}".format(n_workers, n_threads, batch_size, rate, options.tune_output))
+
+elif action == 'export':
+	fn_tflite = args[2]
+	images = read_image_list(args[3:]) if len(args) > 3 else []
+	images = random.Random(0).sample( images, len(images) )
+	n_calibration = min( int(options.calibration_size), len(images) // 2 ) if options.quantize == "int8" else 0
+	if options.quantize == "int8" and n_calibration == 0:
+		parser.error("export --quantize int8 needs images to calibrate on")
+
+	loaded_model = load_predict_model(fn_model)
+	export_tflite(loaded_model, fn_tflite, options.quantize, images[ : n_calibration ])
+	eprint("Exported " + fn_model + " to " + fn_tflite + " (quantization: " + options.quantize + ")")
+
+	class_labels = load_class_labels(fn_model)
+	if class_labels is not None:
+		with open(fn_tflite + '.labels', 'w') as f:
+			f.write( "\n".join(class_labels) )
+	else:
+		class_labels = [ str(c) for c in range(loaded_model.output_shape[-1]) ]
+
+	if len(images) > n_calibration:
+		parity_report(loaded_model, load_predict_model(fn_tflite), images[ n_calibration : ], class_labels, fn_model, fn_tflite, fn_tflite + '.parity.tsv')
+
+elif action == 'fetch-arch':
+	# Run on a host with network access; copy hub_dir to the compute nodes
+	# and pass it with -H.
+	if options.arch in KERAS_ARCHS:
+		import_tensorflow()
+		fn_arch = os.path.join( fn_model, *options.arch.split('/') )
+		os.makedirs(fn_arch, exist_ok=True)
+		keras_arch_backbone(options.arch, 'imagenet').save_weights( os.path.join(fn_arch, 'weights.h5') )
+		eprint("Saved " + options.arch + " to " + fn_arch)
+		sys.exit(0)
+	import_tensorflow(with_hub=True)
+	arch = re.sub(r'^https?://tfhub\.dev/', '', options.arch).strip('/')
+	fn_arch = os.path.join( fn_model, *arch.split('/') )
+	if os.path.isdir(fn_arch):
+		shutil.rmtree(fn_arch)
+	shutil.copytree( hub.resolve("https://tfhub.dev/" + arch), fn_arch )
+	eprint("Saved " + options.arch + " to " + fn_arch)